@@ -1,37 +1,91 @@
 # -*- coding: utf-8 -*-
 
-
-from typing import Dict, Text, Any, Callable
+import collections
+from typing import Dict, Text, Any, Callable, Optional, MutableMapping, List, Iterable
 
 from d7.core import loader
 from d7.core.builtin import get_uuid
 from d7.core.parser import parse_variables_mapping, parse_string, parse_data, get_mapping_function, \
-    get_mapping_variable
+    get_mapping_variable, CompiledData, build_functions_table
 
 
 class Context(object):
 
-    _variables_map: Dict[Text, Any] = {}
+    _variables_map: MutableMapping[Text, Any] = {}
     _functions_map: Dict[Text, Callable] = {}
+    # all functions that can be referenced, built from _functions_map on demand
+    _functions_table: Optional[Dict[Text, Callable]] = None
+    # loaded scripts, so that the context can be rebuilt in another process
+    _scripts: List[Text] = []
 
     def __init__(self) -> None:
+        self._variables_map = {}
         self._functions_map = loader.load_builtin_functions()
+        self._functions_table = None
+        self._scripts = []
+
+    def fork(self) -> 'Context':
+        """create a child context, e.g. for one loop running concurrently with others.
+        variables of this context are visible to the child, but variables set in the child
+        are kept in the child only, see get_local_variables.
+        """
+        ctx = Context.__new__(Context)
+        ctx._variables_map = collections.ChainMap({}, self._variables_map)
+        ctx._functions_map = dict(self._functions_map)
+        ctx._functions_table = self.get_functions_table()
+        ctx._scripts = list(self._scripts)
+        return ctx
+
+    def get_variables(self) -> Dict[Text, Any]:
+        """all variables, including the ones of parent context if forked."""
+        return dict(self._variables_map)
+
+    def get_local_variables(self) -> Dict[Text, Any]:
+        """variables set in this context, excluding the ones of parent context if forked."""
+        if isinstance(self._variables_map, collections.ChainMap):
+            return self._variables_map.maps[0]
+        return self._variables_map
+
+    def merge(self, child: 'Context', names: Optional[Iterable[Text]] = None):
+        """merge variables set in a forked child context back, only the ones of names if given.
+        scripts loaded by the child are merged too.
+        """
+        local_variables = child.get_local_variables()
+        if names is None:
+            names = list(local_variables)
+        self.set_variables({name: local_variables[name] for name in names if name in local_variables})
+        scripts = [script for script in child._scripts if script not in self._scripts]
+        if scripts:
+            self._functions_map.update(child._functions_map)
+            self._functions_table = None
+            self._scripts.extend(scripts)
 
     def load_script(self, script_str: Text):
         self._functions_map.update(**loader.load_functions_from_script(script_str, get_uuid()))
+        self._functions_table = None
+        self._scripts.append(script_str)
+
+    def get_scripts(self) -> List[Text]:
+        return self._scripts
+
+    def get_functions_table(self) -> Dict[Text, Callable]:
+        if self._functions_table is None:
+            self._functions_table = build_functions_table(self._functions_map)
+        return self._functions_table
 
     def extract_variables(self, variables: Dict[Text, Any]):
         if variables is None:
             return
-        for key in variables:
-            self._variables_map[key] = self.parse_data(variables[key])
-        self._variables_map.update(parse_variables_mapping(self._variables_map, self._functions_map))
+        self._variables_map.update(parse_variables_mapping(variables, self.get_functions_table(), self._variables_map))
 
     def parse_string(self, raw_string: Text) -> Any:
-        return parse_string(raw_string, self._variables_map, self._functions_map)
+        return parse_string(raw_string, self._variables_map, self.get_functions_table())
 
     def parse_data(self, raw_data: Any) -> Any:
-        return parse_data(raw_data, self._variables_map, self._functions_map)
+        return parse_data(raw_data, self._variables_map, self.get_functions_table())
+
+    def evaluate(self, compiled_data: CompiledData) -> Any:
+        return compiled_data.evaluate(self._variables_map, self.get_functions_table())
 
     def set_variable(self, key: Text, value: Any):
         self._variables_map[key] = value
@@ -40,7 +94,7 @@ class Context(object):
         self._variables_map.update(**variables)
 
     def get_variable(self, name: Text) -> Callable:
-        return get_mapping_variable(name, self._variables_map, self._functions_map)
+        return get_mapping_variable(name, self._variables_map, self.get_functions_table())
 
     def get_function(self, name: Text) -> Callable:
-        return get_mapping_function(name, self._functions_map)
+        return get_mapping_function(name, self.get_functions_table())
@@ -74,6 +74,10 @@ class VariablePointToSelf(NotFoundError):
     pass
 
 
+class VariableCircularReference(VariablePointToSelf):
+    pass
+
+
 class EnvNotFound(NotFoundError):
     pass
 
@@ -2,8 +2,11 @@
 
 import ast
 import builtins
+import collections
 import re
-from typing import Any, Callable, Dict, List, Set, Text
+import reprlib
+from functools import lru_cache
+from typing import AbstractSet, Any, Callable, Dict, List, Sequence, Set, Text
 from urllib.parse import urlparse
 
 from d7.core import utils, loader, exceptions
@@ -17,6 +20,9 @@ dolloar_regex_compile = re.compile(r"\$\$")
 variable_regex_compile = re.compile(r"\$\{([a-zA-Z_]\w*\.?)+\}|\$([a-zA-Z_]\w*)")
 # function notation, e.g. ${func1($var_1, $var_2)}
 function_regex_compile = re.compile(r"\$\{([a-zA-Z_]\w*)\(([\$\w\.\-/\s=,]*)\)\}")
+# values of these keys are left as it is when parsing dict, e.g. children of LOOP step,
+# a step may leave more keys of its own config, see StepBase.ignore_variables
+ignore_variables = {'children'}
 
 
 def build_url(base_url, step_url):
@@ -87,6 +93,8 @@ def regex_findall_variables(raw_string: Text) -> List[Text]:
             var_name = var_match.group(1) or var_match.group(2)
             vars_list.append(var_name)
             match_start_position = var_match.end()
+            # e.g. "$var1$var2", the next variable may start right after this one
+            continue
 
         curr_position = match_start_position
         try:
@@ -101,22 +109,27 @@ def regex_findall_variables(raw_string: Text) -> List[Text]:
 
 def extract_variables(content: Any) -> Set:
     """extract all variables in content recursively."""
+    return set(extract_ordered_variables(content))
+
+
+def extract_ordered_variables(content: Any) -> List[Text]:
+    """extract all variables in content recursively, without duplicates, in the order of first appearance."""
     if isinstance(content, (list, set, tuple)):
-        variables = set()
+        variables = {}
         for item in content:
-            variables = variables | extract_variables(item)
-        return variables
+            variables.update(dict.fromkeys(extract_ordered_variables(item)))
+        return list(variables)
 
     elif isinstance(content, dict):
-        variables = set()
+        variables = {}
         for key, value in content.items():
-            variables = variables | extract_variables(value)
-        return variables
+            variables.update(dict.fromkeys(extract_ordered_variables(value)))
+        return list(variables)
 
     elif isinstance(content, str):
-        return set(regex_findall_variables(content))
+        return list(dict.fromkeys(regex_findall_variables(content)))
 
-    return set()
+    return []
 
 
 def parse_string_value(str_value: Text) -> Any:
@@ -184,13 +197,125 @@ def parse_function_params(params: Text) -> Dict:
     return function_meta
 
 
+# max count of compiled variable paths kept in cache
+VARIABLE_PATH_CACHE_SIZE = 4096
+
+# variables map in VariableNotFound message is truncated by this
+_variables_repr = reprlib.Repr()
+_variables_repr.maxlevel = 3
+_variables_repr.maxdict = 20
+_variables_repr.maxlist = 10
+_variables_repr.maxstring = 64
+_variables_repr.maxother = 64
+
+
+class VariableNotFoundMessage(object):
+    """message of exceptions.VariableNotFound, it is formatted only when printed,
+    and the variables map in message is truncated."""
+    __slots__ = ('variable_name', 'variables_mapping')
+
+    # max length of formatted message
+    max_length = 1024
+
+    def __init__(self, variable_name: Text, variables_mapping: VariablesMapping):
+        self.variable_name = variable_name
+        self.variables_mapping = variables_mapping
+
+    def __str__(self) -> str:
+        variables_mapping = self.variables_mapping
+        if not isinstance(variables_mapping, dict):
+            # e.g. ChainMap
+            variables_mapping = dict(variables_mapping)
+        return utils.omit_long_data(
+            f"{self.variable_name} not found, variables_map={_variables_repr.repr(variables_mapping)}",
+            self.max_length,
+        )
+
+    def __repr__(self) -> str:
+        return repr(str(self))
+
+
+def _to_mapping_key(key: Any) -> Any:
+    if isinstance(key, str) and key.isnumeric():
+        return int(key)
+    return key
+
+
+class VariablePath(object):
+    """compiled variable name, e.g. "p4.$p1.p5", see compile_variable_path.
+
+    keys are static keys (str or int) except the $-dynamic ones, which are CompiledString
+    and resolved against variables mapping on every access.
+    """
+    __slots__ = ('variable_name', 'keys')
+
+    def __init__(self, variable_name: Text, keys: List):
+        self.variable_name = variable_name
+        self.keys = keys
+
+    def _get(self, variables_mapping: VariablesMapping, functions_mapping: FunctionsMapping) -> Any:
+        value = variables_mapping
+        for key in self.keys:
+            if isinstance(key, CompiledString):
+                key = _to_mapping_key(key.evaluate(variables_mapping, functions_mapping))
+            value = value[key]
+        return value
+
+    def get(self, variables_mapping: VariablesMapping, functions_mapping: FunctionsMapping) -> Any:
+        try:
+            return self._get(variables_mapping, functions_mapping)
+        except KeyError:
+            raise exceptions.VariableNotFound(
+                VariableNotFoundMessage(self.variable_name, variables_mapping)
+            ) from None
+
+    def exists(self, variables_mapping: VariablesMapping, functions_mapping: FunctionsMapping) -> bool:
+        try:
+            self._get(variables_mapping, functions_mapping)
+        except KeyError:
+            return False
+        return True
+
+    def __repr__(self) -> str:
+        return f'<VariablePath of "{self.variable_name}">'
+
+
+@lru_cache(maxsize=VARIABLE_PATH_CACHE_SIZE)
+def compile_variable_path(variable_name: Text) -> VariablePath:
+    """compile variable name to VariablePath, compiled paths are cached by variable name.
+
+    Examples:
+        >>> compile_variable_path("p4.$p1.p5").keys
+        ['p4', <CompiledString of "$p1">, 'p5']
+
+        >>> compile_variable_path("p4.0.p5").keys
+        ['p4', 0, 'p5']
+
+    """
+    keys = variable_name.split('.')
+    if len(keys) == 1:
+        return VariablePath(variable_name, [_to_mapping_key(variable_name)])
+
+    compiled_keys = []
+    for key in keys:
+        key = key.strip(" \t")
+        if "$" in key:
+            compiled_key = compile_string(key)
+            if not compiled_key.is_constant():
+                compiled_keys.append(compiled_key)
+                continue
+            key = compiled_key.evaluate({}, {})
+        compiled_keys.append(_to_mapping_key(key))
+    return VariablePath(variable_name, compiled_keys)
+
+
 def get_mapping_variable(variable_name: Text,
                          variables_mapping: VariablesMapping,
                          functions_mapping: FunctionsMapping) -> Any:
     """get variable from variables_mapping.
 
     Args:
-        variable_name (str): variable name
+        variable_name (str): variable name, e.g. "p1", "p2.p3", "p4.$p1.p5"
         variables_mapping (dict): variables mapping
 
     Returns:
@@ -200,20 +325,38 @@ def get_mapping_variable(variable_name: Text,
         exceptions.VariableNotFound: variable is not found.
 
     """
-    keys = variable_name.split('.')
-    if len(keys) > 1:
-        keys = parse_data(keys, variables_mapping, functions_mapping)
-    value = variables_mapping
-    try:
-        for key in keys:
-            if key.isnumeric():
-                key = int(key)
-            value = value[key]
-        return value
-    except KeyError:
-        raise exceptions.VariableNotFound(
-            f"{variable_name} not found, variables_map={variables_mapping}"
-        )
+    return compile_variable_path(variable_name).get(variables_mapping, functions_mapping)
+
+
+@lru_cache(maxsize=1)
+def _load_default_functions() -> FunctionsMapping:
+    """functions that can be referenced without being loaded, do not modify the returned mapping"""
+    # Python builtin functions
+    functions_mapping = dict(vars(builtins))
+    # d7 builtin functions
+    functions_mapping.update(loader.load_builtin_functions())
+    functions_mapping["parameterize"] = functions_mapping["P"] = loader.load_csv_file
+    functions_mapping["environ"] = functions_mapping["ENV"] = utils.get_os_environ
+    return functions_mapping
+
+
+def build_functions_table(functions_mapping: FunctionsMapping = None) -> FunctionsMapping:
+    """resolve all functions that can be referenced by name into one table,
+    so that looking up a function is a single dict lookup.
+
+    priority: functions_mapping > parameterize/environ > d7 builtin functions > Python builtin functions
+
+    Args:
+        functions_mapping (dict): functions mapping, e.g. functions loaded from script
+
+    Returns:
+        dict: functions table
+
+    """
+    functions_table = dict(_load_default_functions())
+    if functions_mapping:
+        functions_table.update(functions_mapping)
+    return functions_table
 
 
 def get_mapping_function(function_name: Text, functions_mapping: FunctionsMapping) -> Callable:
@@ -234,57 +377,133 @@ def get_mapping_function(function_name: Text, functions_mapping: FunctionsMappin
     if function_name in functions_mapping:
         return functions_mapping[function_name]
 
-    elif function_name in ["parameterize", "P"]:
-        return loader.load_csv_file
+    # check if parameterize/environ, d7 builtin functions or Python builtin functions
+    default_functions = _load_default_functions()
+    if function_name in default_functions:
+        return default_functions[function_name]
 
-    elif function_name in ["environ", "ENV"]:
-        return utils.get_os_environ
+    raise exceptions.FunctionNotFound(f"{function_name} is not found.")
 
-    try:
-        # check if data_maker_core builtin functions
-        built_in_functions = loader.load_builtin_functions()
-        return built_in_functions[function_name]
-    except KeyError:
-        pass
 
-    try:
-        # check if Python builtin functions
-        return getattr(builtins, function_name)
-    except AttributeError:
-        pass
+# token kinds of a compiled string
+TOKEN_LITERAL = 0
+TOKEN_VARIABLE = 1
+TOKEN_FUNCTION = 2
 
-    raise exceptions.FunctionNotFound(f"{function_name} is not found.")
+# max count of compiled strings kept in cache
+COMPILED_STRING_CACHE_SIZE = 4096
 
 
-def parse_string(
-        raw_string: Text,
-        variables_mapping: VariablesMapping,
-        functions_mapping: FunctionsMapping,
-) -> Any:
-    """parse string content with variables and functions mapping.
+class CompiledString(object):
+    """token program of a raw string, which is compiled once by compile_string
+    and then evaluated against variables and functions mapping many times.
 
-    Args:
-        raw_string: raw string content to be parsed.
-        variables_mapping: variables mapping.
-        functions_mapping: functions mapping.
+    tokens is a list of (kind, payload):
+        (TOKEN_LITERAL, "abc")
+        (TOKEN_VARIABLE, VariablePath)
+        (TOKEN_FUNCTION, (func_name, args, kwargs)), args and kwargs are pre-parsed
+    """
+    __slots__ = ('raw_string', 'tokens', 'whole')
 
-    Returns:
-        str: parsed string content.
+    def __init__(self, raw_string: Text, tokens: List, whole: Any = None):
+        self.raw_string = raw_string
+        self.tokens = tokens
+        # the only token when raw_string is exactly a variable or a function, e.g. "$var" or "${func()}",
+        # its value is returned directly instead of being converted to str
+        self.whole = whole
+
+    def __repr__(self) -> str:
+        return f'<CompiledString of "{self.raw_string}">'
+
+    def is_constant(self) -> bool:
+        """raw string contains no variable or function"""
+        return self.whole is None and all(kind == TOKEN_LITERAL for kind, _ in self.tokens)
+
+    def evaluate(self, variables_mapping: VariablesMapping, functions_mapping: FunctionsMapping) -> Any:
+        if self.whole is not None:
+            return _evaluate_token(self.whole, variables_mapping, functions_mapping)
+
+        if len(self.tokens) == 1 and self.tokens[0][0] == TOKEN_LITERAL:
+            return self.tokens[0][1]
+
+        return "".join([
+            payload if kind == TOKEN_LITERAL else
+            str(_evaluate_token((kind, payload), variables_mapping, functions_mapping))
+            for kind, payload in self.tokens
+        ])
+
+
+def _compile_param(param: Any) -> Any:
+    if isinstance(param, str):
+        return compile_string(param.strip(" \t"))
+    return param
+
+
+def _evaluate_param(param: Any, variables_mapping: VariablesMapping, functions_mapping: FunctionsMapping) -> Any:
+    if isinstance(param, CompiledString):
+        return param.evaluate(variables_mapping, functions_mapping)
+    return parse_data(param, variables_mapping, functions_mapping)
+
+
+def _evaluate_token(token, variables_mapping: VariablesMapping, functions_mapping: FunctionsMapping) -> Any:
+    kind, payload = token
+    if kind == TOKEN_VARIABLE:
+        return payload.get(variables_mapping, functions_mapping)
+
+    if kind == TOKEN_FUNCTION:
+        func_name, args, kwargs = payload
+        func = get_mapping_function(func_name, functions_mapping)
+        parsed_args = [
+            _evaluate_param(arg, variables_mapping, functions_mapping) for arg in args
+        ]
+        parsed_kwargs = {
+            _evaluate_param(key, variables_mapping, functions_mapping):
+                _evaluate_param(value, variables_mapping, functions_mapping)
+            for key, value in kwargs
+        }
+        try:
+            return func(*parsed_args, **parsed_kwargs)
+        except Exception as ex:
+            logger.error(
+                f"call function error:\n"
+                f"func_name: {func_name}\n"
+                f"args: {parsed_args}\n"
+                f"kwargs: {parsed_kwargs}\n"
+                f"{type(ex).__name__}: {ex}"
+            )
+            raise
+
+    return payload
+
+
+@lru_cache(maxsize=COMPILED_STRING_CACHE_SIZE)
+def compile_string(raw_string: Text) -> CompiledString:
+    """compile string content to token program, compiled programs are cached by raw string.
 
     Examples:
-        >>> raw_string = "abc${add_one($num)}def"
-        >>> variables_mapping = {"num": 3}
-        >>> functions_mapping = {"add_one": lambda x: x + 1}
-        >>> parse_string(raw_string, variables_mapping, functions_mapping)
-            "abc4def"
+        >>> compile_string("abc$num").tokens
+        [(0, 'abc'), (1, <VariablePath of "num">)]
+
+        >>> compile_string("abc$num") is compile_string("abc$num")
+        True
 
     """
+    tokens = []
+
+    def append_literal(literal: Text):
+        if not literal:
+            return
+        if tokens and tokens[-1][0] == TOKEN_LITERAL:
+            tokens[-1] = (TOKEN_LITERAL, tokens[-1][1] + literal)
+        else:
+            tokens.append((TOKEN_LITERAL, literal))
+
     try:
         match_start_position = raw_string.index("$", 0)
-        parsed_string = raw_string[0:match_start_position]
+        append_literal(raw_string[0:match_start_position])
     except ValueError:
-        parsed_string = raw_string
-        return parsed_string
+        append_literal(raw_string)
+        return CompiledString(raw_string, tokens)
 
     while match_start_position < len(raw_string):
 
@@ -295,41 +514,27 @@ def parse_string(
         dollar_match = dolloar_regex_compile.match(raw_string, match_start_position)
         if dollar_match:
             match_start_position = dollar_match.end()
-            parsed_string += "$"
+            append_literal("$")
             continue
 
         # search function like ${func($a, $b)}
         func_match = function_regex_compile.match(raw_string, match_start_position)
         if func_match:
             func_name = func_match.group(1)
-            func = get_mapping_function(func_name, functions_mapping)
-
-            func_params_str = func_match.group(2)
-            function_meta = parse_function_params(func_params_str)
-            args = function_meta["args"]
-            kwargs = function_meta["kwargs"]
-            parsed_args = parse_data(args, variables_mapping, functions_mapping)
-            parsed_kwargs = parse_data(kwargs, variables_mapping, functions_mapping)
-
-            try:
-                func_eval_value = func(*parsed_args, **parsed_kwargs)
-            except Exception as ex:
-                logger.error(
-                    f"call function error:\n"
-                    f"func_name: {func_name}\n"
-                    f"args: {parsed_args}\n"
-                    f"kwargs: {parsed_kwargs}\n"
-                    f"{type(ex).__name__}: {ex}"
-                )
-                raise
+            function_meta = parse_function_params(func_match.group(2))
+            args = [_compile_param(arg) for arg in function_meta["args"]]
+            kwargs = [
+                (_compile_param(key), _compile_param(value))
+                for key, value in function_meta["kwargs"].items()
+            ]
+            token = (TOKEN_FUNCTION, (func_name, args, kwargs))
 
             # raw_string is a function, e.g. "${add_one(3)}", return its eval value directly
-            func_raw_str = "${" + func_name + f"({func_params_str})" + "}"
-            if func_raw_str == raw_string:
-                return func_eval_value
+            if func_match.group(0) == raw_string:
+                return CompiledString(raw_string, [token], token)
 
             # raw_string contains one or many functions, e.g. "abc${add_one(3)}def"
-            parsed_string += str(func_eval_value)
+            tokens.append(token)
             match_start_position = func_match.end()
             continue
 
@@ -337,14 +542,14 @@ def parse_string(
         var_match = variable_regex_compile.match(raw_string, match_start_position)
         if var_match:
             var_name = var_match.group(1) or var_match.group(2)
-            var_value = get_mapping_variable(var_name, variables_mapping, functions_mapping)
+            token = (TOKEN_VARIABLE, compile_variable_path(var_name))
 
             if f"${var_name}" == raw_string or "${" + var_name + "}" == raw_string:
                 # raw_string is a variable, $var or ${var}, return its value directly
-                return var_value
+                return CompiledString(raw_string, [token], token)
 
             # raw_string contains one or many variables, e.g. "abc${var}def"
-            parsed_string += str(var_value)
+            tokens.append(token)
             match_start_position = var_match.end()
             continue
 
@@ -358,18 +563,50 @@ def parse_string(
             # break while loop
             match_start_position = len(raw_string)
 
-        parsed_string += remain_string
+        append_literal(remain_string)
 
-    return parsed_string
+    return CompiledString(raw_string, tokens)
+
+
+def parse_string(
+        raw_string: Text,
+        variables_mapping: VariablesMapping,
+        functions_mapping: FunctionsMapping,
+) -> Any:
+    """parse string content with variables and functions mapping.
+
+    Args:
+        raw_string: raw string content to be parsed.
+        variables_mapping: variables mapping.
+        functions_mapping: functions mapping.
+
+    Returns:
+        str: parsed string content.
+
+    Examples:
+        >>> raw_string = "abc${add_one($num)}def"
+        >>> variables_mapping = {"num": 3}
+        >>> functions_mapping = {"add_one": lambda x: x + 1}
+        >>> parse_string(raw_string, variables_mapping, functions_mapping)
+            "abc4def"
+
+    """
+    if "$" not in raw_string:
+        return raw_string
+    return compile_string(raw_string).evaluate(variables_mapping, functions_mapping)
 
 
 def parse_data(raw_data: Any,
                variables_mapping: VariablesMapping = None,
                functions_mapping: FunctionsMapping = None,
+               ignore_keys: AbstractSet[Text] = None,
                ) -> Any:
     """parse raw data with evaluated variables mapping.
     Notice: variables_mapping should not contain any variable or function.
+    values of ignore_keys in dicts are left as it is, ignore_variables by default.
     """
+    if ignore_keys is None:
+        ignore_keys = ignore_variables
     if isinstance(raw_data, str):
         # content in string format may contains variables and functions
         variables_mapping = variables_mapping or {}
@@ -380,18 +617,17 @@ def parse_data(raw_data: Any,
 
     elif isinstance(raw_data, (list, set, tuple)):
         return [
-            parse_data(item, variables_mapping, functions_mapping) for item in raw_data
+            parse_data(item, variables_mapping, functions_mapping, ignore_keys) for item in raw_data
         ]
 
     elif isinstance(raw_data, dict):
-        ignore_variables = {'children'}
         parsed_data = {}
         for key, value in raw_data.items():
-            if key in ignore_variables:
+            if key in ignore_keys:
                 parsed_data[key] = value
                 continue
-            parsed_key = parse_data(key, variables_mapping, functions_mapping)
-            parsed_value = parse_data(value, variables_mapping, functions_mapping)
+            parsed_key = parse_data(key, variables_mapping, functions_mapping, ignore_keys)
+            parsed_value = parse_data(value, variables_mapping, functions_mapping, ignore_keys)
             parsed_data[parsed_key] = parsed_value
 
         return parsed_data
@@ -401,68 +637,209 @@ def parse_data(raw_data: Any,
         return raw_data
 
 
+# node kinds of compiled data
+DATA_CONSTANT = 0
+DATA_STRING = 1
+DATA_LIST = 2
+DATA_DICT = 3
+
+
+class CompiledData(object):
+    """compiled raw data, see compile_data.
+    strings are parsed once at compile time if they contain no variable or function,
+    only the dynamic strings are rendered every time the data is evaluated.
+    lists and dicts are rebuilt on every evaluation, so that the evaluated data can be modified safely,
+    e.g. stored in Context by PARAM_SET or passed to functions.
+    """
+    __slots__ = ('kind', 'value', 'constant')
+
+    def __init__(self, kind: int, value: Any, constant: bool = True):
+        self.kind = kind
+        # DATA_CONSTANT: parsed value, e.g. str, int, None
+        # DATA_STRING: CompiledString
+        # DATA_LIST: list of CompiledData
+        # DATA_DICT: list of (CompiledData of key, CompiledData of value)
+        self.value = value
+        # no variable or function in data
+        self.constant = constant
+
+    def is_constant(self) -> bool:
+        return self.constant
+
+    def evaluate(self, variables_mapping: VariablesMapping = None,
+                 functions_mapping: FunctionsMapping = None) -> Any:
+        """same as parse_data(raw_data, variables_mapping, functions_mapping)"""
+        if self.kind == DATA_CONSTANT:
+            return self.value
+
+        elif self.kind == DATA_STRING:
+            return self.value.evaluate(variables_mapping or {}, functions_mapping or {})
+
+        elif self.kind == DATA_LIST:
+            return [item.evaluate(variables_mapping, functions_mapping) for item in self.value]
+
+        return {
+            key.evaluate(variables_mapping, functions_mapping): value.evaluate(variables_mapping, functions_mapping)
+            for key, value in self.value
+        }
+
+
+def compile_data(raw_data: Any, ignore_keys: AbstractSet[Text] = None) -> CompiledData:
+    """compile raw data once, so that it can be evaluated many times with different variables.
+    values of ignore_keys in dicts are left as it is, ignore_variables by default.
+
+    Examples:
+        >>> compiled = compile_data({"url": "/api/$uid", "method": "GET", "headers": {"a": "b"}})
+        >>> compiled.evaluate({"uid": 1000})
+        {"url": "/api/1000", "method": "GET", "headers": {"a": "b"}}
+
+        >>> compile_data({"method": "GET", "headers": {"a": "b"}}).is_constant()
+        True
+
+    """
+    if ignore_keys is None:
+        ignore_keys = ignore_variables
+    if isinstance(raw_data, str):
+        # only strip whitespaces and tabs, the same as parse_data
+        raw_data = raw_data.strip(" \t")
+        if "$" not in raw_data:
+            return CompiledData(DATA_CONSTANT, raw_data)
+        compiled_string = compile_string(raw_data)
+        if compiled_string.is_constant():
+            # e.g. "abc$$", "$1"
+            return CompiledData(DATA_CONSTANT, compiled_string.evaluate({}, {}))
+        return CompiledData(DATA_STRING, compiled_string, False)
+
+    elif isinstance(raw_data, (list, set, tuple)):
+        items = [compile_data(item, ignore_keys) for item in raw_data]
+        return CompiledData(DATA_LIST, items, all(item.is_constant() for item in items))
+
+    elif isinstance(raw_data, dict):
+        items = []
+        for key, value in raw_data.items():
+            if key in ignore_keys:
+                # left as it is, the same as parse_data
+                items.append((CompiledData(DATA_CONSTANT, key), CompiledData(DATA_CONSTANT, value)))
+                continue
+            items.append((compile_data(key, ignore_keys), compile_data(value, ignore_keys)))
+        constant = all(key.is_constant() and value.is_constant() for key, value in items)
+        return CompiledData(DATA_DICT, items, constant)
+
+    else:
+        # other types, e.g. None, int, float, bool
+        return CompiledData(DATA_CONSTANT, raw_data)
+
+
 def is_variable_exists(variable_name: str, variables_mapping: VariablesMapping = {},
                        functions_mapping: FunctionsMapping = {}):
-    keys = variable_name.split('.')
-    if len(keys) > 1:
-        keys = parse_data(keys, variables_mapping, functions_mapping)
-    value = variables_mapping
-    try:
-        for key in keys:
-            if key.isnumeric():
-                key = int(key)
-            value = value[key]
-    except KeyError:
-        return False
-    return True
+    return compile_variable_path(variable_name).exists(variables_mapping, functions_mapping)
 
 
 def parse_variables_mapping(variables_mapping: VariablesMapping,
-                            functions_mapping: FunctionsMapping = None) -> VariablesMapping:
+                            functions_mapping: FunctionsMapping = None,
+                            global_variables: VariablesMapping = None) -> VariablesMapping:
     """
     >>> parse_variables_mapping({"varA": "$varB", "varB": "$varC", "varC": "123", "a": 1, "b": 2})
     {"varA": "123", "varB": "123", "varC": "123", "a": 1, "b": 2}
 
-    :param variables_mapping:
+    the reference graph of variables is built once and sorted topologically,
+    so that every variable is parsed exactly once after the variables it references.
+
+    :param variables_mapping: variables to be parsed
     :param functions_mapping:
-    :return:
+    :param global_variables: already parsed variables, e.g. variables in Context,
+        they can be referenced by variables_mapping but are not parsed again.
+    :return: parsed variables, in the same order as variables_mapping
     """
+    functions_mapping = functions_mapping or {}
+    global_variables = global_variables or {}
+
+    # reference graph: var_name => names in variables_mapping it references
+    references: Dict[Text, List[Text]] = {}
+    for var_name, var_value in variables_mapping.items():
+        # ordered, so that variables are always parsed in the same order
+        variables = extract_ordered_variables(var_value)
+
+        # check if reference variable itself
+        if var_name in variables and var_name not in global_variables:
+            # e.g.
+            # variables_mapping = {"token": "abc$token"}
+            # variables_mapping = {"key": ["$key", 2]}
+            # but if token is a global variable, "abc$token" references the global one
+            raise exceptions.VariablePointToSelf(var_name)
+
+        # check if reference variable not in variables_mapping
+        not_defined_variables = [
+            v_name for v_name in variables
+            if not is_variable_exists(v_name, variables_mapping) and not is_variable_exists(v_name, global_variables)
+        ]
+        if not_defined_variables:
+            # e.g. {"varA": "123$varB", "varB": "456$varC"}
+            # e.g. {"varC": "${sum_two($a, $b)}"}
+            raise exceptions.VariableNotFound(not_defined_variables)
+
+        references[var_name] = [
+            v_name for v_name in variables if v_name != var_name and v_name in variables_mapping
+        ]
+
     parsed_variables: VariablesMapping = {}
+    if global_variables:
+        lookup_variables = collections.ChainMap(parsed_variables, global_variables)
+    else:
+        lookup_variables = parsed_variables
 
-    while len(parsed_variables) != len(variables_mapping):
-        for var_name in variables_mapping:
-            if var_name in parsed_variables:
-                continue
+    for var_name in sort_variables_by_reference(references):
+        parsed_variables[var_name] = parse_data(
+            variables_mapping[var_name], lookup_variables, functions_mapping
+        )
 
-            var_value = variables_mapping[var_name]
-            variables = extract_variables(var_value)
+    return {var_name: parsed_variables[var_name] for var_name in variables_mapping}
 
-            # check if reference variable itself
-            if var_name in variables:
-                # e.g.
-                # variables_mapping = {"token": "abc$token"}
-                # variables_mapping = {"key": ["$key", 2]}
-                raise exceptions.VariablePointToSelf(var_name)
 
-            # check if reference variable not in variables_mapping
-            not_defined_variables = [
-                v_name for v_name in variables if not is_variable_exists(v_name, variables_mapping)
-            ]
-            if not_defined_variables:
-                # e.g. {"varA": "123$varB", "varB": "456$varC"}
-                # e.g. {"varC": "${sum_two($a, $b)}"}
-                raise exceptions.VariableNotFound(not_defined_variables)
-
-            try:
-                parsed_value = parse_data(
-                    var_value, parsed_variables, functions_mapping
-                )
-            except exceptions.VariableNotFound:
-                continue
+def sort_variables_by_reference(references: Dict[Text, List[Text]]) -> List[Text]:
+    """sort variables topologically, referenced variables come first.
+
+    Args:
+        references (dict): var_name => names of variables it references
+
+    Returns:
+        list: sorted variable names
+
+    Raises:
+        exceptions.VariableCircularReference: variables reference each other in a cycle.
+
+    Examples:
+        >>> sort_variables_by_reference({"varA": ["varB"], "varB": ["varC"], "varC": []})
+        ["varC", "varB", "varA"]
 
-            parsed_variables[var_name] = parsed_value
+    """
+    sorted_names = []
+    # var_name => True if visiting, False if visited
+    visiting: Dict[Text, bool] = {}
+    for root_name in references:
+        if root_name in visiting:
+            continue
 
-    return parsed_variables
+        # iterative dfs, stack of (var_name, iterator of its references)
+        visiting[root_name] = True
+        stack = [(root_name, iter(references[root_name]))]
+        while stack:
+            var_name, refs = stack[-1]
+            ref_name = next(refs, None)
+            if ref_name is None:
+                stack.pop()
+                visiting[var_name] = False
+                sorted_names.append(var_name)
+            elif ref_name not in visiting:
+                visiting[ref_name] = True
+                stack.append((ref_name, iter(references[ref_name])))
+            elif visiting[ref_name]:
+                # e.g. {"varA": "$varB", "varB": "$varA"}
+                cycle = [name for name, _ in stack]
+                cycle = cycle[cycle.index(ref_name):] + [ref_name]
+                raise exceptions.VariableCircularReference(" -> ".join(cycle))
+
+    return sorted_names
 
 
 def parse_parameters(parameters: Dict, functions_mapping: FunctionsMapping = None) -> List[Dict]:
@@ -476,7 +853,7 @@ def parse_parameters(parameters: Dict, functions_mapping: FunctionsMapping = Non
                 (3) call custom function in data_maker_core.core.builtin, "${gen_app_version()}"
         functions_mapping: [func_name, function]
     Returns:
-        list: cartesian product list
+        list: cartesian product list, use parse_parameters_lazily if the product may be large
 
     Examples:
         >>> parameters = {
@@ -486,13 +863,17 @@ def parse_parameters(parameters: Dict, functions_mapping: FunctionsMapping = Non
         }
         >>> parse_parameters(parameters)
 
+    """
+    return list(parse_parameters_lazily(parameters, functions_mapping))
+
+
+def parse_parameters_lazily(parameters: Dict, functions_mapping: FunctionsMapping = None) -> utils.CartesianProduct:
+    """same as parse_parameters, but the cartesian product is generated lazily, see utils.CartesianProduct.
+    parameter values are still parsed eagerly, only the combinations are not materialised.
     """
     parsed_parameters_list: List[List[Dict]] = []
 
-    # load builtin functions
-    builtin_functions_mapping = loader.load_builtin_functions()
-    functions_mapping = functions_mapping or {}
-    functions_mapping.update(**builtin_functions_mapping)
+    functions_mapping = build_functions_table(functions_mapping)
 
     for parameter_name, parameter_content in parameters.items():
         parameter_name_list = parameter_name.split("-")
@@ -505,6 +886,12 @@ def parse_parameters(parameters: Dict, functions_mapping: FunctionsMapping = Non
             #       => [{"username": "user1", "password": "111111"}, {"username": "user2", "password": "222222"}]
             parameter_content_list: List[Dict] = []
             for parameter_item in parameter_content:
+                if isinstance(parameter_item, Dict):
+                    # e.g. {"username-password": [{"username": "user1", "password": "111111"}]},
+                    # content of "${parameterize(account.csv)}" which is already parsed
+                    parameter_content_list.append({key: parameter_item[key] for key in parameter_name_list})
+                    continue
+
                 if not isinstance(parameter_item, (list, tuple)):
                     # "2.8.5" => ["2.8.5"]
                     parameter_item = [parameter_item]
@@ -570,4 +957,4 @@ def parse_parameters(parameters: Dict, functions_mapping: FunctionsMapping = Non
 
         parsed_parameters_list.append(parameter_content_list)
 
-    return utils.gen_cartesian_product(*parsed_parameters_list)
+    return utils.lazy_cartesian_product(*parsed_parameters_list)
@@ -1,12 +1,12 @@
 # -*- coding: utf-8 -*-
 
 import collections
+import collections.abc
 import copy
-import itertools
 import json
 import multiprocessing
 import os
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Sequence
 
 from d7.core import exceptions
 from d7.core.logger import logger
@@ -200,6 +200,78 @@ def is_support_multiprocessing() -> bool:
         return False
 
 
+class CartesianProduct(collections.abc.Sequence):
+    """lazy cartesian product of lists of dicts, each item is the merged dict of one combination.
+
+    items are generated on demand and never materialised:
+        len(product) is the count of combinations,
+        product[i] decodes index i as a mixed-radix number, the last list changes fastest (same as itertools.product),
+        product[start:stop:step] is a lazy product of the sliced index range, e.g. used for sharding.
+
+    Examples:
+        >>> product = CartesianProduct([{"a": 1}, {"a": 2}], [{"x": 111}, {"x": 121}, {"x": 131}])
+        >>> len(product)
+        6
+        >>> product[4]
+        {'a': 2, 'x': 121}
+        >>> list(product[4:])
+        [{'a': 2, 'x': 121}, {'a': 2, 'x': 131}]
+
+    """
+
+    def __init__(self, *args: List[Dict], indexes: range = None):
+        self.factors = args
+        if indexes is None:
+            # no lists, no combinations, the same as gen_cartesian_product()
+            total = 1 if args else 0
+            for factor in args:
+                total *= len(factor)
+            indexes = range(total)
+        self.indexes = indexes
+
+    def __len__(self) -> int:
+        return len(self.indexes)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return CartesianProduct(*self.factors, indexes=self.indexes[index])
+        return self._merge(self._decode(self.indexes[index]))
+
+    def __iter__(self):
+        if self.indexes.step != 1:
+            for index in self.indexes:
+                yield self._merge(self._decode(index))
+            return
+
+        if not self.indexes:
+            return
+
+        # decode start index once, then count up like an odometer
+        positions = self._decode(self.indexes.start)
+        for _ in range(len(self.indexes)):
+            yield self._merge(positions)
+            for i in range(len(positions) - 1, -1, -1):
+                positions[i] += 1
+                if positions[i] < len(self.factors[i]):
+                    break
+                positions[i] = 0
+
+    def __repr__(self) -> str:
+        return f"CartesianProduct(lengths={[len(factor) for factor in self.factors]}, indexes={self.indexes})"
+
+    def _decode(self, index: int) -> List[int]:
+        positions = [0] * len(self.factors)
+        for i in range(len(self.factors) - 1, -1, -1):
+            index, positions[i] = divmod(index, len(self.factors[i]))
+        return positions
+
+    def _merge(self, positions: List[int]) -> Dict:
+        product_item_dict = {}
+        for factor, position in zip(self.factors, positions):
+            product_item_dict.update(factor[position])
+        return product_item_dict
+
+
 def gen_cartesian_product(*args: List[Dict]) -> List[Dict]:
     """generate cartesian product for lists
 
@@ -207,7 +279,7 @@ def gen_cartesian_product(*args: List[Dict]) -> List[Dict]:
         args (list of list): lists to be generated with cartesian product
 
     Returns:
-        list: cartesian product in list
+        list: cartesian product in list, use lazy_cartesian_product if the product may be large
 
     Examples:
 
@@ -230,15 +302,16 @@ def gen_cartesian_product(*args: List[Dict]) -> List[Dict]:
     elif len(args) == 1:
         return args[0]
 
-    product_list = []
-    for product_item_tuple in itertools.product(*args):
-        product_item_dict = {}
-        for item in product_item_tuple:
-            product_item_dict.update(item)
+    return list(CartesianProduct(*args))
+
 
-        product_list.append(product_item_dict)
+def lazy_cartesian_product(*args: List[Dict]) -> CartesianProduct:
+    """same as gen_cartesian_product, but the product is generated lazily, see CartesianProduct.
 
-    return product_list
+    Notice: the result is a read-only sequence instead of list, e.g. it is not JSON serializable,
+    convert it by list(product) if needed.
+    """
+    return CartesianProduct(*args)
 
 
 if __name__ == '__main__':
@@ -12,11 +12,14 @@ from d7.steps.step_redis_delete import StepRedisDelete
 from d7.steps.step_redis_get import StepRedisGet
 from d7.steps.step_redis_set import StepRedisSet
 from d7.steps.step_script_load import StepScriptLoad
+from d7.steps.step_sql_batch_insert import StepSqlBatchInsert
+from d7.steps.step_sql_chunked import StepSqlChunkedUpdate, StepSqlChunkedDelete
 from d7.steps.step_sql_delete import StepSqlDelete
 from d7.steps.step_sql_insert import StepSqlInsert
+from d7.steps.step_sql_load import StepSqlLoad
 from d7.steps.step_sql_select import StepSqlSelect
 from d7.steps.step_sql_update import StepSqlUpdate
-from d7.steps.task import LoopConfig, Task, TaskType
+from d7.steps.task import LoopConfig, ParallelConfig, Task, TaskType, TransactionConfig
 
 
 def validate_step_config_of_json(json_config: str):
@@ -63,8 +66,16 @@ def validate_step_config(config: dict):
             step = StepSqlUpdate()
         elif cfg.type == StepTypeEnum.SQL_INSERT:
             step = StepSqlInsert()
+        elif cfg.type == StepTypeEnum.SQL_BATCH_INSERT:
+            step = StepSqlBatchInsert()
+        elif cfg.type == StepTypeEnum.SQL_LOAD:
+            step = StepSqlLoad()
         elif cfg.type == StepTypeEnum.SQL_DELETE:
             step = StepSqlDelete()
+        elif cfg.type == StepTypeEnum.SQL_CHUNKED_UPDATE:
+            step = StepSqlChunkedUpdate()
+        elif cfg.type == StepTypeEnum.SQL_CHUNKED_DELETE:
+            step = StepSqlChunkedDelete()
         elif cfg.type == StepTypeEnum.REDIS_GET:
             step = StepRedisGet()
         elif cfg.type == StepTypeEnum.REDIS_SET:
@@ -84,6 +95,24 @@ def validate_step_config(config: dict):
                         task_type=TaskType.LOOP,
                         ctx=Context()
                         )
+        elif cfg.type == StepTypeEnum.PARALLEL:
+            parallel_config = ParallelConfig(**cfg.config)
+            step = Task(name=cfg.name,
+                        logger=logger,
+                        log_file='',
+                        task_type=TaskType.PARALLEL,
+                        ctx=Context(),
+                        parallel_config=parallel_config
+                        )
+        elif cfg.type == StepTypeEnum.SQL_TRANSACTION:
+            transaction_config = TransactionConfig(**cfg.config)
+            step = Task(name=cfg.name,
+                        logger=logger,
+                        log_file='',
+                        task_type=TaskType.TRANSACTION,
+                        ctx=Context(),
+                        transaction_config=transaction_config
+                        )
         else:
             raise ParamsError(f"invalid step type: {cfg.type}")
         step.init(config=cfg, log_file='', logger=logger, ctx=Context())
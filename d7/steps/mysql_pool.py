@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict
+
+import pymysql
+from pydantic import BaseModel
+
+from d7.core.logger import logger
+
+POOL_MIN_SIZE = 0
+POOL_MAX_SIZE = 16
+POOL_IDLE_TIMEOUT = 300
+POOL_WAIT_TIMEOUT = 30
+
+
+class PoolStats(BaseModel):
+    checkouts: int = 0
+    waits: int = 0
+    total_wait_time: float = 0
+    max_wait_time: float = 0
+    created: int = 0
+    closed: int = 0
+    reconnects: int = 0
+    in_use: int = 0
+    idle: int = 0
+
+
+class MySQLPool(object):
+    """a thread-safe pool of pymysql connections.
+
+    Connections are pinged on checkout and replaced if the ping fails,
+    connections idle longer than idle_timeout are closed, but min_size connections are always kept.
+    """
+
+    def __init__(self, connect: Callable[[], pymysql.connections.Connection], min_size: int = POOL_MIN_SIZE,
+                 max_size: int = POOL_MAX_SIZE, idle_timeout: float = POOL_IDLE_TIMEOUT,
+                 wait_timeout: float = POOL_WAIT_TIMEOUT):
+        assert max_size > 0, 'max_size should > 0'
+        assert 0 <= min_size <= max_size, 'min_size should between 0 and max_size'
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self._cond = threading.Condition()
+        # (connection, time of release), the latest released is on the right
+        self._idle = deque()
+        self._size = 0
+        self._closed = False
+        self._stats = PoolStats()
+
+    def acquire(self) -> pymysql.connections.Connection:
+        start = time.monotonic()
+        waited = False
+        with self._cond:
+            while True:
+                self._close_expired()
+                if self._idle:
+                    connection, _ = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    # reserve the slot, the connection is created out of the lock
+                    self._size += 1
+                    connection = None
+                    break
+                remaining = self.wait_timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    raise TimeoutError(f'no mysql connection available in {self.wait_timeout}s, '
+                                       f'max_size of pool is {self.max_size}')
+                waited = True
+                self._cond.wait(remaining)
+            elapsed = time.monotonic() - start
+            self._stats.checkouts += 1
+            if waited:
+                self._stats.waits += 1
+            self._stats.total_wait_time += elapsed
+            self._stats.max_wait_time = max(self._stats.max_wait_time, elapsed)
+
+        try:
+            if connection is None:
+                return self._create()
+            return self._check(connection)
+        except BaseException:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, connection: pymysql.connections.Connection, discard: bool = False):
+        """give the connection back to pool, a discarded or broken connection is closed."""
+        if discard or self._closed or not connection.open:
+            self._close(connection)
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            return
+        with self._cond:
+            self._idle.append((connection, time.monotonic()))
+            self._cond.notify()
+
+    def close(self):
+        """close all idle connections, connections in use are closed when released."""
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+        for connection, _ in idle:
+            self._close(connection)
+
+    def stats(self) -> PoolStats:
+        with self._cond:
+            stats = self._stats.copy()
+            stats.idle = len(self._idle)
+            stats.in_use = self._size - stats.idle
+        return stats
+
+    def _close_expired(self):
+        # the oldest released is on the left
+        now = time.monotonic()
+        while self._idle and self._size > self.min_size and now - self._idle[0][1] > self.idle_timeout:
+            connection, _ = self._idle.popleft()
+            self._size -= 1
+            self._close(connection)
+
+    def _create(self) -> pymysql.connections.Connection:
+        connection = self.connect()
+        with self._cond:
+            self._stats.created += 1
+        return connection
+
+    def _check(self, connection: pymysql.connections.Connection) -> pymysql.connections.Connection:
+        try:
+            connection.ping(reconnect=False)
+            return connection
+        except Exception as e:
+            logger.info('mysql connection is broken, reconnect: %s', e)
+            self._close(connection)
+            with self._cond:
+                self._stats.reconnects += 1
+            return self._create()
+
+    def _close(self, connection: pymysql.connections.Connection):
+        try:
+            connection.close()
+        except Exception as e:
+            # already closed by server or by ping
+            logger.debug('close mysql connection error: %s', e)
+        with self._cond:
+            self._stats.closed += 1
+
+
+_pools: Dict[int, MySQLPool] = {}
+_pool_configs: Dict[int, object] = {}
+_pools_lock = threading.Lock()
+_pool_options = {}
+
+
+def set_mysql_pool_options(min_size: int = POOL_MIN_SIZE, max_size: int = POOL_MAX_SIZE,
+                           idle_timeout: float = POOL_IDLE_TIMEOUT, wait_timeout: float = POOL_WAIT_TIMEOUT):
+    """set options of the pools created later, should be called before any task runs."""
+    assert max_size > 0, 'max_size should > 0'
+    assert 0 <= min_size <= max_size, 'min_size should between 0 and max_size'
+    _pool_options.update(min_size=min_size, max_size=max_size, idle_timeout=idle_timeout, wait_timeout=wait_timeout)
+
+
+def get_mysql_pool(meta_id: int, config, connect: Callable[[], pymysql.connections.Connection]) -> MySQLPool:
+    """get the pool of meta_id, the pool is rebuilt if config of meta_id changed."""
+    with _pools_lock:
+        pool = _pools.get(meta_id)
+        if pool is not None and _pool_configs[meta_id] == config:
+            return pool
+        old_pool = pool
+        pool = MySQLPool(connect, **_pool_options)
+        _pools[meta_id] = pool
+        _pool_configs[meta_id] = config
+    if old_pool is not None:
+        old_pool.close()
+    return pool
+
+
+def get_mysql_pool_stats() -> Dict[int, PoolStats]:
+    with _pools_lock:
+        pools = dict(_pools)
+    return {meta_id: pool.stats() for meta_id, pool in pools.items()}
+
+
+def close_mysql_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+        _pool_configs.clear()
+    for pool in pools:
+        pool.close()
+
+
+def _reset_pools_in_child():
+    # sockets are shared with parent process, drop them without closing (closing would send QUIT to server)
+    global _pools_lock
+    _pools.clear()
+    _pool_configs.clear()
+    _pools_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_pools_in_child)
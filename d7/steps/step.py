@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
 import logging
 from enum import Enum
-from typing import Optional, Text, List
+from typing import Optional, Text, List, FrozenSet
 
 from pydantic import BaseModel, validator
 
@@ -17,13 +18,19 @@ class StepTypeEnum(Text, Enum):
     PARAM_SET = "PARAM_SET"
     SQL_UPDATE = "SQL_UPDATE"
     SQL_DELETE = "SQL_DELETE"
+    SQL_CHUNKED_UPDATE = "SQL_CHUNKED_UPDATE"
+    SQL_CHUNKED_DELETE = "SQL_CHUNKED_DELETE"
     SQL_INSERT = "SQL_INSERT"
+    SQL_BATCH_INSERT = "SQL_BATCH_INSERT"
+    SQL_LOAD = "SQL_LOAD"
     SQL_SELECT = "SQL_SELECT"
     REDIS_GET = "REDIS_GET"
     REDIS_SET = "REDIS_SET"
     REDIS_DELETE = "REDIS_DELETE"
     HTTP = "HTTP"
     LOOP = "LOOP"
+    PARALLEL = "PARALLEL"
+    SQL_TRANSACTION = "SQL_TRANSACTION"
     TASK = "TASK"
 
 
@@ -38,18 +45,89 @@ class TimeStat(BaseModel):
 INDENT = 4
 
 
+class StepStat(BaseModel):
+    """aggregated results of one step over all loops, used by aggregate summary mode."""
+    name: Text = ""
+    type: Text = "UNKNOWN"
+    count: int = 0
+    success_count: int = 0
+    fail_count: int = 0
+    min_elapsed: float = 0
+    max_elapsed: float = 0
+    total_elapsed: float = 0
+    # the first errors only
+    errors: List[Text] = []
+
+    @property
+    def avg_elapsed(self) -> float:
+        return self.total_elapsed / self.count if self.count else 0
+
+    def add(self, step_result: 'StepResult', max_errors: int):
+        elapsed = step_result.time_stat.end_at - step_result.time_stat.start_at
+        if self.count == 0:
+            self.name = step_result.name
+            # type may be StepTypeEnum
+            self.type = getattr(step_result.type, 'value', step_result.type)
+            self.min_elapsed = self.max_elapsed = elapsed
+        else:
+            self.min_elapsed = min(self.min_elapsed, elapsed)
+            self.max_elapsed = max(self.max_elapsed, elapsed)
+        self.count += 1
+        self.total_elapsed += elapsed
+        if step_result.success:
+            self.success_count += 1
+            return
+        self.fail_count += 1
+        if len(self.errors) < max_errors:
+            self.errors.append(step_result.config_error or step_result.execute_error or 'failed')
+
+    def merge(self, other: 'StepStat', max_errors: int):
+        """merge stats of the same step, e.g. collected in another process."""
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.name = other.name
+            self.type = other.type
+            self.min_elapsed = other.min_elapsed
+            self.max_elapsed = other.max_elapsed
+        else:
+            self.min_elapsed = min(self.min_elapsed, other.min_elapsed)
+            self.max_elapsed = max(self.max_elapsed, other.max_elapsed)
+        self.count += other.count
+        self.success_count += other.success_count
+        self.fail_count += other.fail_count
+        self.total_elapsed += other.total_elapsed
+        self.errors.extend(other.errors[:max(max_errors - len(self.errors), 0)])
+
+    def iter_lines(self, indent: int = 0):
+        indent_str = " " * indent
+        yield f'{indent_str}[~] [{self.type}][{self.name}], count={self.count}, success={self.success_count}, ' \
+              f'failed={self.fail_count}, elapsed(min/avg/max)=' \
+              f'{self.min_elapsed:.2f}/{self.avg_elapsed:.2f}/{self.max_elapsed:.2f}s'
+        for error in self.errors:
+            yield f'{indent_str}{" " * INDENT}error: {error}'
+
+    def __str__(self) -> str:
+        return '\n'.join(self.iter_lines())
+
+
 class StepResult(BaseModel):
     name: Text = ""
     indent: int = 0
     type: Text = "UNKNOWN"
     time_stat: TimeStat = TimeStat()
     children: List['StepResult'] = {}
+    # stats of children, only for loops in aggregate summary mode
+    stats: List[StepStat] = []
     success: bool = False
     config_error: Text = ""
     execute_error: Text = ""
 
-    def __str__(self) -> str:
-        ret = " " * self.indent
+    def iter_lines(self, indent: int = None):
+        """render result line by line, children are rendered lazily."""
+        if indent is None:
+            indent = self.indent
+        ret = " " * indent
         started = self.time_stat.start_at > 0
         if self.success:
             ret += "[√] "
@@ -64,13 +142,16 @@ class StepResult(BaseModel):
             ret += f', elapsed={self.time_stat.end_at - self.time_stat.start_at:.2f}s, start_time={self.time_stat.start_at_str}'
         if self.execute_error:
             ret = ret + ', execute_error=' + self.execute_error
-        if self.children:
-            ret += ', children:\n'
-            for child in self.children:
-                child.indent = self.indent + INDENT
-            ret += '\n'.join([str(i) for i in self.children])
+        if self.children or self.stats:
+            ret += ', children:'
+        yield ret
+        for stat in self.stats:
+            yield from stat.iter_lines(indent + INDENT)
+        for child in self.children:
+            yield from child.iter_lines(indent + INDENT)
 
-        return ret
+    def __str__(self) -> str:
+        return '\n'.join(self.iter_lines())
 
 
 StepResult.update_forward_refs()
@@ -98,6 +179,11 @@ class StepBase(object):
     ctx: Context
     step_result: StepResult
     parent: Optional['StepBase']
+    # step built from a constant config can be copied and reused in every loop, see task.StepPlan,
+    # subclass should set it False if run() hands values of config over to context
+    reusable: bool = True
+    # keys of config left unrendered by task, e.g. a template rendered by the step itself, see parser.ignore_variables
+    ignore_variables: FrozenSet[Text] = frozenset()
 
     def get_name(self) -> Text:
         return self.name
@@ -125,6 +211,11 @@ class StepBase(object):
         self.step_result.time_stat.start_at = unix_now()
         self.step_result.time_stat.start_at_str = str_now()
 
+    async def run_async(self) -> StepResult:
+        # subclass may override this method with async io, run in the default executor by default
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.run)
+
     def validate_config(self):
         # subclass should override this method
         pass
@@ -9,6 +9,8 @@ from d7.steps.step import StepBase, StepConfigBase, StepResult
 
 class StepParamSet(StepBase):
     config: Dict[Text, Any] = {}
+    # values are set to context, they should be rebuilt in every loop
+    reusable = False
 
     def init(self, config: StepConfigBase, logger: logging.Logger, log_file: str, ctx: Context):
         self.config = config.config
@@ -5,6 +5,7 @@ from typing import Text
 
 from pydantic import BaseModel, validator
 from redis import *
+from redis import asyncio as aioredis
 
 from d7.core.context import Context
 from d7.steps.step import StepBase, StepConfigBase, StepResult
@@ -36,6 +37,15 @@ class StepRedisDelete(StepBase):
         self.step_result.success = response == 1
         return self.step_result
 
+    async def run_async(self) -> StepResult:
+        super().run()
+        meta_config = get_metaconfig_redis(self.redis_delete_config.meta_id)
+        async with aioredis.Redis(host=meta_config.host, port=meta_config.port, db=meta_config.db,
+                                  password=meta_config.password) as r:
+            response = await r.delete(self.redis_delete_config.key)
+        self.step_result.success = response == 1
+        return self.step_result
+
     def validate_config(self):
         pass
 
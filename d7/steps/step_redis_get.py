@@ -5,6 +5,7 @@ from typing import Text, Optional
 
 from pydantic import BaseModel, validator
 from redis import *
+from redis import asyncio as aioredis
 
 from d7.core.context import Context
 from d7.core.model_validators import not_empty
@@ -34,6 +35,17 @@ class StepRedisGet(StepBase):
         meta_config = get_metaconfig_redis(self.redis_get_config.meta_id)
         r = Redis(host=meta_config.host, port=meta_config.port, db=meta_config.db, password=meta_config.password)
         result = r.get(self.redis_get_config.key)
+        return self._get_step_result(result)
+
+    async def run_async(self) -> StepResult:
+        super().run()
+        meta_config = get_metaconfig_redis(self.redis_get_config.meta_id)
+        async with aioredis.Redis(host=meta_config.host, port=meta_config.port, db=meta_config.db,
+                                  password=meta_config.password) as r:
+            result = await r.get(self.redis_get_config.key)
+        return self._get_step_result(result)
+
+    def _get_step_result(self, result) -> StepResult:
         self.logger.info(f'get from redis: key={self.redis_get_config.key}, result={result}')
         if self.redis_get_config.extract_result_to:
             self.ctx.set_variable(self.redis_get_config.extract_result_to, result)
@@ -5,6 +5,7 @@ from typing import Text
 
 from pydantic import BaseModel, validator
 from redis import *
+from redis import asyncio as aioredis
 
 from d7.core.context import Context
 from d7.core.model_validators import not_empty
@@ -37,6 +38,18 @@ class StepRedisSet(StepBase):
         r = Redis(host=meta_config.host, port=meta_config.port, db=meta_config.db, password=meta_config.password)
         response = r.set(name=self.redis_delete_config.key, value=self.redis_delete_config.value,
                          ex=self.redis_delete_config.expire_seconds)
+        return self._get_step_result(response)
+
+    async def run_async(self) -> StepResult:
+        super().run()
+        meta_config = get_metaconfig_redis(self.redis_delete_config.meta_id)
+        async with aioredis.Redis(host=meta_config.host, port=meta_config.port, db=meta_config.db,
+                                  password=meta_config.password) as r:
+            response = await r.set(name=self.redis_delete_config.key, value=self.redis_delete_config.value,
+                                   ex=self.redis_delete_config.expire_seconds)
+        return self._get_step_result(response)
+
+    def _get_step_result(self, response) -> StepResult:
         self.logger.info(
             f'set to redis: key={self.redis_delete_config.key}, value={self.redis_delete_config.value}, response={response}')
         self.step_result.success = response
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+import logging
+from enum import Enum
+from typing import Text, Any, Dict, Optional, List, Iterator, Tuple
+
+from pydantic import BaseModel, validator, root_validator
+
+from d7.core.context import Context
+from d7.core.model_validators import not_empty, gte
+from d7.core.parser import compile_data, CompiledData
+from d7.steps.step import StepBase, StepConfigBase, StepResult
+from d7.steps.util import escape_sql_value, get_metaconfig_db, get_mysql_cursor
+
+# variable of row index when rendering row_template
+ROW_INDEX_VARIABLE = 'row_index'
+# length of ",", "(" and ")"
+_ROW_OVERHEAD = 3
+
+
+class CommitMode(Text, Enum):
+    # commit after every INSERT statement
+    CHUNK = 'chunk'
+    # commit once after all INSERT statements
+    BATCH = 'batch'
+
+
+class SqlBatchInsertConfig(BaseModel):
+    meta_id: int
+    table: Text
+    # rows to be inserted, or rows rendered from row_template for count times, $row_index is the index of row
+    rows: Optional[List[Dict[Text, Any]]]
+    row_template: Optional[Dict[Text, Any]]
+    count: Optional[int]
+    # max rows of one INSERT statement
+    chunk_size: int = 1000
+    # max bytes of one INSERT statement, should not exceed max_allowed_packet of server
+    max_allowed_packet: int = 4 * 1024 * 1024
+    commit: CommitMode = CommitMode.CHUNK
+    # columns updated by ON DUPLICATE KEY UPDATE col=VALUES(col)
+    on_duplicate_update: Optional[List[Text]]
+    extract_result_to: Optional[Text]
+
+    # validators
+    _meta_id = validator('meta_id', allow_reuse=True)(not_empty)
+    _table = validator('table', allow_reuse=True)(not_empty)
+    _rows = validator('rows', allow_reuse=True)(not_empty)
+    _row_template = validator('row_template', allow_reuse=True)(not_empty)
+    _count = validator('count', allow_reuse=True)(gte(1))
+    _chunk_size = validator('chunk_size', allow_reuse=True)(gte(1))
+    _max_allowed_packet = validator('max_allowed_packet', allow_reuse=True)(gte(1024))
+    _on_duplicate_update = validator('on_duplicate_update', allow_reuse=True)(not_empty)
+
+    @root_validator(skip_on_failure=True)
+    def check_rows_source(cls, values):
+        has_rows = values.get('rows') is not None
+        has_row_template = values.get('row_template') is not None
+        assert has_rows or has_row_template, 'rows or row_template should not be empty'
+        assert not (has_rows and has_row_template), 'only one of rows and row_template can be set'
+        if has_row_template:
+            assert values.get('count') is not None, 'count should not be empty when row_template is set'
+        return values
+
+
+class BatchInsertResult(BaseModel):
+    # affected rows, a row updated by ON DUPLICATE KEY UPDATE is counted twice
+    rowcount: int = 0
+    # auto increment id of the first and last inserted row,
+    # ids of one INSERT statement are consecutive, see id_ranges for ids of every statement
+    first_id: Optional[int]
+    last_id: Optional[int]
+    # [first_id, last_id] of every INSERT statement, empty when on_duplicate_update is set
+    id_ranges: List[Tuple[int, int]] = []
+
+
+class StepSqlBatchInsert(StepBase):
+    sql_batch_insert_config: SqlBatchInsertConfig
+    columns: List[Text]
+    compiled_row_template: Optional[CompiledData]
+    # rendered for every row
+    ignore_variables = frozenset({'row_template'})
+
+    def init(self, config: StepConfigBase, logger: logging.Logger, log_file: str, ctx: Context):
+        self.sql_batch_insert_config = SqlBatchInsertConfig(**config.config)
+        if self.sql_batch_insert_config.rows is not None:
+            self.columns = list(self.sql_batch_insert_config.rows[0])
+            self.compiled_row_template = None
+        else:
+            self.columns = list(self.sql_batch_insert_config.row_template)
+            self.compiled_row_template = compile_data(self.sql_batch_insert_config.row_template)
+        super().init(config, logger, log_file, ctx)
+
+    def _iter_rows(self) -> Iterator[Dict[Text, Any]]:
+        if self.compiled_row_template is None:
+            yield from self.sql_batch_insert_config.rows
+            return
+        # row_index is kept in a child context
+        ctx = self.ctx.fork()
+        for i in range(self.sql_batch_insert_config.count):
+            ctx.set_variable(ROW_INDEX_VARIABLE, i)
+            yield ctx.evaluate(self.compiled_row_template)
+
+    def _get_sql_parts(self) -> Tuple[Text, Text]:
+        head = f'INSERT INTO {self.sql_batch_insert_config.table} ({",".join(self.columns)}) VALUES '
+        tail = ''
+        if self.sql_batch_insert_config.on_duplicate_update:
+            tail = ' ON DUPLICATE KEY UPDATE ' + ','.join(
+                f'{column}=VALUES({column})' for column in self.sql_batch_insert_config.on_duplicate_update)
+        return head, tail
+
+    def iter_statements(self, charset: Text) -> Iterator[Tuple[Text, int]]:
+        """render INSERT statements chunked by chunk_size and max_allowed_packet, yield sql and count of rows."""
+        config = self.sql_batch_insert_config
+        head, tail = self._get_sql_parts()
+        base_size = len(head.encode()) + len(tail.encode())
+        columns = set(self.columns)
+        values = []
+        size = base_size
+        for i, row in enumerate(self._iter_rows()):
+            if row.keys() != columns:
+                raise Exception(f'columns of row {i} should be {self.columns}, but got {list(row)}')
+            value = ','.join(escape_sql_value(row[column], charset) for column in self.columns)
+            value_size = len(value.encode()) + _ROW_OVERHEAD
+            if base_size + value_size > config.max_allowed_packet:
+                raise Exception(f'row {i} is too large for max_allowed_packet={config.max_allowed_packet}')
+            if values and (len(values) >= config.chunk_size or size + value_size > config.max_allowed_packet):
+                yield head + ','.join(values) + tail, len(values)
+                values = []
+                size = base_size
+            values.append(f'({value})')
+            size += value_size
+        if values:
+            yield head + ','.join(values) + tail, len(values)
+
+    def run(self) -> StepResult:
+        super().run()
+        config = self.sql_batch_insert_config
+        statements = self.iter_statements(get_metaconfig_db(config.meta_id).charset)
+        result = BatchInsertResult()
+        if config.commit == CommitMode.BATCH:
+            with get_mysql_cursor(config.meta_id) as cursor:
+                for sql, count in statements:
+                    self._execute(cursor, sql, count, result)
+        else:
+            for sql, count in statements:
+                with get_mysql_cursor(config.meta_id) as cursor:
+                    self._execute(cursor, sql, count, result)
+        self.logger.debug('batch insert result: %s', result)
+        if config.extract_result_to:
+            self.ctx.set_variable(config.extract_result_to, result.dict())
+        self.step_result.success = True
+        return self.step_result
+
+    def _execute(self, cursor, sql: Text, count: int, result: BatchInsertResult):
+        cursor.execute(sql)
+        self.logger.debug('cursor.rowcount=%s, cursor.lastrowid=%s, rows=%s', cursor.rowcount, cursor.lastrowid,
+                          count)
+        result.rowcount += cursor.rowcount
+        if self.sql_batch_insert_config.on_duplicate_update or not cursor.lastrowid:
+            return
+        # lastrowid of a multi-row INSERT is the id of its first row
+        first_id, last_id = cursor.lastrowid, cursor.lastrowid + count - 1
+        result.id_ranges.append((first_id, last_id))
+        if result.first_id is None:
+            result.first_id = first_id
+        result.last_id = last_id
+
+    def validate_config(self):
+        config = self.sql_batch_insert_config
+        assert self.columns, 'columns should not be empty'
+        if config.on_duplicate_update:
+            unknown = set(config.on_duplicate_update).difference(self.columns)
+            assert not unknown, f'columns of on_duplicate_update should be in columns of rows: {sorted(unknown)}'
+
+    def validate_result(self):
+        pass
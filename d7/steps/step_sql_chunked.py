@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+from typing import Text, Any, Dict, Optional, List
+
+from pydantic import BaseModel, validator
+
+from d7.core.context import Context
+from d7.core.model_validators import not_empty, gte
+from d7.steps.step import StepBase, StepConfigBase, StepResult
+from d7.steps.util import normalize_where, format_sql_raw, get_mysql_cursor, escape_sql_value, get_metaconfig_db
+
+
+class SqlChunkedConfigBase(BaseModel):
+    meta_id: int
+    table: Text
+    where: Text
+    where_args: Dict[Text, Any]
+    # rows are walked in order of key_column, it should be the primary key or a unique index
+    key_column: Text = 'id'
+    # max rows of every chunk, every chunk is committed on its own
+    chunk_size: int = 1000
+    # seconds to sleep between chunks, e.g. to let replicas catch up
+    pause: float = 0
+    extract_result_to: Optional[Text]
+
+    # validators
+    _meta_id = validator('meta_id', allow_reuse=True)(not_empty)
+    _table = validator('table', allow_reuse=True)(not_empty)
+    _where = validator('where', allow_reuse=True)(not_empty)
+    _key_column = validator('key_column', allow_reuse=True)(not_empty)
+    _chunk_size = validator('chunk_size', allow_reuse=True)(gte(1))
+    _pause = validator('pause', allow_reuse=True)(gte(0))
+
+
+class SqlChunkedUpdateConfig(SqlChunkedConfigBase):
+    update_fields: Dict[Text, Any]
+
+    # validators
+    _update_fields = validator('update_fields', allow_reuse=True)(not_empty)
+
+
+class SqlChunkedDeleteConfig(SqlChunkedConfigBase):
+    pass
+
+
+class ChunkedResult(BaseModel):
+    # affected rows of all chunks
+    rowcount: int = 0
+    chunks: int = 0
+    # seconds of all chunks, pauses excluded
+    elapsed: float = 0
+    # affected rows per second
+    throughput: float = 0
+    # key of the last row walked
+    last_key: Any
+
+
+class StepSqlChunkedBase(StepBase):
+    """update or delete rows matching where chunk by chunk, with keyset pagination on key_column.
+
+    every chunk selects the next chunk_size keys after the last key, e.g.
+    "SELECT id FROM t WHERE (where) AND id > 100 ORDER BY id LIMIT 1000",
+    then updates or deletes rows of the key range "WHERE (where) AND id BETWEEN 101 AND 1100" and commits.
+    so every statement locks one chunk of rows only, whatever the total rows are.
+    in SQL_TRANSACTION chunks are committed by the transaction instead.
+    """
+    chunked_config: SqlChunkedConfigBase
+    # statement of every chunk, formatted with table, assignments and where of the chunk
+    chunk_sql_template: Text
+    # where rendered with where_args
+    where: Text
+    # SET clause rendered with update_fields, empty for delete
+    assignments: Text = ''
+
+    def init(self, config: StepConfigBase, logger: logging.Logger, log_file: str, ctx: Context):
+        self.chunked_config.where = normalize_where(self.chunked_config.where)
+        self.where = format_sql_raw(self.chunked_config.meta_id, self.chunked_config.where,
+                                    self.chunked_config.where_args)
+        logger.debug('%s', self.where)
+        super().init(config, logger, log_file, ctx)
+
+    def _get_keys_sql(self, last_key: Any, charset: Text) -> Text:
+        config = self.chunked_config
+        sql = f'SELECT {config.key_column} FROM {config.table} WHERE ({self.where})'
+        if last_key is not None:
+            sql += f' AND {config.key_column} > {escape_sql_value(last_key, charset)}'
+        return sql + f' ORDER BY {config.key_column} LIMIT {config.chunk_size}'
+
+    def _get_range_where(self, first_key: Any, last_key: Any, charset: Text) -> Text:
+        # where is checked again, rows of the range not matching it are kept
+        return f'({self.where}) AND {self.chunked_config.key_column} ' \
+               f'BETWEEN {escape_sql_value(first_key, charset)} AND {escape_sql_value(last_key, charset)}'
+
+    def _get_chunk_sql(self, range_where: Text) -> Text:
+        return self.chunk_sql_template.format(table=self.chunked_config.table, assignments=self.assignments,
+                                              where=range_where)
+
+    def run(self) -> StepResult:
+        super().run()
+        config = self.chunked_config
+        charset = get_metaconfig_db(config.meta_id).charset
+        result = ChunkedResult()
+        while True:
+            start = time.monotonic()
+            with get_mysql_cursor(config.meta_id) as cursor:
+                cursor.execute(self._get_keys_sql(result.last_key, charset))
+                keys: List[Any] = [row[config.key_column] for row in cursor.fetchall()]
+                if not keys:
+                    break
+                cursor.execute(self._get_chunk_sql(self._get_range_where(keys[0], keys[-1], charset)))
+                self.logger.debug('chunk %d: keys [%s, %s], cursor.rowcount=%s', result.chunks, keys[0], keys[-1],
+                                  cursor.rowcount)
+                result.rowcount += cursor.rowcount
+            result.chunks += 1
+            result.elapsed += time.monotonic() - start
+            result.last_key = keys[-1]
+            if len(keys) < config.chunk_size:
+                break
+            if config.pause:
+                time.sleep(config.pause)
+        if result.elapsed:
+            result.throughput = result.rowcount / result.elapsed
+        self.logger.info('%s rows in %d chunks, %.3fs, %.1f rows/s', result.rowcount, result.chunks,
+                         result.elapsed, result.throughput)
+        if config.extract_result_to:
+            self.ctx.set_variable(config.extract_result_to, result.dict())
+        self.step_result.success = True
+        return self.step_result
+
+    def validate_config(self):
+        pass
+
+    def validate_result(self):
+        pass
+
+
+class StepSqlChunkedUpdate(StepSqlChunkedBase):
+    chunked_config: SqlChunkedUpdateConfig
+    chunk_sql_template = 'UPDATE {table} SET {assignments} WHERE {where}'
+
+    def init(self, config: StepConfigBase, logger: logging.Logger, log_file: str, ctx: Context):
+        self.chunked_config = SqlChunkedUpdateConfig(**config.config)
+        args = {}
+        assignments = []
+        for field, value in self.chunked_config.update_fields.items():
+            field_name = f'##{field}'
+            args[field_name] = value
+            assignments.append(f'{field}=%({field_name})s')
+        self.assignments = format_sql_raw(self.chunked_config.meta_id, ','.join(assignments), args)
+        super().init(config, logger, log_file, ctx)
+
+
+class StepSqlChunkedDelete(StepSqlChunkedBase):
+    chunked_config: SqlChunkedDeleteConfig
+    chunk_sql_template = 'DELETE FROM {table} WHERE {where}'
+
+    def init(self, config: StepConfigBase, logger: logging.Logger, log_file: str, ctx: Context):
+        self.chunked_config = SqlChunkedDeleteConfig(**config.config)
+        super().init(config, logger, log_file, ctx)
@@ -26,6 +26,9 @@ class SqlInsertConfig(BaseModel):
 class StepSqlInsert(StepBase):
     sql_insert_config: SqlInsertConfig
     sql: str
+    # "INSERT INTO table (fields) VALUES " and "(values)" of sql, rows of a loop may be coalesced by them
+    sql_head: str
+    sql_values: str
 
     def init(self, config: StepConfigBase, logger: logging.Logger, log_file: str, ctx: Context):
         self.sql_insert_config = SqlInsertConfig(**config.config)
@@ -39,15 +42,16 @@ class StepSqlInsert(StepBase):
         for field in self.sql_insert_config.insert_fields:
             sql += f'{field},'
         sql = sql.rstrip(',')
-        sql += ') VALUES ('
+        self.sql_head = sql + ') VALUES '
+        sql = '('
         for field in self.sql_insert_config.insert_fields:
             field_name = f'##{field}'
             args[field_name] = self.sql_insert_config.insert_fields[field]
             sql += f'%({field_name})s,'
         sql = sql.rstrip(',')
         sql += ')'
-        formatted_sql = format_sql_raw(self.sql_insert_config.meta_id, sql, args)
-        return formatted_sql
+        self.sql_values = format_sql_raw(self.sql_insert_config.meta_id, sql, args)
+        return self.sql_head + self.sql_values
 
     def run(self) -> StepResult:
         super().run()
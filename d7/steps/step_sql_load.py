@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import logging
+import os
+import tempfile
+import time
+from enum import Enum
+from typing import Text, Any, Dict, Optional, List, Iterator, Tuple
+
+from pydantic import BaseModel, validator, root_validator
+from pymysql.charset import charset_by_name
+
+from d7.core.context import Context
+from d7.core.model_validators import not_empty, gte
+from d7.core.parser import compile_data, CompiledData
+from d7.steps.step import StepBase, StepConfigBase, StepResult
+from d7.steps.step_sql_batch_insert import ROW_INDEX_VARIABLE
+from d7.steps.util import escape_sql_value, get_metaconfig_db, get_mysql_cursor
+
+# escaping of the default FIELDS and LINES options of LOAD DATA
+_TSV_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r', '\0': '\\0'})
+_TSV_NULL = '\\N'
+
+
+class DuplicateMode(Text, Enum):
+    # rows with duplicate keys are errors
+    ERROR = 'error'
+    # rows with duplicate keys replace the existing rows
+    REPLACE = 'replace'
+    # rows with duplicate keys are skipped
+    IGNORE = 'ignore'
+
+
+class SqlLoadConfig(BaseModel):
+    meta_id: int
+    table: Text
+    # rows to be loaded, rows rendered from row_template for count times ($row_index is the index of row),
+    # or rows of a csv file with header
+    rows: Optional[List[Dict[Text, Any]]]
+    row_template: Optional[Dict[Text, Any]]
+    count: Optional[int]
+    file: Optional[Text]
+    # rows are written to spool files in spool_dir, the system temp dir if not set
+    spool_dir: Optional[Text]
+    # max bytes of one spool file, rows are loaded file by file and every file is removed after loaded
+    max_spool_size: int = 256 * 1024 * 1024
+    on_duplicate: DuplicateMode = DuplicateMode.ERROR
+    extract_result_to: Optional[Text]
+
+    # validators
+    _meta_id = validator('meta_id', allow_reuse=True)(not_empty)
+    _table = validator('table', allow_reuse=True)(not_empty)
+    _rows = validator('rows', allow_reuse=True)(not_empty)
+    _row_template = validator('row_template', allow_reuse=True)(not_empty)
+    _count = validator('count', allow_reuse=True)(gte(1))
+    _file = validator('file', allow_reuse=True)(not_empty)
+    _max_spool_size = validator('max_spool_size', allow_reuse=True)(gte(1024))
+
+    @root_validator(skip_on_failure=True)
+    def check_rows_source(cls, values):
+        sources = [key for key in ('rows', 'row_template', 'file') if values.get(key) is not None]
+        assert sources, 'rows, row_template or file should not be empty'
+        assert len(sources) == 1, 'only one of rows, row_template and file can be set'
+        if sources[0] == 'row_template':
+            assert values.get('count') is not None, 'count should not be empty when row_template is set'
+        return values
+
+
+class LoadResult(BaseModel):
+    # affected rows, a replaced row is counted twice
+    rowcount: int = 0
+    # rows written to spool files
+    rows: int = 0
+    files: int = 0
+    # bytes of all spool files
+    bytes: int = 0
+    # seconds of all loads and spooling
+    elapsed: float = 0
+    # rows per second
+    throughput: float = 0
+
+
+class StepSqlLoad(StepBase):
+    """load rows by LOAD DATA LOCAL INFILE, much faster than INSERT for millions of rows.
+
+    rows are written to tab separated spool files, a new file is started when max_spool_size is reached,
+    every file is loaded and committed on its own, and removed even if loading failed.
+    local_infile of the meta config should be enabled.
+    """
+    sql_load_config: SqlLoadConfig
+    columns: List[Text]
+    compiled_row_template: Optional[CompiledData]
+    # rendered for every row
+    ignore_variables = frozenset({'row_template'})
+
+    def init(self, config: StepConfigBase, logger: logging.Logger, log_file: str, ctx: Context):
+        self.sql_load_config = SqlLoadConfig(**config.config)
+        self.compiled_row_template = None
+        if self.sql_load_config.rows is not None:
+            self.columns = list(self.sql_load_config.rows[0])
+        elif self.sql_load_config.row_template is not None:
+            self.columns = list(self.sql_load_config.row_template)
+            self.compiled_row_template = compile_data(self.sql_load_config.row_template)
+        else:
+            self.columns = self._read_file_columns()
+        super().init(config, logger, log_file, ctx)
+
+    def _read_file_columns(self) -> List[Text]:
+        if not os.path.isfile(self.sql_load_config.file):
+            raise Exception(f'file not found: {self.sql_load_config.file}')
+        with open(self.sql_load_config.file, encoding='utf-8', newline='') as f:
+            return next(csv.reader(f), [])
+
+    def _iter_rows(self) -> Iterator[Dict[Text, Any]]:
+        config = self.sql_load_config
+        if config.rows is not None:
+            yield from config.rows
+        elif self.compiled_row_template is not None:
+            # row_index is kept in a child context
+            ctx = self.ctx.fork()
+            for i in range(config.count):
+                ctx.set_variable(ROW_INDEX_VARIABLE, i)
+                yield ctx.evaluate(self.compiled_row_template)
+        else:
+            with open(config.file, encoding='utf-8', newline='') as f:
+                yield from csv.DictReader(f)
+
+    @staticmethod
+    def format_value(value: Any) -> Text:
+        if value is None:
+            return _TSV_NULL
+        if isinstance(value, bool):
+            return '1' if value else '0'
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        return str(value).translate(_TSV_ESCAPES)
+
+    def iter_spool_files(self, encoding: Text) -> Iterator[Tuple[Text, int, int]]:
+        """write rows to spool files of at most max_spool_size bytes, yield path, count of rows and bytes.
+
+        a file is removed when the next one is requested or the iteration is closed.
+        """
+        config = self.sql_load_config
+        lines = self._iter_lines(encoding)
+        # the first line of the next file
+        pending = next(lines, None)
+        while pending is not None:
+            fd, path = tempfile.mkstemp(prefix='d7_load_', suffix='.tsv', dir=config.spool_dir)
+            try:
+                count = size = 0
+                with os.fdopen(fd, 'wb') as f:
+                    while pending is not None and size + len(pending) <= config.max_spool_size:
+                        f.write(pending)
+                        count += 1
+                        size += len(pending)
+                        pending = next(lines, None)
+                yield path, count, size
+            finally:
+                os.remove(path)
+
+    def _iter_lines(self, encoding: Text) -> Iterator[bytes]:
+        config = self.sql_load_config
+        columns = set(self.columns)
+        for i, row in enumerate(self._iter_rows()):
+            if row.keys() != columns:
+                raise Exception(f'columns of row {i} should be {self.columns}, but got {list(row)}')
+            line = ('\t'.join(self.format_value(row[column]) for column in self.columns) + '\n').encode(encoding)
+            if len(line) > config.max_spool_size:
+                raise Exception(f'row {i} is too large for max_spool_size={config.max_spool_size}')
+            yield line
+
+    def _get_sql(self, path: Text, charset: Text) -> Text:
+        duplicate = ''
+        if self.sql_load_config.on_duplicate != DuplicateMode.ERROR:
+            duplicate = f' {self.sql_load_config.on_duplicate.value.upper()}'
+        return f"LOAD DATA LOCAL INFILE {escape_sql_value(path, charset)}{duplicate} " \
+               f"INTO TABLE {self.sql_load_config.table} CHARACTER SET {charset} " \
+               f"FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' " \
+               f"({','.join(self.columns)})"
+
+    def run(self) -> StepResult:
+        super().run()
+        config = self.sql_load_config
+        meta_config = get_metaconfig_db(config.meta_id)
+        if not meta_config.local_infile:
+            raise Exception(f'local_infile of meta config {config.meta_id} should be enabled for SQL_LOAD')
+        result = LoadResult()
+        start = time.monotonic()
+        for path, count, size in self.iter_spool_files(charset_by_name(meta_config.charset).encoding):
+            with get_mysql_cursor(config.meta_id) as cursor:
+                cursor.execute(self._get_sql(path, meta_config.charset))
+                self.logger.debug('loaded %s: rows=%s, bytes=%s, cursor.rowcount=%s', path, count, size,
+                                  cursor.rowcount)
+                result.rowcount += cursor.rowcount
+            result.rows += count
+            result.files += 1
+            result.bytes += size
+        result.elapsed = time.monotonic() - start
+        if result.elapsed:
+            result.throughput = result.rows / result.elapsed
+        self.logger.info('%s rows loaded from %d files, %.3fs, %.1f rows/s', result.rows, result.files,
+                         result.elapsed, result.throughput)
+        if config.extract_result_to:
+            self.ctx.set_variable(config.extract_result_to, result.dict())
+        self.step_result.success = True
+        return self.step_result
+
+    def validate_config(self):
+        assert self.columns, 'columns should not be empty'
+
+    def validate_result(self):
+        pass
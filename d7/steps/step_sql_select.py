@@ -1,31 +1,225 @@
 # -*- coding: utf-8 -*-
 
+import contextlib
 import logging
-from typing import Text, Any, Dict, Optional
+import threading
+import weakref
+from enum import Enum
+from typing import Text, Any, Dict, Optional, Iterator, List
 
-from pydantic import BaseModel, validator
+from pydantic import BaseModel, validator, root_validator
 
 from d7.core.context import Context
-from d7.core.model_validators import not_empty, validator_chain, gte, lte
+from d7.core.model_validators import not_empty, gte
 from d7.steps.step import StepBase, StepConfigBase, StepResult
 from d7.steps.util import normalize_where, format_sql_raw, \
-    get_mysql_cursor
+    get_mysql_cursor, iter_mysql_rows, escape_sql_value, get_metaconfig_db
+
+# max rows of a select which is not in stream mode
+MAX_SELECT_LIMIT = 2000
+
+
+class ResultShape(Text, Enum):
+    # a row if limit is 1, otherwise a list of rows
+    ROWS = 'rows'
+    # value of the only column of the first row
+    SCALAR = 'scalar'
+    # list of values of the only column
+    COLUMN = 'column'
+    # dict of rows keyed by key_column
+    DICT = 'dict'
 
 
 class SqlSelectConfig(BaseModel):
     meta_id: int
     table: Text
-    where: Text
-    where_args: Dict[Text, Any]
+    # may be empty in lookup mode
+    where: Text = ''
+    where_args: Dict[Text, Any] = {}
+    # columns to select, all columns if not set
+    columns: Optional[List[Text]]
+    # shape of result set to extract_result_to
+    shape: ResultShape = ResultShape.ROWS
+    # key of rows when shape is dict
+    key_column: Optional[Text]
+    # 0 means no limit in stream mode
     limit: int = 1
     extract_result_to: Optional[Text]
+    # set an iterator of rows to extract_result_to instead of the rows, e.g. for loop_from of LOOP,
+    # rows are read by a server-side cursor in chunks of fetch_size when iterating
+    stream: bool = False
+    fetch_size: int = 1000
+    # lookup mode: select rows whose lookup_key column equals lookup_value, lookups of concurrent loops
+    # are batched into one "lookup_key IN (...)" query of at most lookup_window keys, see LookupBatcher
+    lookup_key: Optional[Text]
+    lookup_value: Any
+    lookup_window: int = 100
 
     # validators
     _meta_id = validator('meta_id', allow_reuse=True)(not_empty)
     _table = validator('table', allow_reuse=True)(not_empty)
     _where = validator('where', allow_reuse=True)(not_empty)
     _where_args = validator('where_args', allow_reuse=True)(not_empty)
-    _limit = validator('limit', allow_reuse=True)(validator_chain(gte(1), lte(2000)))
+    _columns = validator('columns', allow_reuse=True)(not_empty)
+    _limit = validator('limit', allow_reuse=True)(gte(0))
+    _fetch_size = validator('fetch_size', allow_reuse=True)(gte(1))
+    _lookup_window = validator('lookup_window', allow_reuse=True)(gte(1))
+
+    @root_validator(skip_on_failure=True)
+    def check_where(cls, values):
+        lookup_key = values.get('lookup_key')
+        if not lookup_key:
+            assert values.get('where'), 'where should not be empty'
+            assert values.get('where_args'), 'where_args should not be empty'
+            return values
+        assert not values.get('stream'), 'lookup_key can not be set in stream mode'
+        return values
+
+    @root_validator(skip_on_failure=True)
+    def check_shape(cls, values):
+        shape = values.get('shape')
+        columns = values.get('columns')
+        if shape in (ResultShape.SCALAR, ResultShape.COLUMN):
+            assert columns and len(columns) == 1, f'columns should have only one column when shape is {shape.value}'
+        if shape == ResultShape.DICT:
+            key_column = values.get('key_column')
+            assert key_column, 'key_column should not be empty when shape is dict'
+            assert not columns or key_column in columns, 'key_column should be in columns'
+        if values.get('stream'):
+            assert shape in (ResultShape.ROWS, ResultShape.COLUMN), 'shape should be rows or column in stream mode'
+        return values
+
+    @root_validator(skip_on_failure=True)
+    def check_limit(cls, values):
+        if values.get('stream'):
+            assert values.get('extract_result_to'), 'extract_result_to should not be empty in stream mode'
+            return values
+        limit = values.get('limit')
+        assert limit >= 1, 'limit should >= 1'
+        assert limit <= MAX_SELECT_LIMIT, f'limit should <= {MAX_SELECT_LIMIT}, set stream for more rows'
+        return values
+
+
+class _LookupBatch(object):
+    __slots__ = ('keys', 'has_leader', 'done', 'rows', 'error')
+
+    def __init__(self):
+        # normalized key -> key, in the order of lookups
+        self.keys: Dict[Text, Any] = {}
+        self.has_leader = False
+        self.done = threading.Event()
+        self.rows: Dict[Text, List[Dict[Text, Any]]] = {}
+        self.error: Optional[Exception] = None
+
+
+class LookupBatcher(object):
+    """batch lookups of the same query from concurrent loops, like a dataloader.
+
+    the first lookup of a batch leads it: if no query of the batcher is running, the batch is queried at once,
+    otherwise lookups arriving while a query is running are collected into the batch,
+    until the running query finishes or window keys are collected.
+    so a serial loop queries key by key without waiting, and concurrent loops query window by window.
+    keys are compared as str, e.g. 1 and "1" are the same key.
+    """
+
+    def __init__(self, meta_id: int, sql_head: Text, lookup_key: Text, window: int):
+        self.meta_id = meta_id
+        # e.g. "SELECT * FROM user_tab WHERE id IN ", keys are appended
+        self.sql_head = sql_head
+        self.lookup_key = lookup_key
+        self.window = window
+        self._cond = threading.Condition()
+        self._running = 0
+        self._batch: Optional[_LookupBatch] = None
+
+    def load(self, key: Any) -> List[Dict[Text, Any]]:
+        """rows whose lookup_key column equals key."""
+        normalized_key = str(key)
+        with self._cond:
+            batch = self._batch
+            if batch is None or len(batch.keys) >= self.window:
+                batch = _LookupBatch()
+                self._batch = batch
+            batch.keys.setdefault(normalized_key, key)
+            leader = not batch.has_leader
+            batch.has_leader = True
+            if leader:
+                while self._running and len(batch.keys) < self.window:
+                    self._cond.wait()
+                if self._batch is batch:
+                    self._batch = None
+                self._running += 1
+            elif len(batch.keys) >= self.window:
+                # wake the leader up
+                self._cond.notify_all()
+
+        if leader:
+            try:
+                batch.rows = self._query(list(batch.keys.values()))
+            except Exception as e:
+                batch.error = e
+            finally:
+                with self._cond:
+                    self._running -= 1
+                    self._cond.notify_all()
+                batch.done.set()
+        else:
+            batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+        return batch.rows.get(normalized_key, [])
+
+    def _query(self, keys: List[Any]) -> Dict[Text, List[Dict[Text, Any]]]:
+        sql = self.sql_head + escape_sql_value(keys, get_metaconfig_db(self.meta_id).charset)
+        with get_mysql_cursor(self.meta_id) as cursor:
+            cursor.execute(sql)
+            rows = cursor.fetchall()
+        indexed_rows = {}
+        for row in rows:
+            indexed_rows.setdefault(str(row[self.lookup_key]), []).append(row)
+        return indexed_rows
+
+
+# batchers are shared by steps of the same query, and dropped when no step uses them
+_lookup_batchers = weakref.WeakValueDictionary()
+_lookup_batchers_lock = threading.Lock()
+
+
+def get_lookup_batcher(meta_id: int, sql_head: Text, lookup_key: Text, window: int) -> LookupBatcher:
+    key = (meta_id, sql_head, lookup_key, window)
+    with _lookup_batchers_lock:
+        batcher = _lookup_batchers.get(key)
+        if batcher is None:
+            batcher = LookupBatcher(meta_id, sql_head, lookup_key, window)
+            _lookup_batchers[key] = batcher
+        return batcher
+
+
+class SqlRowStream(object):
+    """rows of a select, which are read when iterating, and read again when iterating again.
+    values of column are iterated instead of rows if column is set.
+    """
+
+    def __init__(self, meta_id: int, sql: Text, fetch_size: int, column: Optional[Text] = None):
+        self.meta_id = meta_id
+        self.sql = sql
+        self.fetch_size = fetch_size
+        self.column = column
+
+    def __iter__(self) -> Iterator[Any]:
+        rows = iter_mysql_rows(self.meta_id, self.sql, self.fetch_size)
+        if self.column is None:
+            return rows
+        return self._iter_column(rows)
+
+    def _iter_column(self, rows: Iterator[Dict[Text, Any]]) -> Iterator[Any]:
+        # rows are closed as soon as the iteration is stopped
+        with contextlib.closing(rows):
+            for row in rows:
+                yield row[self.column]
+
+    def __repr__(self):
+        return f'<SqlRowStream of "{self.sql}">'
 
 
 class StepSqlSelect(StepBase):
@@ -40,25 +234,81 @@ class StepSqlSelect(StepBase):
         super().init(config, logger, log_file, ctx)
 
     def _get_sql(self):
-        sql = f'SELECT * FROM {self.sql_select_config.table} WHERE {self.sql_select_config.where} LIMIT {self.sql_select_config.limit}'
+        columns = ','.join(self.sql_select_config.columns) if self.sql_select_config.columns else '*'
+        if self.sql_select_config.lookup_key:
+            return self._get_lookup_sql(columns)
+        sql = f'SELECT {columns} FROM {self.sql_select_config.table} WHERE {self.sql_select_config.where}'
+        if self.sql_select_config.limit:
+            sql += f' LIMIT {self.sql_select_config.limit}'
         formatted_sql = format_sql_raw(self.sql_select_config.meta_id, sql, self.sql_select_config.where_args)
         return formatted_sql
 
+    def _get_lookup_sql(self, columns: Text) -> Text:
+        config = self.sql_select_config
+        # rows are indexed by lookup_key, it is removed from rows in _lookup if not in columns
+        if config.columns and config.lookup_key not in config.columns:
+            columns = f'{columns},{config.lookup_key}'
+        # keys are appended by LookupBatcher, and rows of every key are limited by _lookup
+        where = f'({config.where}) AND ' if config.where else ''
+        sql = f'SELECT {columns} FROM {config.table} WHERE {where}{config.lookup_key} IN '
+        return format_sql_raw(config.meta_id, sql, config.where_args)
+
     def run(self) -> StepResult:
         super().run()
-        with get_mysql_cursor(self.sql_select_config.meta_id) as cursor:
-            cursor.execute(self.sql)
-            self.logger.debug('cursor.rowcount=%s, cursor.lastrowid=%s', cursor.rowcount, cursor.lastrowid)
-            if self.sql_select_config.limit == 1:
-                result = cursor.fetchone()
-            else:
-                result = cursor.fetchmany()
-            self.logger.debug('select result:\n%s', result)
-            if self.sql_select_config.extract_result_to:
-                self.ctx.set_variable(self.sql_select_config.extract_result_to, result)
-        self.step_result.success = result is not None
+        if self.sql_select_config.stream:
+            # the query is executed when the rows are iterated
+            column = self.sql_select_config.columns[0] if self.sql_select_config.shape == ResultShape.COLUMN else None
+            self.ctx.set_variable(self.sql_select_config.extract_result_to,
+                                  SqlRowStream(self.sql_select_config.meta_id, self.sql,
+                                               self.sql_select_config.fetch_size, column))
+            self.step_result.success = True
+            return self.step_result
+        if self.sql_select_config.lookup_key:
+            result = self._lookup()
+        else:
+            with get_mysql_cursor(self.sql_select_config.meta_id) as cursor:
+                cursor.execute(self.sql)
+                self.logger.debug('cursor.rowcount=%s, cursor.lastrowid=%s', cursor.rowcount, cursor.lastrowid)
+                if self.sql_select_config.limit == 1:
+                    result = cursor.fetchone()
+                else:
+                    result = cursor.fetchmany(self.sql_select_config.limit)
+        self.logger.debug('select result:\n%s', result)
+        # a NULL scalar of the found row is still a success
+        success = result is not None
+        if self.sql_select_config.extract_result_to:
+            self.ctx.set_variable(self.sql_select_config.extract_result_to, self._shape_result(result))
+        self.step_result.success = success
         return self.step_result
 
+    def _lookup(self) -> Any:
+        """the same as fetched by cursor: a row or None if limit is 1, otherwise a list of rows."""
+        config = self.sql_select_config
+        batcher = get_lookup_batcher(config.meta_id, self.sql, config.lookup_key, config.lookup_window)
+        rows = batcher.load(config.lookup_value)[:config.limit]
+        if config.columns and config.lookup_key not in config.columns:
+            rows = [{column: row[column] for column in config.columns} for row in rows]
+        if config.limit == 1:
+            return rows[0] if rows else None
+        return rows
+
+    def _shape_result(self, result: Any) -> Any:
+        """shape the fetched row (limit is 1) or rows, scalar is None if no row is fetched."""
+        shape = self.sql_select_config.shape
+        if shape == ResultShape.ROWS:
+            return result
+        if self.sql_select_config.limit == 1:
+            rows = [] if result is None else [result]
+        else:
+            rows = result
+        if shape == ResultShape.SCALAR:
+            return rows[0][self.sql_select_config.columns[0]] if rows else None
+        if shape == ResultShape.COLUMN:
+            column = self.sql_select_config.columns[0]
+            return [row[column] for row in rows]
+        key_column = self.sql_select_config.key_column
+        return {row[key_column]: row for row in rows}
+
     def validate_config(self):
         pass
 
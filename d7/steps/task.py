@@ -1,29 +1,47 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
+import copy
 import json
 import logging
+import os
+import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
 from enum import Enum
-from typing import List, Iterable, Dict, Text, Any, Optional
+from typing import List, Iterable, Dict, Text, Any, Optional, Mapping, Sized, Tuple, Sequence, Set, Type, FrozenSet
 
-from pydantic import validator, BaseModel
+from pydantic import validator, root_validator, BaseModel
 
-from d7.core.builtin import unix_now, str_now
+from d7.core.builtin import unix_now, str_now, get_uuid
 from d7.core.context import Context
 from d7.core.exceptions import ParamsError
-from d7.core.logger import get_task_logger
-from d7.core.model_validators import not_empty
-from d7.core.utils import read_file
-from d7.steps.step import StepBase, StepConfigBase, StepTypeEnum, StepResult, INDENT, TimeStat
+from d7.core.logger import get_task_logger, get_task_log_file
+from d7.core.model_validators import not_empty, gte
+from d7.core.parser import compile_data, ignore_variables, function_regex_compile, parse_parameters_lazily, extract_ordered_variables
+from d7.core.utils import read_file, is_support_multiprocessing
+from d7.steps.step import StepBase, StepConfigBase, StepTypeEnum, StepResult, StepStat, INDENT, TimeStat
 from d7.steps.step_http import StepHttp
 from d7.steps.step_param_set import StepParamSet
 from d7.steps.step_redis_delete import StepRedisDelete
 from d7.steps.step_redis_get import StepRedisGet
 from d7.steps.step_redis_set import StepRedisSet
 from d7.steps.step_script_load import StepScriptLoad
+from d7.steps.step_sql_batch_insert import StepSqlBatchInsert
+from d7.steps.step_sql_chunked import StepSqlChunkedUpdate, StepSqlChunkedDelete
 from d7.steps.step_sql_delete import StepSqlDelete
 from d7.steps.step_sql_insert import StepSqlInsert
+from d7.steps.step_sql_load import StepSqlLoad
 from d7.steps.step_sql_select import StepSqlSelect
 from d7.steps.step_sql_update import StepSqlUpdate
+from d7.steps.util import get_mysql_cursor, get_mysql_transaction, mysql_transaction, MySQLTransaction
+
+
+class SummaryMode(Text, Enum):
+    # keep result of every step in every loop
+    FULL = 'full'
+    # keep stats of every step, and results of failed steps and the first loops only
+    AGGREGATE = 'aggregate'
 
 
 class TaskSummary(BaseModel):
@@ -35,37 +53,300 @@ class TaskSummary(BaseModel):
     error: Text = ""
     step_results: List[StepResult] = []
     indent = 0
+    summary_mode: SummaryMode = SummaryMode.FULL
+    # aggregate mode: keep step results of the first summary_samples loops
+    summary_samples: int = 0
+    # aggregate mode: keep the first summary_max_errors failed results and errors of every step
+    summary_max_errors: int = 0
+    loop_count: int = 0
+    # aggregate mode: stats of children, in the same order as children
+    step_stats: List[StepStat] = []
 
-    def __str__(self):
-        step_result_str = '\n'.join([str(step_result) for step_result in self.step_results])
+    def add_step_result(self, index: int, step_result: StepResult, loop_count: Optional[int] = None,
+                        position: Optional[int] = None) -> bool:
+        """record result of child index, return True if it is kept in step_results.
+
+        a result recorded after its loop, e.g. of a coalesced insert, is recorded with loop_count of its loop
+        and inserted at position, the length of step_results when its loop ran.
+        """
+        if loop_count is None:
+            loop_count = self.loop_count
+        if self.summary_mode != SummaryMode.FULL:
+            while len(self.step_stats) <= index:
+                self.step_stats.append(StepStat())
+            stat = self.step_stats[index]
+            stat.add(step_result, self.summary_max_errors)
+            if loop_count > self.summary_samples and \
+                    (step_result.success or stat.fail_count > self.summary_max_errors):
+                return False
+        if position is None:
+            self.step_results.append(step_result)
+        else:
+            self.step_results.insert(position, step_result)
+        return True
+
+    def merge(self, other: 'TaskSummary'):
+        """merge summary of loops running in another process."""
+        self.loop_count += other.loop_count
+        self.error = self.error or other.error
+        self.step_results.extend(other.step_results)
+        for index, stat in enumerate(other.step_stats):
+            while len(self.step_stats) <= index:
+                self.step_stats.append(StepStat())
+            self.step_stats[index].merge(stat, self.summary_max_errors)
+
+    def iter_lines(self):
+        """render summary line by line, step results are rendered lazily."""
         indent_str = ' ' * self.indent
-        task_summary_str = f"""
-{indent_str}success: {self.success}
-{indent_str}name: {self.name}
-{indent_str}type: {self.type}
-{indent_str}start_time: {self.time_stat.start_at_str}
-{indent_str}end_time: {self.time_stat.end_at_str}
-{indent_str}elapsed: {self.time_stat.end_at - self.time_stat.start_at:.2f}s
-{indent_str}step_results:
-{indent_str}{step_result_str}
-"""
+        yield ''
+        yield f'{indent_str}success: {self.success}'
+        yield f'{indent_str}name: {self.name}'
+        yield f'{indent_str}type: {self.type}'
+        yield f'{indent_str}start_time: {self.time_stat.start_at_str}'
+        yield f'{indent_str}end_time: {self.time_stat.end_at_str}'
+        yield f'{indent_str}elapsed: {self.time_stat.end_at - self.time_stat.start_at:.2f}s'
+        if self.step_stats:
+            yield f'{indent_str}loops: {self.loop_count}'
+            yield f'{indent_str}step_stats:'
+            for stat in self.step_stats:
+                yield from stat.iter_lines(self.indent)
+        yield f'{indent_str}step_results:'
+        first = True
+        for step_result in self.step_results:
+            for line in step_result.iter_lines():
+                yield indent_str + line if first else line
+                first = False
+        if first:
+            yield indent_str
         if self.error:
-            task_summary_str += f'error: {self.error}\n'
-        return task_summary_str
+            yield f'error: {self.error}'
+        yield ''
+
+    def __str__(self):
+        return '\n'.join(self.iter_lines())
+
+
+# variables set by every loop
+LOOP_VARIABLES = frozenset(('loop_index', 'loop_param'))
+
+
+# one budget of worker threads shared by all concurrent loops, including nested ones,
+# a loop runs iterations in its own thread when the budget is used up, see Task._run_loops_concurrently
+MAX_LOOP_WORKERS = 64
+_loop_worker_budget = threading.Semaphore(MAX_LOOP_WORKERS)
+
+
+def set_max_loop_workers(max_workers: int):
+    """set the global budget of loop worker threads, should be called before any task runs."""
+    global _loop_worker_budget
+    assert max_workers > 0, 'max_workers should > 0'
+    _loop_worker_budget = threading.Semaphore(max_workers)
+
+
+def check_loop_from(loop_from):
+    if is_range_spec(loop_from):
+        args = loop_from['range']
+        assert isinstance(args, list) and 1 <= len(args) <= 3 \
+               and all(isinstance(arg, int) and not isinstance(arg, bool) for arg in args), \
+            'range should be a list of int: [stop], [start, stop] or [start, stop, step]'
+        assert args[-1] != 0 or len(args) < 3, 'step of range should not be 0'
+        assert len(range(*args)) > 0, 'range should not be empty'
+        return loop_from
+    assert isinstance(loop_from, Iterable), 'should be iterable'
+    if isinstance(loop_from, Sized):
+        # iterators and generators can not be checked without being consumed
+        not_empty(loop_from)
+    return loop_from
+
+
+def is_range_spec(loop_from) -> bool:
+    # e.g. {"range": [0, 10000000, 1]}
+    # Notice: a mapping whose only key is "range" is always taken as range spec,
+    # use "${range(0, 100)}" or add another key if it should be looped as mapping
+    return isinstance(loop_from, Mapping) and len(loop_from) == 1 and 'range' in loop_from
+
+
+def check_parameters(parameters):
+    not_empty(parameters)
+    for parameter_name in parameters:
+        reserved_names = LOOP_VARIABLES.intersection(parameter_name.split('-'))
+        assert not reserved_names, f'{", ".join(sorted(reserved_names))} is reserved for loop, use another name'
+    return parameters
+
+
+class Schedule(Text, Enum):
+    # run children one after another
+    SERIAL = 'serial'
+    # run children concurrently, except the ones depending on each other, see get_steps_dependencies
+    DAG = 'dag'
 
 
 class LoopConfig(BaseModel):
-    loop_from: Iterable
+    # list, mapping, range spec like {"range": [0, 100, 1]}, or any iterable, e.g. generator returned by function
+    loop_from: Optional[Any]
+    # loop over cartesian product of parameters, see parser.parse_parameters
+    parameters: Optional[Dict[Text, Any]]
+    children: List[Dict[Text, Any]]
+    # inherited from the parent loop if not set, full by default
+    summary_mode: Optional[SummaryMode]
+    summary_samples: int = 10
+    summary_max_errors: int = 10
+    # run loops in a thread pool, every loop has its own variables, see Context.fork
+    concurrency: int = 1
+    # collect results in loop order, or in the order loops finish
+    ordered: bool = True
+    # how children are scheduled in every loop
+    schedule: Schedule = Schedule.SERIAL
+    # split loops into shards and run every shard in a worker process, with its own context and connections
+    processes: int = 1
+    # rows of SQL_INSERT children are inserted by multi-row statements of insert_batch_size rows, 1 to disable,
+    # the other children should not depend on the inserted rows, see get_coalescable_inserts
+    insert_batch_size: int = 1
+
+    # validators
+    _concurrency = validator('concurrency', allow_reuse=True)(gte(1))
+    _processes = validator('processes', allow_reuse=True)(gte(1))
+    _insert_batch_size = validator('insert_batch_size', allow_reuse=True)(gte(1))
+    _summary_samples = validator('summary_samples', allow_reuse=True)(gte(0))
+    _summary_max_errors = validator('summary_max_errors', allow_reuse=True)(gte(0))
+    _loop_from = validator('loop_from', allow_reuse=True)(check_loop_from)
+    _parameters = validator('parameters', allow_reuse=True)(check_parameters)
+    _children = validator('children', allow_reuse=True)(not_empty)
+
+    @root_validator(skip_on_failure=True)
+    def check_loop_source(cls, values):
+        has_loop_from = values.get('loop_from') is not None
+        has_parameters = values.get('parameters') is not None
+        assert has_loop_from or has_parameters, 'loop_from or parameters should not be empty'
+        assert not (has_loop_from and has_parameters), 'only one of loop_from and parameters can be set'
+        return values
+
+
+class JoinPolicy(Text, Enum):
+    # succeed if all children succeed
+    ALL = 'all'
+    # succeed as soon as one child succeeds
+    FIRST_SUCCESS = 'first_success'
+    # succeed as soon as quorum children succeed
+    QUORUM = 'quorum'
+
+
+class ParallelConfig(BaseModel):
     children: List[Dict[Text, Any]]
+    # all children run at the same time if not set
+    max_concurrency: Optional[int]
+    join: JoinPolicy = JoinPolicy.ALL
+    quorum: Optional[int]
 
     # validators
-    _loop_from = validator('loop_from', allow_reuse=True)(not_empty)
     _children = validator('children', allow_reuse=True)(not_empty)
+    _max_concurrency = validator('max_concurrency', allow_reuse=True)(gte(1))
+    _quorum = validator('quorum', allow_reuse=True)(gte(1))
+
+    @root_validator(skip_on_failure=True)
+    def check_quorum(cls, values):
+        if values.get('join') == JoinPolicy.QUORUM:
+            quorum = values.get('quorum')
+            assert quorum is not None, 'quorum should not be empty when join is quorum'
+            assert quorum <= len(values['children']), 'quorum should <= count of children'
+        return values
+
+    def get_required_successes(self) -> int:
+        if self.join == JoinPolicy.FIRST_SUCCESS:
+            return 1
+        if self.join == JoinPolicy.QUORUM:
+            return self.quorum
+        return len(self.children)
+
+
+def _check_children_in_transaction(children: List[Any]):
+    # the transaction is bound to the thread running the block, see util.mysql_transaction,
+    # SQL steps run by other threads or processes would not see it
+    for child in children:
+        if not isinstance(child, Mapping) or not isinstance(child.get('config'), Mapping):
+            # e.g. config rendered from variables, checked when the child is built
+            continue
+        name, step_type, config = child.get('name'), child.get('type'), child['config']
+        assert step_type != StepTypeEnum.PARALLEL, f'PARALLEL {name} can not run in SQL_TRANSACTION'
+        if step_type == StepTypeEnum.LOOP:
+            assert config.get('concurrency', 1) == 1, f'concurrency of LOOP {name} should be 1 in SQL_TRANSACTION'
+            assert config.get('processes', 1) == 1, f'processes of LOOP {name} should be 1 in SQL_TRANSACTION'
+            assert config.get('schedule', Schedule.SERIAL) == Schedule.SERIAL, \
+                f'schedule of LOOP {name} should be serial in SQL_TRANSACTION'
+        if step_type in (StepTypeEnum.LOOP, StepTypeEnum.SQL_TRANSACTION) and isinstance(config.get('children'), list):
+            _check_children_in_transaction(config['children'])
+
+
+class TransactionConfig(BaseModel):
+    # SQL steps of children share one connection of every meta_id, see util.mysql_transaction
+    children: List[Dict[Text, Any]]
+    # commit after every commit_every loops of LOOP children, for bulk runs, commit at the end only if not set
+    commit_every: Optional[int]
+
+    # validators
+    _children = validator('children', allow_reuse=True)(not_empty)
+    _commit_every = validator('commit_every', allow_reuse=True)(gte(1))
+
+    @root_validator(skip_on_failure=True)
+    def check_children(cls, values):
+        # children run in the thread of the block only, PARALLEL and concurrent LOOP are rejected
+        _check_children_in_transaction(values['children'])
+        return values
+
+
+# step types run by step classes, LOOP, PARALLEL and SQL_TRANSACTION are run by Task
+STEP_CLASSES: Dict[StepTypeEnum, Type[StepBase]] = {
+    StepTypeEnum.HTTP: StepHttp,
+    StepTypeEnum.SQL_SELECT: StepSqlSelect,
+    StepTypeEnum.SQL_UPDATE: StepSqlUpdate,
+    StepTypeEnum.SQL_INSERT: StepSqlInsert,
+    StepTypeEnum.SQL_BATCH_INSERT: StepSqlBatchInsert,
+    StepTypeEnum.SQL_LOAD: StepSqlLoad,
+    StepTypeEnum.SQL_DELETE: StepSqlDelete,
+    StepTypeEnum.SQL_CHUNKED_UPDATE: StepSqlChunkedUpdate,
+    StepTypeEnum.SQL_CHUNKED_DELETE: StepSqlChunkedDelete,
+    StepTypeEnum.REDIS_GET: StepRedisGet,
+    StepTypeEnum.REDIS_SET: StepRedisSet,
+    StepTypeEnum.REDIS_DELETE: StepRedisDelete,
+    StepTypeEnum.PARAM_SET: StepParamSet,
+    StepTypeEnum.SCRIPT_LOAD: StepScriptLoad,
+}
+
+
+def _get_step_ignore_variables(step_type: Any) -> FrozenSet[Text]:
+    try:
+        step_class = STEP_CLASSES.get(StepTypeEnum(step_type))
+    except ValueError:
+        # dynamic or invalid type, reported when the step is built
+        return frozenset()
+    return step_class.ignore_variables if step_class is not None else frozenset()
+
+
+class StepPlan(object):
+    """plan of a child config, compiled once and used in every loop.
+
+    config is compiled once, and only the dynamic parts are rendered in every loop.
+    step built from a constant config is validated once and copied in every loop, see StepBase.reusable.
+    name, type and continue_when_failed of a dynamic config are validated once if they are constant.
+    """
+    __slots__ = ('compiled_config', 'constant_header', 'step_config', 'prototype')
+
+    def __init__(self, config: Dict[Text, Any]):
+        self.compiled_config = compile_data(config, ignore_variables | _get_step_ignore_variables(config.get('type')))
+        # name, type and continue_when_failed
+        self.constant_header = compile_data({key: value for key, value in config.items() if key != 'config'}) \
+            .is_constant()
+        # validated step config of constant header, config is replaced by rendered config in every loop
+        self.step_config: Optional[StepConfigBase] = None
+        # step of constant config
+        self.prototype: Optional[StepBase] = None
 
 
 class TaskType(Text, Enum):
     TASK = 'task'
     LOOP = 'loop'
+    PARALLEL = 'parallel'
+    TRANSACTION = 'transaction'
 
 
 def _get_result_str(success: bool):
@@ -83,37 +364,71 @@ class Task(StepBase):
     name: str = ''
     task_type: TaskType
     loop_config: Optional[LoopConfig]
+    # children run concurrently once, see StepTypeEnum.PARALLEL
+    parallel_config: Optional[ParallelConfig]
+    # children run once in a transaction, see StepTypeEnum.SQL_TRANSACTION
+    transaction_config: Optional[TransactionConfig]
     log_file: str
     logger: logging.Logger
     ctx: Context
     indent = 0
     parent = None
+    # plans of children, built once and used on every loop
+    step_plans: List[Optional[StepPlan]]
+    # dag schedule: dependencies of children, built on demand
+    children_dependencies: Optional[List[Set[int]]]
 
     def get_task_log(self) -> Text:
         s = read_file(self.log_file)
         return s
 
     def execute(self) -> TaskSummary:
-        summary = TaskSummary(name=self.name, type='task', indent=self.indent)
+        summary = self._start_execute()
+        try:
+            self._run(summary)
+        except Exception as e:
+            self._on_execute_error(summary, e)
+        self._end_execute(summary)
+        return summary
+
+    async def execute_async(self) -> TaskSummary:
+        """same as execute, but run in asyncio, steps are run by StepBase.run_async."""
+        summary = self._start_execute()
+        try:
+            await self._run_async(summary)
+        except Exception as e:
+            self._on_execute_error(summary, e)
+        self._end_execute(summary)
+        return summary
+
+    def _start_execute(self) -> TaskSummary:
+        summary = self._new_summary()
         summary.time_stat.start_at = unix_now()
         summary.time_stat.start_at_str = str_now()
-        path = self.get_full_path()
         if self.task_type == TaskType.TASK:
             config = json.dumps(self.loop_config.children, indent=2)
-            self.logger.info('start run task [%s], config=%s', path, config)
-        try:
-            self._run(summary)
-        except Exception as e:
-            self.logger.exception('run task error: %s', e)
-            print('run task error: %s' % e)
-            summary.error = repr(e)
+            self.logger.info('start run task [%s], config=%s', self.get_full_path(), config)
+        return summary
+
+    def _on_execute_error(self, summary: TaskSummary, e: Exception):
+        self.logger.error('run task error: %s', e, exc_info=e)
+        print('run task error: %s' % e)
+        summary.error = repr(e)
+
+    def _end_execute(self, summary: TaskSummary):
         summary.time_stat.end_at = unix_now()
         summary.time_stat.end_at_str = str_now()
         if self.task_type == TaskType.TASK:
-            self.logger.info('end [%s] [%s]', _get_result_str(summary.success), path)
+            self.logger.info('end [%s] [%s]', _get_result_str(summary.success), self.get_full_path())
             self.logger.info('task_summary: %s', summary)
-        summary.log = read_file(self.log_file)
-        return summary
+            # the log of a loop is a part of the task log, it is not read again for every loop
+            summary.log = read_file(self.log_file)
+
+    def _new_summary(self) -> TaskSummary:
+        return TaskSummary(name=self.name, type='task', indent=self.indent,
+                           summary_mode=self.loop_config.summary_mode or SummaryMode.FULL,
+                           summary_samples=self.loop_config.summary_samples,
+                           summary_max_errors=self.loop_config.summary_max_errors)
 
     def validate_config(self):
         pass
@@ -131,140 +446,913 @@ class Task(StepBase):
                  configs: List[dict] = None,
                  loop_config: LoopConfig = None,
                  task_type: TaskType = TaskType.TASK,
-                 ctx: Context = None):
+                 ctx: Context = None,
+                 schedule: Schedule = Schedule.SERIAL,
+                 parallel_config: ParallelConfig = None,
+                 transaction_config: TransactionConfig = None):
         self.task_type = task_type
-        self.type = StepTypeEnum.TASK if task_type == TaskType.TASK else StepTypeEnum.LOOP
+        self.type = {
+            TaskType.TASK: StepTypeEnum.TASK,
+            TaskType.LOOP: StepTypeEnum.LOOP,
+            TaskType.PARALLEL: StepTypeEnum.PARALLEL,
+            TaskType.TRANSACTION: StepTypeEnum.SQL_TRANSACTION,
+        }[task_type]
         self.log_file = log_file
         self.logger = logger or get_task_logger(log_file=self.log_file, level='DEBUG', name=self.log_file)
-        if not configs and not loop_config:
-            raise ParamsError('configs or loop_config should exists')
+        if not configs and not loop_config and not parallel_config and not transaction_config:
+            raise ParamsError('configs, loop_config, parallel_config or transaction_config should exists')
 
         self.name = name
-        self.loop_config = loop_config or LoopConfig(loop_from=[1], children=configs)
+        self.parallel_config = parallel_config
+        if parallel_config is not None:
+            configs = parallel_config.children
+        self.transaction_config = transaction_config
+        if transaction_config is not None:
+            configs = transaction_config.children
+        self.loop_config = loop_config or LoopConfig(loop_from=[1], children=configs, schedule=schedule)
         self.ctx = ctx or Context()
+        self.step_plans = [None] * len(self.loop_config.children)
+        self.children_dependencies = None
 
     def run(self) -> StepResult:
-        summary = self.execute()
+        return self._get_step_result(self.execute())
+
+    async def run_async(self) -> StepResult:
+        return self._get_step_result(await self.execute_async())
+
+    def _get_step_result(self, summary: TaskSummary) -> StepResult:
         step_result = StepResult(name=self.name, type=self.task_type)
         step_result.time_stat = summary.time_stat
         step_result.success = summary.success
         step_result.execute_error = summary.error
         step_result.children = summary.step_results
+        step_result.stats = summary.step_stats
         return step_result
 
     def _run(self, summary: TaskSummary):
-        loop_from = []
-        if isinstance(self.loop_config.loop_from, Dict):
-            for key in self.loop_config.loop_from:
-                loop_from.append({
-                    'loop_index': key,
-                    'loop_param': self.loop_config.loop_from[key]
-                })
+        if self.transaction_config is not None:
+            self._run_transaction(summary)
+            return
+        if self.loop_config.processes > 1 and self._run_loops_in_processes(summary):
+            return
+        self._run_loops(*self._get_loops(), summary)
+
+    def _run_transaction(self, summary: TaskSummary):
+        try:
+            with mysql_transaction(self, self.transaction_config.commit_every) as transaction:
+                self._run_loops(*self._get_loops(), summary)
+                # a nested block joins the outer transaction, the outer one is rolled back too if it failed
+                if not summary.success:
+                    transaction.rollback_only = True
+        except Exception:
+            # e.g. commit failed
+            summary.success = False
+            raise
+
+    def _get_parent_transaction(self) -> Optional[MySQLTransaction]:
+        # loops of a transaction block may commit every commit_every loops
+        transaction = get_mysql_transaction()
+        if transaction is None or transaction.owner is not self.parent:
+            return None
+        return transaction
+
+    async def _run_async(self, summary: TaskSummary):
+        if self.transaction_config is not None:
+            # the transaction is bound to the thread running the block
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._run, summary)
+            return
+        if self.loop_config.processes > 1:
+            loop = asyncio.get_running_loop()
+            if await loop.run_in_executor(None, self._run_loops_in_processes, summary):
+                return
+        await self._run_loops_async(*self._get_loops(), summary)
+
+    def _get_loops(self) -> Tuple[Iterable[Dict[Text, Any]], bool]:
+        if self.loop_config.parameters is not None:
+            return self._get_parameters_loops()
+        return self._get_loop_from_loops()
+
+    def _get_loop_from_loops(self) -> Tuple[Iterable[Dict[Text, Any]], bool]:
+        # loop_from is consumed one item at a time, only mapping is sorted by key
+        loop_from = self.loop_config.loop_from
+        if is_range_spec(loop_from):
+            loop_from = range(*loop_from['range'])
+        if isinstance(loop_from, Mapping):
+            loops = (
+                {'loop_index': key, 'loop_param': loop_from[key]}
+                for key in sorted(loop_from)
+            )
+        else:
+            loops = (
+                {'loop_index': key, 'loop_param': value}
+                for (key, value) in enumerate(loop_from)
+            )
+        return loops, isinstance(loop_from, Sized) and len(loop_from) == 1
+
+    def _get_parameters_loops(self) -> Tuple[Iterable[Dict[Text, Any]], bool]:
+        # parameters are generated lazily, one loop at a time
+        parameters = parse_parameters_lazily(self.loop_config.parameters, self.ctx.get_functions_table())
+        loops = (
+            {**parameter, 'loop_index': index, 'loop_param': parameter}
+            for (index, parameter) in enumerate(parameters)
+        )
+        return loops, len(parameters) == 1
+
+    def _get_loop_shards(self, count: int) -> Optional[List['_LoopShard']]:
+        # only indexable sources can be split, None for others, e.g. generators
+        loop_from = self.loop_config.loop_from
+        if self.loop_config.parameters is not None:
+            kind = _LoopShard.PARAMETERS
+            source = parse_parameters_lazily(self.loop_config.parameters, self.ctx.get_functions_table())
+        elif is_range_spec(loop_from):
+            kind, source = _LoopShard.SEQUENCE, range(*loop_from['range'])
+        elif isinstance(loop_from, Mapping):
+            kind, source = _LoopShard.ITEMS, [(key, loop_from[key]) for key in sorted(loop_from)]
+        elif isinstance(loop_from, Sequence) and not isinstance(loop_from, (str, bytes)):
+            kind, source = _LoopShard.SEQUENCE, loop_from
         else:
-            for (key, value) in enumerate(self.loop_config.loop_from):
-                loop_from.append({
-                    'loop_index': key,
-                    'loop_param': value
-                })
-        loop_from = sorted(loop_from, key=lambda a: a['loop_index'])
-        single_loop = len(loop_from) == 1
+            return None
+
+        shard_size = -(-len(source) // count)
+        return [
+            _LoopShard(kind, source[offset:offset + shard_size], offset)
+            for offset in range(0, len(source), shard_size)
+        ]
+
+    def _run_loops_in_processes(self, summary: TaskSummary) -> bool:
+        """run shards of loops in worker processes, return False if loops can not run in processes."""
+        path = self.get_full_path()
+        if not is_support_multiprocessing():
+            self.logger.warning('multiprocessing is not supported, run [%s] in current process', path)
+            return False
+        shards = self._get_loop_shards(self.loop_config.processes)
+        if shards is None:
+            self.logger.warning('loop_from can not be split, run [%s] in current process', path)
+            return False
+
+        # the config of shards, loops are passed by shards
+        loop_config = self.loop_config.copy(update={'loop_from': [1], 'parameters': None, 'processes': 1})
+        variables = _get_picklable_variables(self.ctx.get_variables())
+        results = {}
+        success = True
+        with ProcessPoolExecutor(max_workers=len(shards)) as executor:
+            futures = {
+                executor.submit(_run_loop_shard, path, loop_config, variables, self.ctx.get_scripts(), shard): index
+                for index, shard in enumerate(shards)
+            }
+            try:
+                while futures and success:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        index = futures.pop(future)
+                        results[index] = future.result()
+                        success = success and results[index][0].success
+            finally:
+                # fail fast: shards not started yet are cancelled
+                for future in futures:
+                    future.cancel()
+            for future, index in futures.items():
+                if not future.cancelled():
+                    results[index] = future.result()
+
+        for index in sorted(results):
+            shard_summary, shard_variables, shard_log = results[index]
+            self.logger.info('[shard:%s] log of [%s]:\n%s', index, path, shard_log)
+            summary.merge(shard_summary)
+            self.ctx.set_variables(shard_variables)
+        summary.success = success and len(results) == len(shards)
+        return True
+
+    def _run_loops(self, loop_from: Iterable[Dict[Text, Any]], single_loop: bool, summary: TaskSummary):
+        if self.loop_config.concurrency > 1 and not single_loop:
+            self._run_loops_concurrently(loop_from, summary)
+            return
+
         path = self.get_full_path()
+        coalescer = None if single_loop else self._get_insert_coalescer(summary)
+        transaction = self._get_parent_transaction()
         success = True
         for loop in loop_from:
+            summary.loop_count += 1
             self.ctx.set_variables(loop)
             if not single_loop:
                 self.logger.info('start [%s] [loop:%s]', path, loop['loop_index'])
-            success = self._run_steps(self.loop_config.children, summary)
+            if coalescer is not None:
+                coalescer.loop_index = loop['loop_index']
+            success = self._run_steps(self.loop_config.children, summary, coalescer=coalescer)
             if not single_loop:
                 self.logger.info('end [%s] [%s] [loop:%s]', _get_result_str(success), path, loop['loop_index'])
             if not success:
                 break
+            if transaction is not None and transaction.count_loop():
+                # buffered rows are inserted before commit
+                if coalescer is not None and not coalescer.flush():
+                    success = False
+                    break
+                transaction.commit()
+        if coalescer is not None:
+            # rows of the finished loops are inserted even if the loop failed
+            success = coalescer.flush() and success
         summary.success = success
 
-    def _run_steps(self, children: List[Dict[Text, Any]], summary: TaskSummary) -> bool:
+    def _get_insert_coalescer(self, summary: TaskSummary) -> Optional['_InsertCoalescer']:
+        if self.task_type != TaskType.LOOP or self.loop_config.insert_batch_size <= 1 \
+                or self.loop_config.schedule != Schedule.SERIAL:
+            return None
+        indexes = get_coalescable_inserts(self.loop_config.children)
+        if not indexes:
+            return None
+        return _InsertCoalescer(self, indexes, self.loop_config.insert_batch_size, summary)
+
+    async def _run_loops_async(self, loop_from: Iterable[Dict[Text, Any]], single_loop: bool,
+                               summary: TaskSummary):
+        if self.loop_config.concurrency > 1 and not single_loop:
+            await self._run_loops_concurrently_async(loop_from, summary)
+            return
+
+        path = self.get_full_path()
+        success = True
+        for loop in loop_from:
+            summary.loop_count += 1
+            self.ctx.set_variables(loop)
+            if not single_loop:
+                self.logger.info('start [%s] [loop:%s]', path, loop['loop_index'])
+            success = await self._run_steps_async(self.loop_config.children, summary)
+            if not single_loop:
+                self.logger.info('end [%s] [%s] [loop:%s]', _get_result_str(success), path, loop['loop_index'])
+            if not success:
+                break
+        summary.success = success
+
+    async def _run_loops_concurrently_async(self, loop_from: Iterable[Dict[Text, Any]], summary: TaskSummary):
+        # same as _run_loops_concurrently, but loops are asyncio tasks instead of threads
+        concurrency = self.loop_config.concurrency
+        collector = _LoopCollector(summary, self.loop_config.ordered)
+        tasks = set()
+        try:
+            for seq, loop in enumerate(loop_from):
+                while len(tasks) >= concurrency and collector.success:
+                    done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        collector.add(*task.result())
+                if not collector.success:
+                    break
+                tasks.add(asyncio.ensure_future(self._run_loop_async(seq, loop)))
+
+            while tasks and collector.success:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    collector.add(*task.result())
+        finally:
+            # fail fast: running loops are waited, so that no step is interrupted halfway
+            if tasks:
+                await asyncio.wait(tasks)
+
+        for task in tasks:
+            collector.add(*task.result())
+        collector.flush()
+        self.ctx.set_variables(collector.variables)
+        summary.success = collector.success
+
+    async def _run_loop_async(self, seq: int, loop: Dict[Text, Any]) -> Tuple[int, bool, List[StepResult],
+                                                                               Dict[Text, Any]]:
+        path = self.get_full_path()
+        ctx = self.ctx.fork()
+        ctx.set_variables(loop)
+        loop_summary = TaskSummary(name=self.name, type='task')
+        self.logger.info('start [%s] [loop:%s]', path, loop['loop_index'])
+        success = await self._run_steps_async(self.loop_config.children, loop_summary, ctx)
+        self.logger.info('end [%s] [%s] [loop:%s]', _get_result_str(success), path, loop['loop_index'])
+        return seq, success, loop_summary.step_results, ctx.get_local_variables()
+
+    def _run_loops_concurrently(self, loop_from: Iterable[Dict[Text, Any]], summary: TaskSummary):
+        concurrency = self.loop_config.concurrency
+        collector = _LoopCollector(summary, self.loop_config.ordered)
+        futures = set()
+        executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f'loop[{self.name}]')
+        try:
+            for seq, loop in enumerate(loop_from):
+                while len(futures) >= concurrency and collector.success:
+                    done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        collector.add(*future.result())
+                if not collector.success:
+                    break
+
+                budget = _loop_worker_budget
+                if budget.acquire(blocking=False):
+                    future = executor.submit(self._run_loop, seq, loop)
+                    # released even if the future is cancelled
+                    future.add_done_callback(lambda _: budget.release())
+                    futures.add(future)
+                else:
+                    # no worker left, e.g. too many nested concurrent loops, run in the current thread
+                    collector.add(*self._run_loop(seq, loop))
+
+            while futures and collector.success:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collector.add(*future.result())
+        finally:
+            # fail fast: loops not started yet are cancelled, running ones are waited
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        for future in futures:
+            if not future.cancelled():
+                collector.add(*future.result())
+        collector.flush()
+        self.ctx.set_variables(collector.variables)
+        summary.success = collector.success
+
+    def _run_loop(self, seq: int, loop: Dict[Text, Any]) -> Tuple[int, bool, List[StepResult], Dict[Text, Any]]:
+        # every loop has its own variables, so that loop_index and loop_param are not overwritten by other loops
+        path = self.get_full_path()
+        ctx = self.ctx.fork()
+        ctx.set_variables(loop)
+        loop_summary = TaskSummary(name=self.name, type='task')
+        self.logger.info('start [%s] [loop:%s]', path, loop['loop_index'])
+        success = self._run_steps(self.loop_config.children, loop_summary, ctx)
+        self.logger.info('end [%s] [%s] [loop:%s]', _get_result_str(success), path, loop['loop_index'])
+        return seq, success, loop_summary.step_results, ctx.get_local_variables()
+
+    def _run_steps(self, children: List[Dict[Text, Any]], summary: TaskSummary, ctx: Context = None,
+                   coalescer: Optional['_InsertCoalescer'] = None) -> bool:
+        ctx = ctx or self.ctx
+        if self.parallel_config is not None:
+            return self._run_steps_parallel(children, summary, ctx)
+        if self.loop_config.schedule == Schedule.DAG and len(children) > 1:
+            return self._run_steps_dag(children, summary, ctx)
         success = True
-        for config in children:
-            step_name = config['name']
-            path = self.get_full_path() + f' > {step_name}'
-            step_result = StepResult()
-            step_result.time_stat.start_at = unix_now()
-            step_result.time_stat.start_at_str = str_now()
-            step_result.name = step_name
-            self.logger.info('start [%s]', path)
+        for index, config in enumerate(children):
+            step, step_result, path = self._start_step(index, config, ctx)
+            if step is None:
+                summary.add_step_result(index, step_result)
+                return False
+            if coalescer is not None and index in coalescer.indexes:
+                # result is recorded when the row is inserted
+                if not coalescer.add(index, step, step_result, path):
+                    success = False
+                    break
+                continue
             try:
-                self.logger.debug('config before parsed: %s', config)
-                config = self.ctx.parse_data(config)
-                self.logger.debug('config after parsed: %s', config)
-                step = self.build_step(config=config)
-                step_result.type = step.type
+                step_result = step.run()
+                error = None
             except Exception as e:
-                self.logger.exception('build step[%s] error: %r', step_name, e)
+                error = e
+            if not self._end_step(index, step, step_result, error, path, summary):
                 success = False
-                step_result.success = False
-                step_result.config_error = repr(e)
-                step_result.time_stat.end_at = unix_now()
-                step_result.time_stat.end_at_str = str_now()
-                summary.step_results.append(step_result)
-                self.logger.error('end [error:init] [%s]: %r\n', path, e)
-                return success
+                break
+        summary.success = success
+        return success
 
-            try:
-                step_result = step.run()
-                self.logger.info('end [%s] [%s]\n', _get_result_str(step_result.success), path)
-                if not step_result.success:
-                    if not step.continue_when_failed:
+    def _run_steps_dag(self, children: List[Dict[Text, Any]], summary: TaskSummary, ctx: Context) -> bool:
+        """run children concurrently, a child starts after all the children it depends on finished.
+        children share the context, they do not write the same variables if not depending on each other.
+        """
+        if self.children_dependencies is None:
+            self.children_dependencies = get_steps_dependencies(children)
+        dependencies = self.children_dependencies
+
+        results: Dict[int, StepResult] = {}
+        finished: Set[int] = set()
+        waiting = list(range(len(children)))
+        futures = {}
+        success = True
+        with ThreadPoolExecutor(max_workers=len(children), thread_name_prefix=f'dag[{self.name}]') as executor:
+            while True:
+                if success:
+                    ready = [index for index in waiting if dependencies[index] <= finished]
+                    for index in ready:
+                        waiting.remove(index)
+                        futures[executor.submit(self._run_step, index, children[index], ctx)] = index
+                if not futures:
+                    break
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = futures.pop(future)
+                    step, step_result, error, path = future.result()
+                    results[index] = step_result
+                    if step is None or not self._end_step(index, step, step_result, error, path, None):
+                        # fail fast: running steps are waited, the waiting ones are not started
                         success = False
-                        break
-            except Exception as e:
-                step_result.success = False
-                step_result.execute_error = repr(e)
-                self.logger.exception('end [error:run] [%s]: %r\n', path, e)
-                if not step.continue_when_failed:
-                    success = False
+                    finished.add(index)
+
+        # results in the order of children
+        for index in sorted(results):
+            summary.add_step_result(index, results[index])
+        summary.success = success
+        return success
+
+    def _run_steps_parallel(self, children: List[Dict[Text, Any]], summary: TaskSummary, ctx: Context) -> bool:
+        """run children concurrently, and join them by join policy of parallel_config.
+        children not started yet are cancelled once the result is known.
+
+        every child runs in its own fork of the context, e.g. loop_index and loop_param of LOOP children
+        are not overwritten by each other. after the join, variables exported by the children that ran
+        (extract_result_to, variables of PARAM_SET) are merged back in the order of children,
+        so the later child wins if two children export the same variable.
+        variables set inside LOOP, PARALLEL and SQL_TRANSACTION children are not exported,
+        functions loaded by SCRIPT_LOAD children are merged back.
+        """
+        required_successes = self.parallel_config.get_required_successes()
+        max_concurrency = self.parallel_config.max_concurrency or len(children)
+        results: Dict[int, StepResult] = {}
+        successes = 0
+        failures = 0
+        waiting = list(enumerate(children))
+        child_contexts = [ctx.fork() for _ in children]
+        futures = {}
+        executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix=f'parallel[{self.name}]')
+        try:
+            while True:
+                # children are submitted only when there are idle workers, so that they can be cancelled in time
+                while waiting and len(futures) < max_concurrency:
+                    index, config = waiting.pop(0)
+                    futures[executor.submit(self._run_step, index, config, child_contexts[index])] = index
+                if not futures:
                     break
-            finally:
-                step_result.time_stat.end_at = unix_now()
-                step_result.time_stat.end_at_str = str_now()
-                summary.step_results.append(step_result)
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = futures.pop(future)
+                    step, step_result, error, path = future.result()
+                    results[index] = step_result
+                    if step is not None and self._end_step(index, step, step_result, error, path, None) \
+                            and step_result.success:
+                        successes += 1
+                    elif step is None or not step.continue_when_failed:
+                        failures += 1
+                    # children failed with continue_when_failed are neither success nor failure
+                if successes >= required_successes or failures > len(children) - required_successes:
+                    break
+        finally:
+            # running children are waited, the ones not started are not run
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        for future, index in futures.items():
+            if not future.cancelled():
+                step, step_result, error, path = future.result()
+                if step is not None:
+                    self._end_step(index, step, step_result, error, path, None)
+                results[index] = step_result
+        for index in sorted(results):
+            summary.add_step_result(index, results[index])
+            # a leaf step sets the variables it exports only
+            names = () if children[index].get('type') in _CONTAINER_TYPES else None
+            ctx.merge(child_contexts[index], names)
+        success = successes >= required_successes or \
+            (self.parallel_config.join == JoinPolicy.ALL and failures == 0)
+        summary.success = success
+        return success
+
+    def _run_step(self, index: int, config: Dict[Text, Any], ctx: Context) -> Tuple[Optional[StepBase], StepResult,
+                                                                                      Optional[Exception], Text]:
+        # build and run step, the result is recorded by caller, e.g. in another thread
+        step, step_result, path = self._start_step(index, config, ctx)
+        if step is None:
+            return step, step_result, None, path
+        try:
+            return step, step.run(), None, path
+        except Exception as e:
+            return step, step_result, e, path
+
+    async def _run_steps_async(self, children: List[Dict[Text, Any]], summary: TaskSummary,
+                               ctx: Context = None) -> bool:
+        ctx = ctx or self.ctx
+        if self.parallel_config is not None or (self.loop_config.schedule == Schedule.DAG and len(children) > 1):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self._run_steps, children, summary, ctx)
+        success = True
+        for index, config in enumerate(children):
+            step, step_result, path = self._start_step(index, config, ctx)
+            if step is None:
+                summary.add_step_result(index, step_result)
+                return False
+            try:
+                step_result = await step.run_async()
+                error = None
+            except Exception as e:
+                error = e
+            if not self._end_step(index, step, step_result, error, path, summary):
+                success = False
+                break
         summary.success = success
         return success
 
-    def build_step(self, config: dict) -> StepBase:
-        cfg = StepConfigBase(**config)
-        if cfg.type == StepTypeEnum.HTTP:
-            step = StepHttp()
-        elif cfg.type == StepTypeEnum.SQL_SELECT:
-            step = StepSqlSelect()
-        elif cfg.type == StepTypeEnum.SQL_UPDATE:
-            step = StepSqlUpdate()
-        elif cfg.type == StepTypeEnum.SQL_INSERT:
-            step = StepSqlInsert()
-        elif cfg.type == StepTypeEnum.SQL_DELETE:
-            step = StepSqlDelete()
-        elif cfg.type == StepTypeEnum.REDIS_GET:
-            step = StepRedisGet()
-        elif cfg.type == StepTypeEnum.REDIS_SET:
-            step = StepRedisSet()
-        elif cfg.type == StepTypeEnum.REDIS_DELETE:
-            step = StepRedisDelete()
-        elif cfg.type == StepTypeEnum.PARAM_SET:
-            step = StepParamSet()
-        elif cfg.type == StepTypeEnum.SCRIPT_LOAD:
-            step = StepScriptLoad()
+    def _start_step(self, index: int, config: Dict[Text, Any], ctx: Context) -> Tuple[Optional[StepBase],
+                                                                                        StepResult, Text]:
+        """build step of children[index], step is None if config is invalid."""
+        step_name = config['name']
+        path = self.get_full_path() + f' > {step_name}'
+        step_result = StepResult()
+        step_result.time_stat.start_at = unix_now()
+        step_result.time_stat.start_at_str = str_now()
+        step_result.name = step_name
+        self.logger.info('start [%s]', path)
+        try:
+            step = self._build_planned_step(index, config, ctx)
+            step_result.type = step.type
+        except Exception as e:
+            self.logger.exception('build step[%s] error: %r', step_name, e)
+            step_result.success = False
+            step_result.config_error = repr(e)
+            step_result.time_stat.end_at = unix_now()
+            step_result.time_stat.end_at_str = str_now()
+            self.logger.error('end [error:init] [%s]: %r\n', path, e)
+            return None, step_result, path
+        return step, step_result, path
+
+    def _end_step(self, index: int, step: StepBase, step_result: StepResult, error: Optional[Exception],
+                  path: Text, summary: Optional[TaskSummary]) -> bool:
+        """record result of step to summary if not None, return False if the following steps should not run."""
+        if error is None:
+            self.logger.info('end [%s] [%s]\n', _get_result_str(step_result.success), path)
+        else:
+            step_result.success = False
+            step_result.execute_error = repr(error)
+            self.logger.error('end [error:run] [%s]: %r\n', path, error, exc_info=error)
+        step_result.time_stat.end_at = unix_now()
+        step_result.time_stat.end_at_str = str_now()
+        if summary is not None:
+            summary.add_step_result(index, step_result)
+        return step_result.success or step.continue_when_failed
+
+    def _get_step_plan(self, index: int, config: Dict[Text, Any]) -> StepPlan:
+        step_plan = self.step_plans[index]
+        if step_plan is None:
+            step_plan = StepPlan(config)
+            self.step_plans[index] = step_plan
+        return step_plan
+
+    def _build_planned_step(self, index: int, config: Dict[Text, Any], ctx: Context) -> StepBase:
+        step_plan = self._get_step_plan(index, config)
+        if step_plan.prototype is not None:
+            # per-run fields of the prototype are replaced, the rest is shared by the copies
+            step = copy.copy(step_plan.prototype)
+            step.ctx = ctx
+            step.parent = self
+            return step
+
+        self.logger.debug('config before parsed: %s', config)
+        config = ctx.evaluate(step_plan.compiled_config)
+        self.logger.debug('config after parsed: %s', config)
+        if step_plan.step_config is not None:
+            cfg = step_plan.step_config.copy(update={'config': config.get('config')})
+        else:
+            cfg = StepConfigBase(**config)
+        step = self._init_step(cfg, ctx)
+
+        if step_plan.compiled_config.is_constant() and step.reusable:
+            step_plan.prototype = copy.copy(step)
+        elif step_plan.constant_header:
+            step_plan.step_config = cfg
+        return step
+
+    def build_step(self, config: dict, ctx: Context = None) -> StepBase:
+        return self._init_step(StepConfigBase(**config), ctx)
+
+    def _init_step(self, cfg: StepConfigBase, ctx: Context = None) -> StepBase:
+        ctx = ctx or self.ctx
+        if cfg.type in STEP_CLASSES:
+            step = STEP_CLASSES[cfg.type]()
         elif cfg.type == StepTypeEnum.LOOP:
             loop_config = LoopConfig(**cfg.config)
+            if loop_config.summary_mode is None:
+                loop_config.summary_mode = self.loop_config.summary_mode
             step = Task(name=cfg.name,
                         logger=self.logger,
                         log_file=self.log_file,
                         loop_config=loop_config,
                         task_type=TaskType.LOOP,
-                        ctx=self.ctx
+                        ctx=ctx
+                        )
+            step.indent = self.indent + INDENT
+        elif cfg.type == StepTypeEnum.PARALLEL:
+            parallel_config = ParallelConfig(**cfg.config)
+            step = Task(name=cfg.name,
+                        logger=self.logger,
+                        log_file=self.log_file,
+                        task_type=TaskType.PARALLEL,
+                        ctx=ctx,
+                        parallel_config=parallel_config
+                        )
+            step.indent = self.indent + INDENT
+        elif cfg.type == StepTypeEnum.SQL_TRANSACTION:
+            transaction_config = TransactionConfig(**cfg.config)
+            step = Task(name=cfg.name,
+                        logger=self.logger,
+                        log_file=self.log_file,
+                        task_type=TaskType.TRANSACTION,
+                        ctx=ctx,
+                        transaction_config=transaction_config
                         )
             step.indent = self.indent + INDENT
         else:
             raise Exception(f"invalid step type: {cfg.type}")
 
         step.parent = self
-        step.init(config=cfg, logger=self.logger, log_file=self.log_file, ctx=self.ctx)
+        step.init(config=cfg, logger=self.logger, log_file=self.log_file, ctx=ctx)
         step.validate_config()
         return step
+
+
+class _LoopCollector(object):
+    """collect results of loops running concurrently, in loop order if ordered."""
+
+    def __init__(self, summary: TaskSummary, ordered: bool):
+        self.summary = summary
+        self.ordered = ordered
+        self.success = True
+        # variables set by loops, set to context after all loops finished
+        self.variables: Dict[Text, Any] = {}
+        self._next_seq = 0
+        self._pending: Dict[int, Tuple[bool, List[StepResult], Dict[Text, Any]]] = {}
+
+    def add(self, seq: int, success: bool, step_results: List[StepResult], variables: Dict[Text, Any]):
+        if not success:
+            self.success = False
+        if not self.ordered:
+            self._merge(step_results, variables)
+            return
+
+        self._pending[seq] = (success, step_results, variables)
+        while self._next_seq in self._pending:
+            _, step_results, variables = self._pending.pop(self._next_seq)
+            self._merge(step_results, variables)
+            self._next_seq += 1
+
+    def flush(self):
+        # loops after a cancelled one
+        for seq in sorted(self._pending):
+            _, step_results, variables = self._pending.pop(seq)
+            self._merge(step_results, variables)
+
+    def _merge(self, step_results: List[StepResult], variables: Dict[Text, Any]):
+        self.summary.loop_count += 1
+        for index, step_result in enumerate(step_results):
+            self.summary.add_step_result(index, step_result)
+        self.variables.update(variables)
+
+
+class CoalescedInsertError(Exception):
+    """error of a row inserted by _InsertCoalescer, with the index of the loop which rendered the row."""
+
+    def __init__(self, loop_index: Any, error: Exception):
+        super().__init__(f'[loop:{loop_index}] {error!r}')
+        self.loop_index = loop_index
+        self.error = error
+
+
+class _InsertCoalescer(object):
+    """buffer rows of SQL_INSERT children of a serial loop, and insert them by multi-row statements.
+
+    rows are inserted when batch_size rows are buffered and after all loops finished,
+    results are recorded then, but with the loops of the rows, in the places they would have if run one by one.
+    if a statement fails, its rows are inserted one by one, so that errors are recorded with the loops of the rows,
+    and the rows after a failed one are not inserted unless the step continues when failed.
+    """
+
+    def __init__(self, task: 'Task', indexes: Set[int], batch_size: int, summary: TaskSummary):
+        self.task = task
+        self.indexes = indexes
+        self.batch_size = batch_size
+        self.summary = summary
+        # index of the running loop, set by task
+        self.loop_index = None
+        self._rows: List[_CoalescedRow] = []
+
+    def add(self, index: int, step: StepSqlInsert, step_result: StepResult, path: Text) -> bool:
+        """buffer the row of step, return False if the following steps should not run."""
+        self._rows.append(_CoalescedRow(index, step, step_result, path, self.loop_index, self.summary.loop_count,
+                                        len(self.summary.step_results)))
+        if len(self._rows) >= self.batch_size:
+            return self.flush()
+        return True
+
+    def flush(self) -> bool:
+        """insert buffered rows, return False if a row failed and the following steps should not run."""
+        rows, self._rows = self._rows, []
+        # rows of different tables or fields are inserted by different statements
+        groups: Dict[Tuple[int, Text], List[_CoalescedRow]] = {}
+        for row in rows:
+            groups.setdefault((row.step.sql_insert_config.meta_id, row.step.sql_head), []).append(row)
+        for (meta_id, sql_head), group in groups.items():
+            self._insert(meta_id, sql_head, group)
+        # recorded in the order of rows, every result is inserted after the results recorded before its row
+        success = True
+        recorded = 0
+        for row in rows:
+            if not self.task._end_step(row.index, row.step, row.step_result, row.error, row.path, None):
+                success = False
+            if self.summary.add_step_result(row.index, row.step_result, row.loop_count, row.position + recorded):
+                recorded += 1
+        return success
+
+    def _insert(self, meta_id: int, sql_head: Text, rows: List['_CoalescedRow']):
+        sql = sql_head + ','.join(row.step.sql_values for row in rows)
+        try:
+            with get_mysql_cursor(meta_id) as cursor:
+                cursor.execute(sql)
+                # lastrowid of a multi-row INSERT is the id of its first row
+                first_id = cursor.lastrowid
+        except Exception as e:
+            self.task.logger.warning('insert %s rows by one statement error, insert them one by one: %r',
+                                     len(rows), e)
+            self._insert_one_by_one(rows)
+            return
+
+        self.task.logger.debug('inserted %s rows by one statement, first id is %s', len(rows), first_id)
+        for offset, row in enumerate(rows):
+            if row.step.sql_insert_config.extract_result_to:
+                row.step.ctx.set_variable(row.step.sql_insert_config.extract_result_to, first_id + offset)
+            row.step_result.success = True
+
+    def _insert_one_by_one(self, rows: List['_CoalescedRow']):
+        failed = False
+        for row in rows:
+            if failed:
+                row.error = CoalescedInsertError(row.loop_index, Exception('not inserted, a previous row failed'))
+                continue
+            try:
+                row.step_result = row.step.run()
+            except Exception as e:
+                row.error = CoalescedInsertError(row.loop_index, e)
+            if (row.error is not None or not row.step_result.success) and not row.step.continue_when_failed:
+                failed = True
+
+
+class _CoalescedRow(object):
+    """a row buffered by _InsertCoalescer, with the place its result is recorded."""
+    __slots__ = ('index', 'step', 'step_result', 'path', 'loop_index', 'loop_count', 'position', 'error')
+
+    def __init__(self, index: int, step: StepSqlInsert, step_result: StepResult, path: Text, loop_index: Any,
+                 loop_count: int, position: int):
+        self.index = index
+        self.step = step
+        self.step_result = step_result
+        self.path = path
+        self.loop_index = loop_index
+        # loop_count of summary and length of step_results when the row was buffered
+        self.loop_count = loop_count
+        self.position = position
+        self.error: Optional[Exception] = None
+
+
+def _get_step_variables(config: Dict[Text, Any]) -> Tuple[Set[Text], Optional[Set[Text]]]:
+    # variables read and written by step, written variables are None if unknown
+    step_config = config.get('config')
+    reads = {name.split('.')[0] for name in extract_ordered_variables(step_config)}
+    step_type = config.get('type')
+    if step_type in (StepTypeEnum.SCRIPT_LOAD, StepTypeEnum.LOOP, StepTypeEnum.PARALLEL,
+                     StepTypeEnum.SQL_TRANSACTION) or not isinstance(step_config, Mapping):
+        # functions are loaded, or variables are written by children
+        return reads, None
+    if step_type == StepTypeEnum.PARAM_SET:
+        writes = set(step_config)
+    else:
+        extract_result_to = step_config.get('extract_result_to')
+        writes = {extract_result_to} if extract_result_to else set()
+    if any('$' in str(name) for name in writes):
+        # e.g. "extract_result_to": "$name"
+        return reads, None
+    return reads, writes
+
+
+def get_steps_dependencies(children: List[Dict[Text, Any]]) -> List[Set[int]]:
+    """indexes of the previous children every child depends on, for dag schedule.
+
+    a child depends on a previous one if it reads variables written by the previous one,
+    or writes variables read or written by the previous one.
+    SCRIPT_LOAD, LOOP, PARALLEL and SQL_TRANSACTION are barriers, they depend on all previous children and the following ones depend on them.
+
+    Examples:
+        >>> get_steps_dependencies([
+        ...     {'type': 'SQL_SELECT', 'config': {'where': 'id = 1', 'extract_result_to': 'a'}},
+        ...     {'type': 'SQL_SELECT', 'config': {'where': 'id = 2', 'extract_result_to': 'b'}},
+        ...     {'type': 'HTTP', 'config': {'url': 'http://example.com/$a/$b'}},
+        ... ])
+        [set(), set(), {0, 1}]
+
+    """
+    steps_variables = [_get_step_variables(config) for config in children]
+    dependencies = []
+    for index, (reads, writes) in enumerate(steps_variables):
+        depends = set()
+        for previous, (previous_reads, previous_writes) in enumerate(steps_variables[:index]):
+            if writes is None or previous_writes is None \
+                    or reads & previous_writes or writes & previous_reads or writes & previous_writes:
+                depends.add(previous)
+        dependencies.append(depends)
+    return dependencies
+
+
+# steps running children, variables set by the children are not exported
+_CONTAINER_TYPES = frozenset((StepTypeEnum.LOOP, StepTypeEnum.PARALLEL, StepTypeEnum.SQL_TRANSACTION))
+
+def _is_free_of_side_effects(config: Dict[Text, Any]) -> bool:
+    # SQL_INSERT, and PARAM_SET calling no function, neither read rows nor have effects out of the loop
+    if config.get('type') == StepTypeEnum.SQL_INSERT:
+        return True
+    return config.get('type') == StepTypeEnum.PARAM_SET and not function_regex_compile.search(str(config))
+
+
+def get_coalescable_inserts(children: List[Dict[Text, Any]]) -> Set[int]:
+    """indexes of SQL_INSERT children whose rows can be buffered and inserted by multi-row statements in a loop.
+
+    rows are inserted after the following children and loops ran, so only SQL_INSERT and PARAM_SET children
+    calling no function are allowed, any other child, e.g. SQL_SELECT, HTTP or a function, may depend on the rows.
+    a SQL_INSERT child can be coalesced if extract_result_to is not set or not read by any child.
+
+    Examples:
+        >>> get_coalescable_inserts([
+        ...     {'type': 'PARAM_SET', 'config': {'name': 'user_$loop_index'}},
+        ...     {'type': 'SQL_INSERT', 'config': {'insert_fields': {'name': '$name'}, 'extract_result_to': 'id'}},
+        ...     {'type': 'SQL_INSERT', 'config': {'insert_fields': {'user_id': '$id'}}},
+        ... ])
+        {2}
+
+    """
+    if not all(_is_free_of_side_effects(config) for config in children):
+        return set()
+    reads = set()
+    for config in children:
+        reads.update(_get_step_variables(config)[0])
+    indexes = set()
+    for index, config in enumerate(children):
+        step_config = config.get('config')
+        if config.get('type') != StepTypeEnum.SQL_INSERT or not isinstance(step_config, Mapping):
+            continue
+        extract_result_to = step_config.get('extract_result_to')
+        if extract_result_to and ('$' in str(extract_result_to) or extract_result_to in reads):
+            continue
+        indexes.add(index)
+    return indexes
+
+
+class _LoopShard(object):
+    """a part of loops, which is picklable and generates loops lazily in worker process."""
+    # list or range, loop_index is the index
+    SEQUENCE = 0
+    # (key, value) of mapping, loop_index is the key
+    ITEMS = 1
+    # cartesian product of parameters
+    PARAMETERS = 2
+
+    def __init__(self, kind: int, source: Sequence, offset: int):
+        self.kind = kind
+        self.source = source
+        self.offset = offset
+
+    def __len__(self) -> int:
+        return len(self.source)
+
+    def __iter__(self):
+        if self.kind == _LoopShard.ITEMS:
+            for key, value in self.source:
+                yield {'loop_index': key, 'loop_param': value}
+        elif self.kind == _LoopShard.PARAMETERS:
+            for index, parameter in enumerate(self.source, self.offset):
+                yield {**parameter, 'loop_index': index, 'loop_param': parameter}
+        else:
+            for index, value in enumerate(self.source, self.offset):
+                yield {'loop_index': index, 'loop_param': value}
+
+
+def _get_picklable_variables(variables: Dict[Text, Any]) -> Dict[Text, Any]:
+    # e.g. modules and generators can not be passed to another process
+    picklable_variables = {}
+    for key, value in variables.items():
+        try:
+            pickle.dumps(value)
+        except Exception:
+            continue
+        picklable_variables[key] = value
+    return picklable_variables
+
+
+def _run_loop_shard(path: Text, loop_config: LoopConfig, variables: Dict[Text, Any], scripts: List[Text],
+                    shard: _LoopShard) -> Tuple[TaskSummary, Dict[Text, Any], Text]:
+    """run in worker process, return summary, variables set by loops and log of the shard."""
+    log_file = get_task_log_file(get_uuid())
+    logger = get_task_logger(log_file=log_file, level='DEBUG', name=log_file)
+    ctx = Context()
+    for script in scripts:
+        ctx.load_script(script)
+    ctx.set_variables(variables)
+    ctx = ctx.fork()
+    task = Task(name=path, logger=logger, log_file=log_file, loop_config=loop_config,
+                task_type=TaskType.LOOP, ctx=ctx)
+    summary = task._new_summary()
+    try:
+        task._run_loops(iter(shard), False, summary)
+    except Exception as e:
+        logger.exception('run shard error: %s', e)
+        summary.success = False
+        summary.error = repr(e)
+    finally:
+        for handler in list(logger.handlers):
+            handler.close()
+            logger.removeHandler(handler)
+    log = read_file(log_file) or ''
+    os.remove(log_file)
+    return summary, _get_picklable_variables(ctx.get_local_variables()), log
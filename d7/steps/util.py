@@ -1,17 +1,22 @@
 # -*- coding: utf-8 -*-
 
 import contextlib
+import functools
 import json
 import re
 import string
-from typing import Optional
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
 from typing import Text
 
 import pymysql
 from pydantic import BaseModel
-from pymysql import cursors
+from pymysql import converters, cursors
 
 from d7.core.logger import logger
+from d7.steps.mysql_pool import MySQLPool, get_mysql_pool
 from d7.steps.uncurl import parse
 
 
@@ -24,13 +29,97 @@ class MetaConfigRedis(BaseModel):
 
 _fetch_meta_func = None
 
+META_CACHE_TTL = 60
+META_CACHE_ERROR_TTL = 5
+
+
+class MetaCache(object):
+    """a thread-safe TTL cache of meta configs, concurrent misses of the same key share one load."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> (expire_at, value)
+        self._entries = {}
+        # key -> Future of the running load
+        self._loading = {}
+
+    def get(self, key, load: Callable[[], Tuple[object, float]]):
+        """get value of key, load returns value and its ttl on miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                return entry[1]
+            future = self._loading.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._loading[key] = future
+        if not owner:
+            return future.result()
+
+        try:
+            value, ttl = load()
+        except BaseException as e:
+            with self._lock:
+                self._finish_loading(key, future)
+            future.set_exception(e)
+            raise
+        with self._lock:
+            # not cached if invalidated during loading
+            if self._finish_loading(key, future) and ttl > 0:
+                self._entries[key] = (time.monotonic() + ttl, value)
+        future.set_result(value)
+        return value
+
+    def _finish_loading(self, key, future: Future) -> bool:
+        # a load started after invalidate() may be running, its future is kept
+        if self._loading.get(key) is not future:
+            return False
+        del self._loading[key]
+        return True
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                self._loading.clear()
+            else:
+                self._entries.pop(key, None)
+                self._loading.pop(key, None)
+
+
+_meta_cache = MetaCache()
+
 
 def set_fetch_meta_func(fetch_meta):
     global _fetch_meta_func
     _fetch_meta_func = fetch_meta
+    _meta_cache.invalidate()
+
+
+def set_meta_cache_ttl(ttl: float = META_CACHE_TTL, error_ttl: float = META_CACHE_ERROR_TTL):
+    """set ttl of meta configs, errors of fetch_meta are cached for error_ttl, 0 means no cache."""
+    global META_CACHE_TTL, META_CACHE_ERROR_TTL
+    META_CACHE_TTL = ttl
+    META_CACHE_ERROR_TTL = error_ttl
+    _meta_cache.invalidate()
+
+
+def invalidate_meta_cache(meta_id: Optional[int] = None):
+    """drop the cached meta configs of meta_id, or all if meta_id is None."""
+    if meta_id is None:
+        _meta_cache.invalidate()
+        return
+    _meta_cache.invalidate(('redis', meta_id))
+    _meta_cache.invalidate(('db', meta_id))
 
 
 def get_metaconfig_redis(meta_id: int) -> MetaConfigRedis:
+    """get the cached meta config, the returned object is shared and should not be modified."""
+    return _meta_cache.get(('redis', meta_id), functools.partial(_load_metaconfig_redis, meta_id))
+
+
+def _load_metaconfig_redis(meta_id: int) -> Tuple[MetaConfigRedis, float]:
     config = {
         'host': '127.0.0.1',
         'port': 6379,
@@ -39,20 +128,20 @@ def get_metaconfig_redis(meta_id: int) -> MetaConfigRedis:
     global _fetch_meta_func
     if _fetch_meta_func is None:
         logger.info('_fetch_meta_func is None, use default config')
-        return MetaConfigRedis(**config)
+        return MetaConfigRedis(**config), META_CACHE_TTL
     c, err = _fetch_meta_func(meta_id=meta_id)
     if err is not None:
         logger.error('fetch_meta error: %s, use default config', err)
-        return MetaConfigRedis(**config)
+        return MetaConfigRedis(**config), META_CACHE_ERROR_TTL
 
     c = json.loads(c.config)
     if type(c) == type([]):
-        return MetaConfigRedis(**c[0])
+        return MetaConfigRedis(**c[0]), META_CACHE_TTL
     if type(c) == type({}):
-        return MetaConfigRedis(**c)
+        return MetaConfigRedis(**c), META_CACHE_TTL
     logger.info("meta type is: %s", type(c))
 
-    return MetaConfigRedis(**config)
+    return MetaConfigRedis(**config), META_CACHE_TTL
 
 
 class MetaConfigDB(BaseModel):
@@ -61,9 +150,17 @@ class MetaConfigDB(BaseModel):
     host: Text
     port: int = 3306
     database: Text
+    charset: Text = 'utf8mb4'
+    # allow LOAD DATA LOCAL INFILE, the server can read any file of the client when it is enabled, see SQL_LOAD
+    local_infile: bool = False
 
 
 def get_metaconfig_db(meta_id: int) -> MetaConfigDB:
+    """get the cached meta config, the returned object is shared and should not be modified."""
+    return _meta_cache.get(('db', meta_id), functools.partial(_load_metaconfig_db, meta_id))
+
+
+def _load_metaconfig_db(meta_id: int) -> Tuple[MetaConfigDB, float]:
     config = {
         'username': 'root',
         'password': 'root',
@@ -75,20 +172,20 @@ def get_metaconfig_db(meta_id: int) -> MetaConfigDB:
     global _fetch_meta_func
     if _fetch_meta_func is None:
         logger.info('_fetch_meta_func is None, use default config')
-        return MetaConfigDB(**config)
+        return MetaConfigDB(**config), META_CACHE_TTL
     c, err = _fetch_meta_func(meta_id=meta_id)
     if err is not None:
         logger.error('fetch_meta error: %s, use default config', err)
-        return MetaConfigDB(**config)
+        return MetaConfigDB(**config), META_CACHE_ERROR_TTL
 
     c = json.loads(c.config)
     if type(c) == type([]):
-        return MetaConfigDB(**c[0])
+        return MetaConfigDB(**c[0]), META_CACHE_TTL
     if type(c) == type({}):
-        return MetaConfigDB(**c)
+        return MetaConfigDB(**c), META_CACHE_TTL
     logger.info("meta type is: %s", type(c))
 
-    return MetaConfigDB(**config)
+    return MetaConfigDB(**config), META_CACHE_TTL
 
 
 def normalize_where(where: str) -> str:
@@ -101,16 +198,46 @@ def normalize_where(where: str) -> str:
 
 
 def format_sql_raw(meta_id, sql, args) -> string:
+    """render sql on client side with charset of meta config, no connection is opened."""
     meta_config = get_metaconfig_db(meta_id)
-    connection = pymysql.connect(host=meta_config.host,
-                                 port=meta_config.port,
-                                 user=meta_config.username,
-                                 password=meta_config.password,
-                                 database=meta_config.database,
-                                 cursorclass=pymysql.cursors.DictCursor)
-    with connection:
-        with connection.cursor() as cursor:
-            return format_sql(cursor, sql, args)
+    try:
+        return render_sql(sql, args, meta_config.charset)
+    except KeyError as e:
+        field = str(e).replace('##', '')
+        raise Exception(f'invalid param {field}, please check your sql or args') from None
+
+
+def escape_sql_value(value, charset: Text = 'utf8mb4') -> Text:
+    """escape value to sql literal, the same as Connection.escape of pymysql.
+    Notice: server mode NO_BACKSLASH_ESCAPES is not known without connection, backslashes are always escaped.
+    """
+    if isinstance(value, str):
+        return "'" + converters.escape_string(value) + "'"
+    if isinstance(value, (bytes, bytearray)):
+        return "X'" + value.hex() + "'"
+    return converters.escape_item(value, charset, mapping=converters.encoders)
+
+
+def render_sql(sql: Text, args, charset: Text = 'utf8mb4') -> Text:
+    """bind args to sql, the same as cursor.mogrify of pymysql but without connection.
+
+    Examples:
+        >>> render_sql('SELECT * FROM user_tab WHERE id = %(id)s AND name = %(name)s', {'id': 1, 'name': "a'b"})
+        "SELECT * FROM user_tab WHERE id = 1 AND name = 'a\\'b'"
+
+    """
+    if args is None:
+        return sql
+    if isinstance(args, dict):
+        args = {key: escape_sql_value(value, charset) for key, value in args.items()}
+    elif isinstance(args, (list, tuple)):
+        args = tuple(escape_sql_value(value, charset) for value in args)
+    else:
+        args = escape_sql_value(args, charset)
+    try:
+        return sql % args
+    except TypeError as e:
+        raise pymysql.err.ProgrammingError(str(e))
 
 
 def format_sql(cursor, sql, args) -> string:
@@ -122,29 +249,158 @@ def format_sql(cursor, sql, args) -> string:
     return formatted_sql
 
 
+class MySQLTransaction(object):
+    """connections used in a transaction block, one for every meta_id, committed or rolled back together.
+
+    the transaction is bound to the thread running the block, see mysql_transaction.
+    """
+
+    def __init__(self, owner: Any = None, commit_every: Optional[int] = None):
+        # the step running the block
+        self.owner = owner
+        # commit after every commit_every loops of the block
+        self.commit_every = commit_every
+        self.loop_count = 0
+        # rolled back instead of committed at the end of the block
+        self.rollback_only = False
+        # meta_id -> (pool, connection)
+        self._connections: Dict[int, Tuple[MySQLPool, pymysql.connections.Connection]] = {}
+
+    def get_connection(self, meta_id: int, pool: MySQLPool) -> pymysql.connections.Connection:
+        if meta_id not in self._connections:
+            self._connections[meta_id] = (pool, pool.acquire())
+        return self._connections[meta_id][1]
+
+    def count_loop(self) -> bool:
+        """count a finished loop of the block, return True if it's time to commit."""
+        self.loop_count += 1
+        return bool(self.commit_every) and self.loop_count % self.commit_every == 0
+
+    def commit(self):
+        for _, connection in self._connections.values():
+            connection.commit()
+
+    def rollback(self):
+        for meta_id, (_, connection) in self._connections.items():
+            try:
+                connection.rollback()
+            except Exception as e:
+                # e.g. connection is lost, the transaction is rolled back by server
+                logger.exception('rollback transaction of meta_id %s error: %s', meta_id, e)
+
+    def release(self):
+        connections, self._connections = self._connections, {}
+        for pool, connection in connections.values():
+            pool.release(connection, discard=not connection.open)
+
+
+_transaction_local = threading.local()
+
+
+def get_mysql_transaction() -> Optional[MySQLTransaction]:
+    """the transaction of current thread, None if not in a transaction block."""
+    return getattr(_transaction_local, 'transaction', None)
+
+
+@contextlib.contextmanager
+def mysql_transaction(owner: Any = None, commit_every: Optional[int] = None) -> MySQLTransaction:
+    """run SQL steps of current thread in one transaction, commit at the end,
+    or rollback if error raised or rollback_only is set.
+    a nested block joins the outer transaction.
+    """
+    transaction = get_mysql_transaction()
+    if transaction is not None:
+        yield transaction
+        return
+
+    transaction = MySQLTransaction(owner, commit_every)
+    _transaction_local.transaction = transaction
+    try:
+        yield transaction
+        if transaction.rollback_only:
+            transaction.rollback()
+        else:
+            transaction.commit()
+    except BaseException:
+        transaction.rollback()
+        raise
+    finally:
+        _transaction_local.transaction = None
+        transaction.release()
+
+
 @contextlib.contextmanager
 def get_mysql_cursor(meta_id: int) -> cursors.Cursor:
+    """checkout a connection from the pool of meta_id, commit if no error raised, otherwise rollback.
+    in a transaction block, the connection of the transaction is used, and committed by the block.
+    """
     assert meta_id, 'meta_id should not be empty'
     meta_config = get_metaconfig_db(meta_id)
-    connection = pymysql.connect(host=meta_config.host,
-                                 port=meta_config.port,
-                                 user=meta_config.username,
-                                 password=meta_config.password,
-                                 database=meta_config.database,
-                                 cursorclass=pymysql.cursors.DictCursor)
-    with connection:
-        has_err = False
+    pool = get_mysql_pool(meta_id, meta_config, functools.partial(connect_mysql, meta_config))
+    transaction = get_mysql_transaction()
+    if transaction is not None:
+        with transaction.get_connection(meta_id, pool).cursor() as cursor:
+            yield cursor
+        return
+
+    connection = pool.acquire()
+    discard = False
+    try:
         with connection.cursor() as cursor:
             try:
                 yield cursor
             except Exception as e:
                 logger.exception('cursor execute error: %s', e)
-                has_err = True
-                connection.rollback()
+                # a connection broken in the middle of a query can not be reused
+                discard = isinstance(e, (pymysql.err.OperationalError, pymysql.err.InterfaceError))
+                if not discard:
+                    connection.rollback()
                 raise e
-            finally:
-                if not has_err:
-                    connection.commit()
+        connection.commit()
+    except BaseException:
+        discard = discard or not connection.open
+        raise
+    finally:
+        pool.release(connection, discard=discard)
+
+
+def iter_mysql_rows(meta_id: int, sql: Text, fetch_size: int) -> Iterator[Dict[Text, Any]]:
+    """execute sql by a server-side cursor, and fetch rows in chunks of fetch_size.
+
+    the rows are read by a connection of its own, out of transaction if any,
+    so that other SQL steps can run while the rows are being read.
+    if the iteration is stopped halfway, the connection is closed instead of reading the rest rows.
+    """
+    assert meta_id, 'meta_id should not be empty'
+    meta_config = get_metaconfig_db(meta_id)
+    pool = get_mysql_pool(meta_id, meta_config, functools.partial(connect_mysql, meta_config))
+    connection = pool.acquire()
+    finished = False
+    try:
+        cursor = connection.cursor(cursors.SSDictCursor)
+        cursor.execute(sql)
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            yield from rows
+        cursor.close()
+        connection.commit()
+        finished = True
+    finally:
+        # server sends all rows of the query anyway, a connection with rows unread can not be reused
+        pool.release(connection, discard=not finished)
+
+
+def connect_mysql(meta_config: MetaConfigDB) -> pymysql.connections.Connection:
+    return pymysql.connect(host=meta_config.host,
+                           port=meta_config.port,
+                           user=meta_config.username,
+                           password=meta_config.password,
+                           database=meta_config.database,
+                           charset=meta_config.charset,
+                           local_infile=meta_config.local_infile,
+                           cursorclass=pymysql.cursors.DictCursor)
 
 
 def parse_curl_to_step_config(curl_command: str) -> object:
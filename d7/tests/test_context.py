@@ -46,3 +46,20 @@ def add(a, b):
         b = ctx.parse_data('${add($a, b=$c)}')
         self.assertTrue(isinstance(b, int))
         self.assertEqual(10, b)
+
+    def test_functions_table(self):
+        ctx = Context()
+        functions_table = ctx.get_functions_table()
+        self.assertIs(functions_table, ctx.get_functions_table())
+        self.assertIs(functions_table['get_timestamp'], ctx.get_function('get_timestamp'))
+        self.assertIs(sum, ctx.get_function('sum'))
+        self.assertEqual('${ENV(HOME)}', ctx.parse_data('$${ENV(HOME)}'))
+        self.assertNotIn('mul', functions_table)
+
+        # table is rebuilt after script loaded
+        ctx.load_script('''
+def mul(a, b):
+    return a * b
+''')
+        self.assertIsNot(functions_table, ctx.get_functions_table())
+        self.assertEqual(6, ctx.parse_data('${mul(2, 3)}'))
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import unittest
+from unittest import mock
+
+import pymysql
+
+from d7.steps import mysql_pool
+from d7.steps.mysql_pool import MySQLPool, get_mysql_pool_stats, close_mysql_pools
+from d7.steps.util import get_mysql_cursor
+
+
+class FakeCursor(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.open = True
+        self.broken = False
+        self.commits = 0
+        self.rollbacks = 0
+
+    def ping(self, reconnect=True):
+        if self.broken:
+            raise pymysql.err.OperationalError(2006, 'MySQL server has gone away')
+
+    def cursor(self):
+        return FakeCursor()
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.open = False
+
+
+class MySQLPoolTestCase(unittest.TestCase):
+    def tearDown(self):
+        close_mysql_pools()
+
+    def test_reuse(self):
+        pool = MySQLPool(FakeConnection, max_size=2)
+        c1 = pool.acquire()
+        pool.release(c1)
+        c2 = pool.acquire()
+        self.assertIs(c1, c2)
+        pool.release(c2)
+        stats = pool.stats()
+        self.assertEqual(2, stats.checkouts)
+        self.assertEqual(1, stats.created)
+        self.assertEqual(1, stats.idle)
+        self.assertEqual(0, stats.in_use)
+
+    def test_max_size(self):
+        pool = MySQLPool(FakeConnection, max_size=1, wait_timeout=0.05)
+        c1 = pool.acquire()
+        with self.assertRaises(TimeoutError):
+            pool.acquire()
+
+        threading.Timer(0.02, pool.release, args=(c1,)).start()
+        pool.wait_timeout = 5
+        self.assertIs(c1, pool.acquire())
+        stats = pool.stats()
+        self.assertEqual(1, stats.created)
+        self.assertEqual(1, stats.waits)
+        self.assertGreater(stats.max_wait_time, 0)
+
+    def test_idle_timeout(self):
+        pool = MySQLPool(FakeConnection, min_size=1, max_size=3, idle_timeout=0.01)
+        connections = [pool.acquire() for _ in range(3)]
+        for c in connections:
+            pool.release(c)
+        time.sleep(0.02)
+        c = pool.acquire()
+        # the latest released one is kept as min_size
+        self.assertIs(connections[-1], c)
+        self.assertEqual([False, False, True], [c.open for c in connections])
+        self.assertEqual(2, pool.stats().closed)
+
+    def test_reconnect(self):
+        pool = MySQLPool(FakeConnection)
+        c1 = pool.acquire()
+        pool.release(c1)
+        c1.broken = True
+        c2 = pool.acquire()
+        self.assertIsNot(c1, c2)
+        self.assertFalse(c1.open)
+        stats = pool.stats()
+        self.assertEqual(1, stats.reconnects)
+        self.assertEqual(1, stats.in_use)
+
+    def test_get_mysql_cursor(self):
+        with mock.patch('d7.steps.util.connect_mysql', side_effect=lambda _: FakeConnection()) as connect:
+            for _ in range(3):
+                with get_mysql_cursor(1):
+                    pass
+            with self.assertRaises(ValueError):
+                with get_mysql_cursor(1):
+                    raise ValueError('bad sql')
+            with self.assertRaises(pymysql.err.OperationalError):
+                with get_mysql_cursor(1):
+                    raise pymysql.err.OperationalError(2013, 'Lost connection')
+            with get_mysql_cursor(1):
+                pass
+        self.assertEqual(2, connect.call_count)
+        stats = get_mysql_pool_stats()[1]
+        self.assertEqual(6, stats.checkouts)
+        self.assertEqual(1, stats.closed)
+        self.assertEqual(1, stats.idle)
+
+    def test_reset_in_child(self):
+        with mock.patch('d7.steps.util.connect_mysql', side_effect=lambda _: FakeConnection()):
+            with get_mysql_cursor(1):
+                pass
+        self.assertIn(1, get_mysql_pool_stats())
+        mysql_pool._reset_pools_in_child()
+        self.assertEqual({}, get_mysql_pool_stats())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,7 +5,8 @@ import time
 import unittest
 
 from d7.core import parser, loader
-from d7.core.exceptions import VariableNotFound, FunctionNotFound
+from d7.core.exceptions import VariableNotFound, FunctionNotFound, VariablePointToSelf, \
+    VariableCircularReference
 from d7.core.parser import parse_string, is_variable_exists
 
 
@@ -45,6 +46,9 @@ class TestParserBasic(unittest.TestCase):
         self.assertEqual(parser.regex_findall_variables("Z:2>1*0*1+1$a"), ["a"])
         self.assertEqual(parser.regex_findall_variables("Z:2>1*0*1+1$$a"), [])
         self.assertEqual(parser.regex_findall_variables("Z:2>1*0*1+1$$$a"), ["a"])
+        self.assertEqual(parser.regex_findall_variables("$var1$var2"), ["var1", "var2"])
+        self.assertEqual(parser.regex_findall_variables("${var1}${var2}"), ["var1", "var2"])
+        self.assertEqual(parser.regex_findall_variables("$var1$$$var2"), ["var1", "var2"])
         self.assertEqual(parser.regex_findall_variables("Z:2>1*0*1+1$$$$a"), [])
         self.assertEqual(parser.regex_findall_variables("Z:2>1*0*1+1$$a$b"), ["b"])
         self.assertEqual(parser.regex_findall_variables("Z:2>1*0*1+1$$a$$b"), [])
@@ -115,6 +119,71 @@ class TestParserBasic(unittest.TestCase):
         result = parse_string(raw_string, variables_mapping, functions_mapping)
         self.assertEqual("abc4def", result)
 
+    def test_compile_string(self):
+        compiled = parser.compile_string("abc$num/${add_one($num)}def$$")
+        self.assertIs(compiled, parser.compile_string("abc$num/${add_one($num)}def$$"))
+        self.assertFalse(compiled.is_constant())
+        self.assertIsNone(compiled.whole)
+        self.assertEqual(parser.TOKEN_LITERAL, compiled.tokens[0][0])
+        self.assertEqual(parser.TOKEN_VARIABLE, compiled.tokens[1][0])
+        self.assertEqual("num", compiled.tokens[1][1].variable_name)
+        self.assertEqual(parser.TOKEN_FUNCTION, compiled.tokens[3][0])
+        self.assertEqual((parser.TOKEN_LITERAL, "def$"), compiled.tokens[4])
+
+        functions_mapping = {"add_one": lambda x: x + 1}
+        self.assertEqual("abc3/4def$", compiled.evaluate({"num": 3}, functions_mapping))
+        self.assertEqual("abc5/6def$", compiled.evaluate({"num": 5}, functions_mapping))
+
+        self.assertTrue(parser.compile_string("abc$$var").is_constant())
+        self.assertEqual("abc$var", parser.compile_string("abc$$var").evaluate({}, {}))
+
+        # raw string is exactly a variable or a function, value is not converted to str
+        self.assertEqual(4, parser.compile_string("${add_one(3)}").evaluate({}, functions_mapping))
+        self.assertEqual({"a": 1}, parser.compile_string("${var}").evaluate({"var": {"a": 1}}, {}))
+
+    def test_compile_data(self):
+        raw_data = {
+            "url": "/api/users/$uid",
+            "method": " POST\t",
+            "headers": {"token": "abc", "escaped": "$$token"},
+            "data": ["${add_one($uid)}", 1, None],
+            "children": [{"name": "$not_parsed"}],
+        }
+        functions_mapping = {"add_one": lambda x: x + 1}
+        compiled = parser.compile_data(raw_data)
+        self.assertFalse(compiled.is_constant())
+
+        result = compiled.evaluate({"uid": 1000}, functions_mapping)
+        self.assertEqual(parser.parse_data(raw_data, {"uid": 1000}, functions_mapping), result)
+        self.assertEqual("/api/users/1000", result["url"])
+        self.assertEqual("POST", result["method"])
+        self.assertEqual({"token": "abc", "escaped": "$token"}, result["headers"])
+        self.assertEqual([1001, 1, None], result["data"])
+        self.assertIs(raw_data["children"], result["children"])
+
+        # constant lists and dicts are rebuilt, so that they can be modified safely
+        result["headers"]["token"] = "modified"
+        result2 = compiled.evaluate({"uid": 2000}, functions_mapping)
+        self.assertEqual("/api/users/2000", result2["url"])
+        self.assertEqual({"token": "abc", "escaped": "$token"}, result2["headers"])
+        self.assertIsNot(result["headers"], result2["headers"])
+
+        self.assertTrue(parser.compile_data({"a": ["b", 1], "c": "$$d"}).is_constant())
+
+    def test_compile_data_ignore_keys(self):
+        raw_data = {"config": {"row_template": {"name": "$name"}, "table": "$table"}}
+        variables_mapping = {"name": "a", "table": "t"}
+        # row_template is rendered unless it is ignored
+        self.assertEqual({"config": {"row_template": {"name": "a"}, "table": "t"}},
+                         parser.compile_data(raw_data).evaluate(variables_mapping))
+        self.assertEqual({"config": {"row_template": {"name": "a"}, "table": "t"}},
+                         parser.parse_data(raw_data, variables_mapping))
+
+        ignore_keys = parser.ignore_variables | {"row_template"}
+        expected = {"config": {"row_template": {"name": "$name"}, "table": "t"}}
+        self.assertEqual(expected, parser.compile_data(raw_data, ignore_keys).evaluate(variables_mapping))
+        self.assertEqual(expected, parser.parse_data(raw_data, variables_mapping, ignore_keys=ignore_keys))
+
     def test_is_variable_exists(self):
         variables_map = {
             "p1": 0,
@@ -130,6 +199,33 @@ class TestParserBasic(unittest.TestCase):
         self.assertTrue(is_variable_exists('p4.0.p5', variables_map))
         self.assertFalse(is_variable_exists('not_exists', variables_map))
 
+    def test_compile_variable_path(self):
+        variables_map = {
+            "p1": "0",
+            "p4": [{
+                "p5": "v5"
+            }]
+        }
+        path = parser.compile_variable_path("p4.$p1.p5")
+        self.assertIs(path, parser.compile_variable_path("p4.$p1.p5"))
+        self.assertEqual("p4", path.keys[0])
+        self.assertIsInstance(path.keys[1], parser.CompiledString)
+        self.assertEqual('[\'p4\', <CompiledString of "$p1">, \'p5\']', repr(path.keys))
+        self.assertEqual('<VariablePath of "p4.$p1.p5">', repr(path))
+        self.assertEqual("v5", path.get(variables_map, {}))
+        self.assertEqual(["p4", 0, "p5"], parser.compile_variable_path("p4.0.p5").keys)
+        self.assertEqual("v5", parser.get_mapping_variable("p4.0.p5", variables_map, {}))
+        self.assertFalse(path.exists({"p1": "0", "p4": [{}]}, {}))
+
+    def test_variable_not_found_message(self):
+        variables_map = {f"key_{i}": "v" * 1000 for i in range(1000)}
+        with self.assertRaises(VariableNotFound) as cm:
+            parser.get_mapping_variable("not_exists", variables_map, {})
+        message = str(cm.exception)
+        self.assertTrue(message.startswith("not_exists not found, variables_map={'key_0': "))
+        self.assertLessEqual(len(message), 1024 + 100)
+        self.assertTrue(repr(cm.exception).startswith('VariableNotFound("not_exists not found'))
+
     def test_parse_variables_mapping(self):
         variables = {"varA": "$varB", "varB": "$varC", "varC": "123", "a": 1, "b": 2}
         parsed_variables = parser.parse_variables_mapping(variables)
@@ -141,6 +237,42 @@ class TestParserBasic(unittest.TestCase):
         with self.assertRaises(VariableNotFound):
             parser.parse_variables_mapping(variables)
 
+    def test_parse_variables_mapping_reference(self):
+        variables = {"varA": "${add_one($varB)}", "varB": "$varC", "varC": 1, "varD": "$varA$varB"}
+        functions_mapping = {"add_one": lambda x: x + 1}
+        parsed_variables = parser.parse_variables_mapping(variables, functions_mapping)
+        self.assertEqual({"varA": 2, "varB": 1, "varC": 1, "varD": "21"}, parsed_variables)
+        self.assertEqual(list(variables), list(parsed_variables))
+
+        with self.assertRaises(VariablePointToSelf):
+            parser.parse_variables_mapping({"token": "abc$token"})
+        with self.assertRaises(VariableCircularReference):
+            parser.parse_variables_mapping({"varA": "$varB", "varB": ["$varC"], "varC": "$varA", "a": 1})
+
+        # reference global variables, which are not parsed again
+        parsed_variables = parser.parse_variables_mapping(
+            {"token": "abc$token", "url": "/api/$uid/$token"}, {}, {"token": "xyz", "uid": 1}
+        )
+        self.assertEqual({"token": "abcxyz", "url": "/api/1/abcxyz"}, parsed_variables)
+
+        # adjacent references
+        self.assertEqual(
+            {"a": "xy", "b": "x", "c": "y"}, parser.parse_variables_mapping({"a": "$b$c", "b": "x", "c": "y"})
+        )
+        self.assertEqual(
+            {"a": "xy", "b": "x", "c": "y"}, parser.parse_variables_mapping({"a": "${b}${c}", "b": "x", "c": "y"})
+        )
+        self.assertEqual(["c", "b", "a"], parser.extract_ordered_variables({"x": "$c$b", "y": ["$a", "$c"]}))
+
+    def test_sort_variables_by_reference(self):
+        self.assertEqual(
+            ["varC", "varB", "varA", "a"],
+            parser.sort_variables_by_reference({"varA": ["varB"], "varB": ["varC"], "varC": [], "a": []})
+        )
+        with self.assertRaises(VariableCircularReference) as cm:
+            parser.sort_variables_by_reference({"a": [], "varA": ["varB"], "varB": ["varA"]})
+        self.assertEqual("varA -> varB -> varA", str(cm.exception))
+
     def test_parse_data_string_with_variables(self):
         variables_mapping = {
             "var_1": "abc",
@@ -499,6 +631,8 @@ test3,333333'''
             }
             parsed_params = parser.parse_parameters(parameters, function_map)
             self.assertEqual(len(parsed_params), 2 * 3 * 2)
+            # functions mapping of caller is not modified
+            self.assertEqual(["calculate_two_nums"], list(function_map))
 
             self.assertIn(
                 {
@@ -74,3 +74,175 @@ class StepConfigValidatorTestCase(unittest.TestCase):
         with self.assertRaises(ParamsError) as cm:
             validate_step_config(config)
         self.assertTrue(cm.exception.__str__().__contains__("invalid param 'id', please check your sql or args"))
+
+    def test_validate_select_stream(self):
+        config = {
+            'name': 'test select',
+            'type': 'SQL_SELECT',
+            'config': {
+                'meta_id': 1,
+                'table': 'user_tab',
+                'where': 'id > :id',
+                'where_args': {'id': 0},
+                'limit': 100000,
+                'extract_result_to': 'users',
+            }
+        }
+        with self.assertRaises(ParamsError) as cm:
+            validate_step_config(config)
+        self.assertTrue(cm.exception.__str__().__contains__("limit should <= 2000, set stream for more rows"))
+
+        config['config']['stream'] = True
+        validate_step_config(config)
+
+    def test_validate_select_lookup(self):
+        config = {
+            'name': 'test select',
+            'type': 'SQL_SELECT',
+            'config': {
+                'meta_id': 1,
+                'table': 'user_tab',
+                'limit': 1,
+                'extract_result_to': 'user',
+            }
+        }
+        with self.assertRaises(ParamsError) as cm:
+            validate_step_config(config)
+        self.assertTrue(cm.exception.__str__().__contains__("where should not be empty"))
+
+        config['config']['lookup_key'] = 'id'
+        config['config']['lookup_value'] = 1
+        validate_step_config(config)
+
+        config['config']['stream'] = True
+        with self.assertRaises(ParamsError) as cm:
+            validate_step_config(config)
+        self.assertTrue(cm.exception.__str__().__contains__("lookup_key can not be set in stream mode"))
+
+    def test_validate_batch_insert(self):
+        config = {
+            'name': 'test batch insert',
+            'type': 'SQL_BATCH_INSERT',
+            'config': {
+                'meta_id': 1,
+                'table': 'user_tab',
+                'row_template': {'name': 'user_$row_index'},
+                'count': 10,
+            }
+        }
+        validate_step_config(config)
+
+        config['config']['rows'] = [{'name': 'a'}]
+        with self.assertRaises(ParamsError) as cm:
+            validate_step_config(config)
+        self.assertTrue(cm.exception.__str__().__contains__("only one of rows and row_template can be set"))
+
+    def test_validate_load(self):
+        config = {
+            'name': 'test load',
+            'type': 'SQL_LOAD',
+            'config': {
+                'meta_id': 1,
+                'table': 'user_tab',
+                'row_template': {'name': 'user_$row_index'},
+                'count': 10,
+                'file': 'users.csv',
+            }
+        }
+        with self.assertRaises(ParamsError) as cm:
+            validate_step_config(config)
+        self.assertTrue(cm.exception.__str__().__contains__("only one of rows, row_template and file can be set"))
+
+        del config['config']['file']
+        validate_step_config(config)
+
+    def test_validate_chunked_update(self):
+        config = {
+            'name': 'test chunked update',
+            'type': 'SQL_CHUNKED_UPDATE',
+            'config': {
+                'meta_id': 1,
+                'table': 'user_tab',
+                'update_fields': {'status': 0},
+                'where': 'status = :status',
+                'where_args': {'status': 1},
+                'chunk_size': 0,
+            }
+        }
+        with self.assertRaises(ParamsError) as cm:
+            validate_step_config(config)
+        self.assertTrue(cm.exception.__str__().__contains__("chunk_size"))
+
+        config['config']['chunk_size'] = 500
+        validate_step_config(config)
+
+    def test_validate_parallel(self):
+        config = {
+            'name': 'test parallel',
+            'type': 'PARALLEL',
+            'config': {
+                'join': 'quorum',
+                'quorum': 1,
+                'children': [{
+                    'name': 'test set param',
+                    'type': 'PARAM_SET',
+                    'config': {
+                        'param1': 'value1',
+                    }
+                }]
+            }
+        }
+        validate_step_config(config)
+
+        del config['config']['quorum']
+        with self.assertRaises(ParamsError) as cm:
+            validate_step_config(config)
+        self.assertTrue(cm.exception.__str__().__contains__("quorum should not be empty when join is quorum"))
+
+    def test_validate_transaction(self):
+        config = {
+            'name': 'test transaction',
+            'type': 'SQL_TRANSACTION',
+            'config': {
+                'children': [{
+                    'name': 'test loop',
+                    'type': 'LOOP',
+                    'config': {
+                        'loop_from': [1, 2],
+                        'children': [{
+                            'name': 'test set param',
+                            'type': 'PARAM_SET',
+                            'config': {
+                                'param1': 'value1',
+                            }
+                        }]
+                    }
+                }]
+            }
+        }
+        validate_step_config(config)
+
+        loop_config = config['config']['children'][0]['config']
+        loop_config['concurrency'] = 4
+        with self.assertRaises(ParamsError) as cm:
+            validate_step_config(config)
+        self.assertTrue(cm.exception.__str__().__contains__("concurrency of LOOP test loop should be 1"))
+
+        del loop_config['concurrency']
+        loop_config['schedule'] = 'dag'
+        with self.assertRaises(ParamsError) as cm:
+            validate_step_config(config)
+        self.assertTrue(cm.exception.__str__().__contains__("schedule of LOOP test loop should be serial"))
+
+        # children of nested loops run in the thread of the transaction too
+        del loop_config['schedule']
+        loop_config['children'] = [{
+            'name': 'test parallel',
+            'type': 'PARALLEL',
+            'config': {
+                'children': loop_config['children'],
+            }
+        }]
+        with self.assertRaises(ParamsError) as cm:
+            validate_step_config(config)
+        self.assertTrue(cm.exception.__str__().__contains__("PARALLEL test parallel can not run in SQL_TRANSACTION"))
@@ -0,0 +1,813 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+from typing import List, Text
+from unittest import mock
+
+import pymysql
+
+from d7.steps.mysql_pool import close_mysql_pools
+from d7.steps.step_sql_select import SqlRowStream
+from d7.steps.util import set_fetch_meta_func
+from d7.steps.task import Task, TaskSummary, get_coalescable_inserts
+from d7.task_maker import create_task
+
+
+class FakeCursor(object):
+    def __init__(self, connection: 'FakeConnection'):
+        self.connection = connection
+        self.rowcount = 0
+        self.lastrowid = 0
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql):
+        self.connection.statements.append(sql)
+        if self.connection.fail_on and self.connection.fail_on in sql:
+            raise pymysql.err.IntegrityError(1062, f"Duplicate entry '{self.connection.fail_on}'")
+        self.rowcount = sql.count('),(') + 1 if sql.startswith('INSERT') else 0
+        self.lastrowid = self.connection.next_id if sql.startswith('INSERT') else 0
+        self.connection.next_id += self.rowcount
+        # content of the spool file loaded, like "LOAD DATA LOCAL INFILE '/tmp/d7_load_1.tsv' ..."
+        match = re.match(r"LOAD DATA LOCAL INFILE '(.*?)'", sql)
+        if match:
+            with open(match.group(1), 'rb') as f:
+                self.connection.loaded.append(f.read())
+            self.rowcount = self.connection.loaded[-1].count(b'\n')
+        # rows of a key range, like "WHERE (age > 1) AND id BETWEEN 1 AND 2"
+        match = re.search(r'(\w+) BETWEEN (\d+) AND (\d+)$', sql)
+        if match:
+            column, first, last = match.group(1), int(match.group(2)), int(match.group(3))
+            in_range = [row for row in self.connection.rows if first <= row[column] <= last]
+            self.rowcount = len(in_range)
+            if sql.startswith('DELETE'):
+                self.connection.rows = [row for row in self.connection.rows if row not in in_range]
+        if sql.startswith('SELECT'):
+            self._rows = list(self.connection.rows)
+            # keys of the next chunk, like "WHERE (age > 1) AND id > 2 ORDER BY id LIMIT 2"
+            match = re.search(r'ORDER BY (\w+) LIMIT (\d+)$', sql)
+            if match:
+                column, limit = match.group(1), int(match.group(2))
+                match = re.search(rf'{column} > (\d+) ORDER BY', sql)
+                last_key = int(match.group(1)) if match else -1
+                self._rows = [row for row in sorted(self._rows, key=lambda r: r[column]) if row[column] > last_key]
+                self._rows = self._rows[:limit]
+            # rows of the keys looked up, like "WHERE id IN (1,2)"
+            match = re.search(r'(\w+) IN \((.*)\)$', sql)
+            if match:
+                time.sleep(self.connection.lookup_delay)
+                column, keys = match.group(1), match.group(2).split(',')
+                self._rows = [row for row in self._rows if str(row[column]) in keys]
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchmany(self, size=1):
+        self.connection.fetches.append(size)
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    """records executed statements and commits instead of talking to MySQL."""
+
+    def __init__(self):
+        self.open = True
+        self.statements = []
+        self.commits = []
+        self.rollbacks = []
+        self.next_id = 1
+        # statements containing it fail
+        self.fail_on = None
+        # rows of every SELECT, and size of every fetchmany
+        self.rows = []
+        self.fetches = []
+        self.cursor_classes = []
+        # content of every file loaded by LOAD DATA
+        self.loaded = []
+        # seconds of every lookup query
+        self.lookup_delay = 0
+
+    def ping(self, reconnect=True):
+        pass
+
+    def cursor(self, cursor=None):
+        self.cursor_classes.append(cursor)
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits.append(len(self.statements))
+
+    def rollback(self):
+        self.rollbacks.append(len(self.statements))
+
+    def close(self):
+        self.open = False
+
+
+def run_task(task_name: Text, configs: List[dict], fail_on: Text = None,
+             rows: List[dict] = None) -> (Task, TaskSummary, FakeConnection):
+    connection = FakeConnection()
+    connection.fail_on = fail_on
+    connection.rows = rows or []
+    with mock.patch('d7.steps.util.connect_mysql', return_value=connection):
+        task = create_task(task_name, configs)
+        task_summary = task.execute()
+    # connection of the next task is not taken from pool
+    close_mysql_pools()
+    return task, task_summary, connection
+
+
+class StepSqlTestCase(unittest.TestCase):
+    def test_batch_insert_rows(self):
+        task_name = sys._getframe().f_code.co_name
+        configs = [{
+            'name': 'set name',
+            'type': 'PARAM_SET',
+            'config': {
+                'name': "o'neil",
+            }
+        }, {
+            'name': 'batch insert',
+            'type': 'SQL_BATCH_INSERT',
+            'config': {
+                'meta_id': 1,
+                'table': 'user_tab',
+                'rows': [{'name': '$name', 'age': 1}, {'age': 2, 'name': 'b'}, {'name': None, 'age': 3}],
+                'chunk_size': 2,
+                'on_duplicate_update': ['age'],
+                'extract_result_to': 'result',
+            }
+        }]
+        task, task_summary, connection = run_task(task_name, configs)
+        self.assertTrue(task_summary.success, task_summary)
+        self.assertEqual([
+            "INSERT INTO user_tab (name,age) VALUES ('o\\'neil',1),('b',2) ON DUPLICATE KEY UPDATE age=VALUES(age)",
+            "INSERT INTO user_tab (name,age) VALUES (NULL,3) ON DUPLICATE KEY UPDATE age=VALUES(age)",
+        ], connection.statements)
+        # commit per chunk
+        self.assertEqual([1, 2], connection.commits)
+        result = task.ctx.get_variable('result')
+        self.assertEqual(3, result['rowcount'])
+        self.assertEqual([], result['id_ranges'])
+
+    def test_batch_insert_row_template(self):
+        task_name = sys._getframe().f_code.co_name
+        configs = [{
+            'name': 'load script',
+            'type': 'SCRIPT_LOAD',
+            'config': {
+                'script': 'def sum_two(a, b):\n    return a + b',
+            }
+        }, {
+            'name': 'batch insert',
+            'type': 'SQL_BATCH_INSERT',
+            'config': {
+                'meta_id': 1,
+                'table': 'user_tab',
+                'row_template': {'name': 'user_$row_index', 'age': '${sum_two(1, $row_index)}'},
+                'count': 10,
+                'max_allowed_packet': 1024,
+                'commit': 'batch',
+                'extract_result_to': 'result',
+            }
+        }]
+        configs[1]['config']['row_template']['remark'] = 'x' * 300
+        task, task_summary, connection = run_task(task_name, configs)
+        self.assertTrue(task_summary.success, task_summary)
+        # every row is about 330 bytes
+        self.assertEqual([3, 3, 3, 1], [sql.count('),(') + 1 for sql in connection.statements])
+        self.assertTrue(all(len(sql) <= 1024 for sql in connection.statements))
+        self.assertIn("('user_9',10,'xxx", connection.statements[-1])
+        self.assertEqual([4], connection.commits)
+        result = task.ctx.get_variable('result')
+        self.assertEqual(10, result['rowcount'])
+        self.assertEqual(1, result['first_id'])
+        self.assertEqual(10, result['last_id'])
+        self.assertEqual([(1, 3), (4, 6), (7, 9), (10, 10)], result['id_ranges'])
+        self.assertFalse(task.ctx.get_variables().get('row_index'))
+
+    def test_row_template_of_other_steps(self):
+        task_name = sys._getframe().f_code.co_name
+        configs = [{
+            'name': 'set prefix',
+            'type': 'PARAM_SET',
+            'config': {
+                'prefix': 'user',
+            }
+        }, {
+            'name': 'set spec',
+            'type': 'PARAM_SET',
+            'config': {
+                'spec': {'row_template': '${prefix}_x'},
+            }
+        }, {
+            'name': 'batch insert',
+            'type': 'SQL_BATCH_INSERT',
+            'config': {
+                'meta_id': 1,
+                'table': '${prefix}_tab',
+                'row_template': {'name': '${prefix}_$row_index'},
+                'count': 2,
+            }
+        }]
+        task, task_summary, connection = run_task(task_name, configs)
+        self.assertTrue(task_summary.success, task_summary)
+        # row_template is left to SQL_BATCH_INSERT only
+        self.assertEqual({'row_template': 'user_x'}, task.ctx.get_variable('spec'))
+        self.assertEqual(["INSERT INTO user_tab (name) VALUES ('user_0'),('user_1')"], connection.statements)
+
+    def test_batch_insert_invalid_rows(self):
+        task_name = sys._getframe().f_code.co_name
+        configs = [{
+            'name': 'batch insert',
+            'type': 'SQL_BATCH_INSERT',
+            'config': {
+                'meta_id': 1,
+                'table': 'user_tab',
+                'rows': [{'name': 'a', 'age': 1}, {'name': 'b'}],
+            }
+        }]
+        task, task_summary, connection = run_task(task_name, configs)
+        self.assertFalse(task_summary.success)
+        self.assertIn("columns of row 1 should be ['name', 'age']", str(task_summary))
+        self.assertEqual([], connection.statements)
+
+    def _get_insert_loop(self, loop_from: list, insert_batch_size: int, extract_result_to: Text = 'id'):
+        return [{
+            'name': 'loop',
+            'type': 'LOOP',
+            'config': {
+                'loop_from': loop_from,
+                'insert_batch_size': insert_batch_size,
+                'children': [{
+                    'name': 'set name',
+                    'type': 'PARAM_SET',
+                    'config': {
+                        'name': 'user_$loop_param',
+                    }
+                }, {
+                    'name': 'insert',
+                    'type': 'SQL_INSERT',
+                    'config': {
+                        'meta_id': 1,
+                        'table': 'user_tab',
+                        'insert_fields': {'name': '$name', 'age': '$loop_index'},
+                        'extract_result_to': extract_result_to,
+                    }
+                }]
+            }
+        }]
+
+    def test_coalesce_inserts_in_loop(self):
+        task_name = sys._getframe().f_code.co_name
+        configs = self._get_insert_loop(['a', 'b', 'c', 'd', 'e'], 2)
+        task, task_summary, connection = run_task(task_name, configs)
+        self.assertTrue(task_summary.success, task_summary)
+        self.assertEqual([
+            "INSERT INTO user_tab (name,age) VALUES ('user_a',0),('user_b',1)",
+            "INSERT INTO user_tab (name,age) VALUES ('user_c',2),('user_d',3)",
+            "INSERT INTO user_tab (name,age) VALUES ('user_e',4)",
+        ], connection.statements)
+        loop_result = task_summary.step_results[0]
+        # results are recorded in the loops of the rows
+        self.assertEqual(['set name', 'insert'] * 5, [r.name for r in loop_result.children])
+        self.assertTrue(all(r.success for r in loop_result.children))
+        # id of the last row, the same as inserting rows one by one
+        self.assertEqual(5, task.ctx.get_variable('id'))
+
+    def test_coalesce_inserts_fallback(self):
+        task_name = sys._getframe().f_code.co_name
+        configs = self._get_insert_loop(['a', 'bad', 'c', 'd'], 10)
+        task, task_summary, connection = run_task(task_name, configs, fail_on='user_bad')
+        self.assertFalse(task_summary.success)
+        self.assertEqual([
+            "INSERT INTO user_tab (name,age) VALUES ('user_a',0),('user_bad',1),('user_c',2),('user_d',3)",
+            "INSERT INTO user_tab (name,age) VALUES ('user_a',0)",
+            "INSERT INTO user_tab (name,age) VALUES ('user_bad',1)",
+        ], connection.statements)
+        inserts = [r for r in task_summary.step_results[0].children if r.name == 'insert']
+        self.assertEqual([True, False, False, False], [r.success for r in inserts])
+        self.assertIn('[loop:1] IntegrityError(1062', inserts[1].execute_error)
+        self.assertIn('[loop:2]', inserts[2].execute_error)
+        self.assertIn('not inserted, a previous row failed', inserts[2].execute_error)
+
+    def test_coalesce_inserts_disabled(self):
+        task_name = sys._getframe().f_code.co_name
+        # name is read by the insert itself
+        configs = self._get_insert_loop(['a', 'b'], 10, extract_result_to='name')
+        task, task_summary, connection = run_task(task_name, configs)
+        self.assertTrue(task_summary.success, task_summary)
+        self.assertEqual(2, len(connection.statements))
+
+        configs = self._get_insert_loop(['a', 'b'], 1)
+        task, task_summary, connection = run_task(task_name, configs)
+        self.assertTrue(task_summary.success, task_summary)
+        self.assertEqual(2, len(connection.statements))
+
+        # disabled by default
+        del configs[0]['config']['insert_batch_size']
+        task, task_summary, connection = run_task(task_name, configs)
+        self.assertTrue(task_summary.success, task_summary)
+        self.assertEqual(2, len(connection.statements))
+
+    def test_get_coalescable_inserts(self):
+        insert = {'type': 'SQL_INSERT', 'config': {'insert_fields': {'name': '$name'}}}
+        self.assertEqual({1}, get_coalescable_inserts([
+            {'type': 'PARAM_SET', 'config': {'name': 'user_$loop_index'}}, insert]))
+        # children which may depend on the inserted rows, or have effects out of the loop
+        for config in [{'type': 'PARAM_SET', 'config': {'name': '${make_name($loop_index)}'}},
+                       {'type': 'HTTP', 'config': {'url': 'http://example.com'}},
+                       {'type': 'REDIS_SET', 'config': {'key': 'a', 'value': 1}},
+                       {'type': 'SCRIPT_LOAD', 'config': {'script': 'a = 1'}},
+                       {'type': 'SQL_SELECT', 'config': {'where': 'id = 1'}}]:
+            self.assertEqual(set(), get_coalescable_inserts([config, insert]), config)
+
+    def test_coalesce_inserts_aggregate(self):
+        task_name = sys._getframe().f_code.co_name
+        configs = self._get_insert_loop(['a', 'b', 'bad', 'd', 'e'], 10)
+        configs[0]['config'].update(summary_mode='aggregate', summary_samples=2)
+        task, task_summary, connection = run_task(task_name, configs, fail_on='user_bad')
+        self.assertFalse(task_summary.success)
+        loop_result = task_summary.step_results[0]
+        # samples of the first 2 loops, and the failed rows of the following loops
+        self.assertEqual(['set name', 'insert', 'set name', 'insert', 'insert', 'insert', 'insert'],
+                         [r.name for r in loop_result.children])
+        for r, loop_index in zip(loop_result.children[4:], [2, 3, 4]):
+            self.assertIn(f'[loop:{loop_index}]', r.execute_error)
+        insert_stat = loop_result.stats[1]
+        self.assertEqual((5, 2, 3), (insert_stat.count, insert_stat.success_count, insert_stat.fail_count))
+
+    def test_transaction(self):
+        task_name = sys._getframe().f_code.co_name
+        configs = [{
+            'name': 'transaction',
+            'type': 'SQL_TRANSACTION',
+            'config': {
+                'children': [{
+                    'name': 'insert user',
+                    'type': 'SQL_INSERT',
+                    'config': {
+                        'meta_id': 1,
+                        'table': 'user_tab',
+                        'insert_fields': {'name': 'a'},
+                        'extract_result_to': 'user_id',
+                    }
+                }, {
+                    'name': 'insert profile',
+                    'type': 'SQL_INSERT',
+                    'config': {
+                        'meta_id': 1,
+                        'table': 'profile_tab',
+                        'insert_fields': {'user_id': '$user_id'},
+                    }
+                }]
+            }
+        }]
+        task, task_summary, connection = run_task(task_name, configs)
+        self.assertTrue(task_summary.success, task_summary)
+        self.assertEqual(["INSERT INTO user_tab (name) VALUES ('a')", 'INSERT INTO profile_tab (user_id) VALUES (1)'],
+                         connection.statements)
+        self.assertEqual([2], connection.commits)
+        self.assertEqual([], connection.rollbacks)
+
+        task, task_summary, connection = run_task(task_name, configs, fail_on='profile_tab')
+        self.assertFalse(task_summary.success)
+        self.assertEqual([], connection.commits)
+        self.assertEqual([2], connection.rollbacks)
+
+    def test_transaction_commit_every(self):
+        task_name = sys._getframe().f_code.co_name
+        configs = [{
+            'name': 'transaction',
+            'type': 'SQL_TRANSACTION',
+            'config': {
+                'commit_every': 2,
+                'children': self._get_insert_loop(['a', 'b', 'c', 'd', 'e'], 10),
+            }
+        }]
+        task, task_summary, connection = run_task(task_name, configs)
+        self.assertTrue(task_summary.success, task_summary)
+        # buffered rows are inserted before commit
+        self.assertEqual([2, 2, 1], [sql.count('),(') + 1 for sql in connection.statements])
+        self.assertEqual([1, 2, 3], connection.commits)
+
+    def test_transaction_in_loop(self):
+        task_name = sys._getframe().f_code.co_name
+        configs = [{
+            'name': 'outer loop',
+            'type': 'LOOP',
+            'config': {
+                'loop_from': [1, 2, 3],
+                'children': [{
+                    'name': 'transaction',
+                    'type': 'SQL_TRANSACTION',
+                    'config': {
+                        'commit_every': 1,
+                        'children': self._get_insert_loop(['a', 'b'], 1),
+                    }
+                }]
+            }
+        }]
+        task, task_summary, connection = run_task(task_name, configs)
+        self.assertTrue(task_summary.success, task_summary)
+        self.assertEqual(6, len(connection.statements))
+        # every inner loop is committed in every outer loop, the transaction of an outer loop
+        # is not taken as the one of a previous outer loop
+        self.assertEqual([1, 2, 2, 3, 4, 4, 5, 6, 6], connection.commits)
+
+    def test_transaction_concurrent(self):
+        task_name = sys._getframe().f_code.co_name
+        loop = self._get_insert_loop(['a', 'b', 'c', 'd'], 1)
+        loop[0]['config']['concurrency'] = 2
+        configs = [{
+            'name': 'transaction',
+            'type': 'SQL_TRANSACTION',
+            'config': {
+                'children': loop,
+            }
+        }]
+        # inserts of worker threads would not see the transaction
+        task, task_summary, connection = run_task(task_name, configs)
+        self.assertFalse(task_summary.success)
+        self.assertIn('concurrency of LOOP loop should be 1 in SQL_TRANSACTION', task_summary.step_results[0].config_error)
+        self.assertEqual([], connection.statements)
+
+        # a transaction in every loop of a concurrent loop is bound to the thread running the loop
+        configs = [{
+            'name': 'outer loop',
+            'type': 'LOOP',
+            'config': {
+                'loop_from': [1, 2, 3, 4],
+                'concurrency': 2,
+                'children': [{
+                    'name': 'transaction',
+                    'type': 'SQL_TRANSACTION',
+                    'config': {
+                        'children': self._get_insert_loop(['a', 'b'], 1),
+                    }
+                }]
+            }
+        }]
+        task, task_summary, connection = run_task(task_name, configs)
+        self.assertTrue(task_summary.success, task_summary)
+        self.assertEqual(8, len(connection.statements))
+
+    def test_select_limit(self):
+        task_name = sys._getframe().f_code.co_name
+        configs = [{
+            'name': 'select',
+            'type': 'SQL_SELECT',
+            'config': {
+                'meta_id': 1,
+                'table': 'user_tab',
+                'where': 'age > :age',
+                'where_args': {'age': 1},
+                'limit': 3,
+                'extract_result_to': 'users',
+            }
+        }]
+        rows = [{'id': i} for i in range(5)]
+        task, task_summary, connection = run_task(task_name, configs, rows=rows)
+        self.assertTrue(task_summary.success, task_summary)
+        self.assertEqual(['SELECT * FROM user_tab WHERE age > 1 LIMIT 3'], connection.statements)
+        self.assertEqual(rows[:3], task.ctx.get_variable('users'))
+
+    def test_select_shape(self):
+        task_name = sys._getframe().f_code.co_name
+
+        def get_select(name: Text, limit: int, **kwargs) -> dict:
+            return {
+                'name': name,
+                'type': 'SQL_SELECT',
+                'config': {
+                    'meta_id': 1,
+                    'table': 'user_tab',
+                    'where': 'age > :age',
+                    'where_args': {'age': 1},
+                    'limit': limit,
+                    'extract_result_to': name,
+                    **kwargs,
+                }
+            }
+
+        configs = [
+            get_select('name', 1, columns=['name'], shape='scalar'),
+            get_select('names', 10, columns=['name'], shape='column'),
+            get_select('users', 10, columns=['id', 'name'], shape='dict', key_column='id'),
+        ]
+        rows = [{'id': 1, 'name': 'a'}, {'id': 2, 'name': 'b'}]
+        task, task_summary, connection = run_task(task_name, configs, rows=rows)
+        self.assertTrue(task_summary.success, task_summary)
+        self.assertEqual([
+            'SELECT name FROM user_tab WHERE age > 1 LIMIT 1',
+            'SELECT name FROM user_tab WHERE age > 1 LIMIT 10',
+            'SELECT id,name FROM user_tab WHERE age > 1 LIMIT 10',
+        ], connection.statements)
+        self.assertEqual('a', task.ctx.get_variable('name'))
+        self.assertEqual(['a', 'b'], task.ctx.get_variable('names'))
+        self.assertEqual({1: rows[0], 2: rows[1]}, task.ctx.get_variable('users'))
+
+        # scalar of no row
+        task, task_summary, connection = run_task(task_name, configs[:1])
+        self.assertFalse(task_summary.success)
+        self.assertIsNone(task.ctx.get_variable('name'))
+
+    def test_select_stream_in_loop(self):
+        task_name = sys._getframe().f_code.co_name
+        configs = [{
+            'name': 'select',
+            'type': 'SQL_SELECT',
+            'config': {
+                'meta_id': 1,
+                'table': 'user_tab',
+                'where': 'age > :age',
+                'where_args': {'age': 1},
+                'columns': ['id'],
+                'shape': 'column',
+                'limit': 0,
+                'stream': True,
+                'fetch_size': 2,
+                'extract_result_to': 'users',
+            }
+        }, {
+            'name': 'loop',
+            'type': 'LOOP',
+            'config': {
+                'loop_from': '$users',
+                'insert_batch_size': 10,
+                'children': [{
+                    'name': 'insert order',
+                    'type': 'SQL_INSERT',
+                    'config': {
+                        'meta_id': 1,
+                        'table': 'order_tab',
+                        'insert_fields': {'user_id': '$loop_param'},
+                    }
+                }]
+            }
+        }]
+        rows = [{'id': i} for i in range(5)]
+        task, task_summary, connection = run_task(task_name, configs, rows=rows)
+        self.assertTrue(task_summary.success, task_summary)
+        self.assertEqual([
+            'SELECT id FROM user_tab WHERE age > 1',
+            'INSERT INTO order_tab (user_id) VALUES (0),(1),(2),(3),(4)',
+        ], connection.statements)
+        self.assertEqual([2, 2, 2, 2], connection.fetches)
+        self.assertIn(pymysql.cursors.SSDictCursor, connection.cursor_classes)
+
+    def _get_lookup_loop(self, loop_from: list, concurrency: int):
+        return [{
+            'name': 'load script',
+            'type': 'SCRIPT_LOAD',
+            'config': {
+                'script': 'def check_name(id, name):\n    assert name == f"user_{id}", name\n    return True',
+            }
+        }, {
+            'name': 'loop',
+            'type': 'LOOP',
+            'config': {
+                'loop_from': loop_from,
+                'concurrency': concurrency,
+                'children': [{
+                    'name': 'lookup',
+                    'type': 'SQL_SELECT',
+                    'config': {
+                        'meta_id': 1,
+                        'table': 'user_tab',
+                        'where': 'age > :age',
+                        'where_args': {'age': 1},
+                        'columns': ['name'],
+                        'shape': 'scalar',
+                        'lookup_key': 'id',
+                        'lookup_value': '$loop_param',
+                        'lookup_window': 4,
+                        'extract_result_to': 'name',
+                    }
+                }, {
+                    'name': 'check name',
+                    'type': 'PARAM_SET',
+                    'config': {
+                        'checked': '${check_name($loop_param, $name)}',
+                    }
+                }]
+            }
+        }]
+
+    def test_select_lookup(self):
+        task_name = sys._getframe().f_code.co_name
+        rows = [{'id': i, 'name': f'user_{i}'} for i in range(20)]
+        configs = self._get_lookup_loop([3, 1, 3], 1)
+        task, task_summary, connection = run_task(task_name, configs, rows=rows)
+        self.assertTrue(task_summary.success, task_summary)
+        # a serial loop does not wait for other keys
+        self.assertEqual([
+            'SELECT name,id FROM user_tab WHERE (age > 1) AND id IN (3)',
+            'SELECT name,id FROM user_tab WHERE (age > 1) AND id IN (1)',
+            'SELECT name,id FROM user_tab WHERE (age > 1) AND id IN (3)',
+        ], connection.statements)
+
+        # a missing key fails its own loop only
+        configs = self._get_lookup_loop([1, 100], 1)
+        task, task_summary, connection = run_task(task_name, configs, rows=rows)
+        self.assertFalse(task_summary.success)
+        self.assertEqual(2, len(connection.statements))
+
+    def test_select_lookup_concurrently(self):
+        task_name = sys._getframe().f_code.co_name
+        rows = [{'id': i, 'name': f'user_{i}'} for i in range(20)]
+        configs = self._get_lookup_loop(list(range(20)), 4)
+        connection = FakeConnection()
+        connection.rows = rows
+        connection.lookup_delay = 0.05
+        with mock.patch('d7.steps.util.connect_mysql', return_value=connection):
+            task = create_task(task_name, configs)
+            task_summary = task.execute()
+        close_mysql_pools()
+        self.assertTrue(task_summary.success, task_summary)
+        # keys of concurrent loops are looked up together, at most 4 keys in one query
+        self.assertLess(len(connection.statements), 20)
+        keys = []
+        for sql in connection.statements:
+            statement_keys = re.search(r'IN \((.*)\)$', sql).group(1).split(',')
+            self.assertLessEqual(len(statement_keys), 4)
+            keys.extend(statement_keys)
+        self.assertEqual([str(i) for i in range(20)], sorted(keys, key=int))
+
+    def test_chunked_update(self):
+        task_name = sys._getframe().f_code.co_name
+        configs = [{
+            'name': 'chunked update',
+            'type': 'SQL_CHUNKED_UPDATE',
+            'config': {
+                'meta_id': 1,
+                'table': 'user_tab',
+                'update_fields': {'status': 'expired'},
+                'where': 'age > :age',
+                'where_args': {'age': 1},
+                'chunk_size': 2,
+                'extract_result_to': 'result',
+            }
+        }]
+        rows = [{'id': i} for i in (1, 2, 5, 7, 8)]
+        task, task_summary, connection = run_task(task_name, configs, rows=rows)
+        self.assertTrue(task_summary.success, task_summary)
+        self.assertEqual([
+            'SELECT id FROM user_tab WHERE (age > 1) ORDER BY id LIMIT 2',
+            "UPDATE user_tab SET status='expired' WHERE (age > 1) AND id BETWEEN 1 AND 2",
+            'SELECT id FROM user_tab WHERE (age > 1) AND id > 2 ORDER BY id LIMIT 2',
+            "UPDATE user_tab SET status='expired' WHERE (age > 1) AND id BETWEEN 5 AND 7",
+            'SELECT id FROM user_tab WHERE (age > 1) AND id > 7 ORDER BY id LIMIT 2',
+            "UPDATE user_tab SET status='expired' WHERE (age > 1) AND id BETWEEN 8 AND 8",
+        ], connection.statements)
+        # commit per chunk
+        self.assertEqual([2, 4, 6], connection.commits)
+        result = task.ctx.get_variable('result')
+        self.assertEqual(5, result['rowcount'])
+        self.assertEqual(3, result['chunks'])
+        self.assertEqual(8, result['last_key'])
+        self.assertGreater(result['throughput'], 0)
+
+    def test_chunked_delete(self):
+        task_name = sys._getframe().f_code.co_name
+        configs = [{
+            'name': 'chunked delete',
+            'type': 'SQL_CHUNKED_DELETE',
+            'config': {
+                'meta_id': 1,
+                'table': 'user_tab',
+                'where': 'age > :age',
+                'where_args': {'age': 1},
+                'key_column': 'uid',
+                'chunk_size': 2,
+                'pause': 0.01,
+                'extract_result_to': 'result',
+            }
+        }]
+        rows = [{'uid': i} for i in range(4)]
+        task, task_summary, connection = run_task(task_name, configs, rows=rows)
+        self.assertTrue(task_summary.success, task_summary)
+        # the last chunk is full, so one more SELECT finds no key
+        self.assertEqual([
+            'SELECT uid FROM user_tab WHERE (age > 1) ORDER BY uid LIMIT 2',
+            'DELETE FROM user_tab WHERE (age > 1) AND uid BETWEEN 0 AND 1',
+            'SELECT uid FROM user_tab WHERE (age > 1) AND uid > 1 ORDER BY uid LIMIT 2',
+            'DELETE FROM user_tab WHERE (age > 1) AND uid BETWEEN 2 AND 3',
+            'SELECT uid FROM user_tab WHERE (age > 1) AND uid > 3 ORDER BY uid LIMIT 2',
+        ], connection.statements)
+        self.assertEqual([], connection.rows)
+        result = task.ctx.get_variable('result')
+        self.assertEqual(4, result['rowcount'])
+        self.assertEqual(2, result['chunks'])
+
+    def _enable_local_infile(self):
+        def fetch_meta(meta_id):
+            config = {'username': 'u', 'password': 'p', 'host': 'db', 'database': 'd', 'local_infile': True}
+            return SimpleNamespace(config=json.dumps(config)), None
+
+        set_fetch_meta_func(fetch_meta)
+        self.addCleanup(set_fetch_meta_func, None)
+
+    def test_load_row_template(self):
+        task_name = sys._getframe().f_code.co_name
+        self._enable_local_infile()
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, spool_dir)
+        configs = [{
+            'name': 'load',
+            'type': 'SQL_LOAD',
+            'config': {
+                'meta_id': 1,
+                'table': 'user_tab',
+                'row_template': {'name': 'user\t$row_index', 'age': '$row_index', 'remark': None},
+                'count': 100,
+                'spool_dir': spool_dir,
+                'max_spool_size': 1024,
+                'on_duplicate': 'replace',
+                'extract_result_to': 'result',
+            }
+        }]
+        task, task_summary, connection = run_task(task_name, configs)
+        self.assertTrue(task_summary.success, task_summary)
+        self.assertRegex(connection.statements[0],
+                         r"^LOAD DATA LOCAL INFILE '.*d7_load_.*\.tsv' REPLACE INTO TABLE user_tab "
+                         r"CHARACTER SET utf8mb4 FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' "
+                         r"LINES TERMINATED BY '\\n' \(name,age,remark\)$")
+        # every file is committed on its own and removed
+        self.assertGreater(len(connection.statements), 1)
+        self.assertEqual(len(connection.statements), len(connection.commits))
+        self.assertTrue(all(len(content) <= 1024 for content in connection.loaded))
+        self.assertEqual([], os.listdir(spool_dir))
+        lines = b''.join(connection.loaded).splitlines()
+        self.assertEqual(100, len(lines))
+        self.assertEqual(b'user\\t0\t0\t\\N', lines[0])
+        self.assertEqual(b'user\\t99\t99\t\\N', lines[-1])
+        result = task.ctx.get_variable('result')
+        self.assertEqual(100, result['rowcount'])
+        self.assertEqual(100, result['rows'])
+        self.assertEqual(len(connection.statements), result['files'])
+        self.assertEqual(sum(len(content) for content in connection.loaded), result['bytes'])
+
+    def test_load_file(self):
+        task_name = sys._getframe().f_code.co_name
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write('name,age\n"a\\b",1\n中文,2\n')
+        configs = [{
+            'name': 'load',
+            'type': 'SQL_LOAD',
+            'config': {
+                'meta_id': 1,
+                'table': 'user_tab',
+                'file': path,
+            }
+        }]
+        # local_infile is disabled by default
+        task, task_summary, connection = run_task(task_name, configs)
+        self.assertFalse(task_summary.success)
+        self.assertIn('local_infile of meta config 1 should be enabled', str(task_summary))
+        self.assertEqual([], connection.statements)
+
+        self._enable_local_infile()
+        task, task_summary, connection = run_task(task_name, configs)
+        self.assertTrue(task_summary.success, task_summary)
+        self.assertTrue(connection.statements[0].endswith('(name,age)'))
+        self.assertEqual(['a\\\\b\t1\n中文\t2\n'.encode()], connection.loaded)
+
+    def test_select_stream_stopped(self):
+        connection = FakeConnection()
+        connection.rows = [{'id': i} for i in range(5)]
+        with mock.patch('d7.steps.util.connect_mysql', return_value=connection):
+            rows = iter(SqlRowStream(1, 'SELECT * FROM user_tab', 2))
+            self.assertEqual({'id': 0}, next(rows))
+            self.assertTrue(connection.open)
+            rows.close()
+        close_mysql_pools()
+        # the rest rows are not read
+        self.assertFalse(connection.open)
+        self.assertEqual([2], connection.fetches)
+
+
+if __name__ == '__main__':
+    unittest.main()
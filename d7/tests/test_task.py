@@ -1,15 +1,22 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
 import json
+import os
 import sys
+import time
 import unittest
 from typing import List, Text
+from unittest import mock
 
 import pymysql
 from d7.core.builtin import get_uuid, unix_now
+from d7.core.logger import get_task_log_file
 from d7.steps.step import StepTypeEnum
 from d7.steps.step_http import content_type_form, content_type_json
-from d7.steps.task import Task, TaskSummary
+from d7.steps.step_script_load import ScriptLoadConfig
+from d7.steps.task import Task, TaskSummary, Schedule, get_steps_dependencies, set_max_loop_workers, \
+    MAX_LOOP_WORKERS
 from d7.steps.util import get_metaconfig_db
 from d7.task_maker import create_task, create_task_from_json
 
@@ -47,6 +54,549 @@ class TaskTestCase(unittest.TestCase):
         self.assertEqual('v4', task.ctx.get_variable('p3.p4'))
         self.assertEqual('v5', task.ctx.get_variable('p4.$p1.p5'))
 
+    def test_param_set_in_loop(self):
+        task_name = sys._getframe().f_code.co_name
+        configs = [{
+            'name': 'loop',
+            'type': 'LOOP',
+            'config': {
+                'loop_from': ['a', 'b', 'c'],
+                'children': [{
+                    'name': 'set param',
+                    'type': 'PARAM_SET',
+                    'config': {
+                        'p1': '${loop_param}_$loop_index',
+                        'p2': {'p3': 'v3'},
+                    }
+                }]
+            }
+        }]
+        task, task_summary = run_task(task_name, configs)
+        self.assertTrue(task_summary.success)
+        self.assertEqual('c_2', task.ctx.get_variable('p1'))
+        self.assertEqual('v3', task.ctx.get_variable('p2.p3'))
+
+    def test_loop_param_set_not_shared(self):
+        task_name = sys._getframe().f_code.co_name
+        configs = [{
+            'name': 'load script',
+            'type': 'SCRIPT_LOAD',
+            'config': {
+                'script': 'def push(items):\n    items.append(1)\n    return items'
+            }
+        }, {
+            'name': 'loop',
+            'type': 'LOOP',
+            'config': {
+                'loop_from': '${range(3)}',
+                'children': [{
+                    'name': 'set items',
+                    'type': 'PARAM_SET',
+                    'config': {
+                        'items': ['a'],
+                    }
+                }, {
+                    'name': 'push items',
+                    'type': 'PARAM_SET',
+                    'config': {
+                        'pushed': '${push($items)}',
+                    }
+                }]
+            }
+        }]
+        task, task_summary = run_task(task_name, configs)
+        self.assertTrue(task_summary.success)
+        self.assertEqual(['a', 1], task.ctx.get_variable('items'))
+
+    def test_loop_summary_aggregate(self):
+        task_name = sys._getframe().f_code.co_name
+        configs = [{
+            'name': 'loop',
+            'type': 'LOOP',
+            'config': {
+                'loop_from': {'range': [25]},
+                'summary_mode': 'aggregate',
+                'summary_samples': 2,
+                'summary_max_errors': 2,
+                'children': [{
+                    'name': 'set param',
+                    'type': 'PARAM_SET',
+                    'config': {
+                        'p1': '$loop_index',
+                    }
+                }, {
+                    'name': 'fail every 10 loops',
+                    'type': 'SCRIPT_LOAD',
+                    'continue_when_failed': True,
+                    'config': {
+                        'script': 'assert $loop_index % 10, "failed at $loop_index"',
+                    }
+                }]
+            }
+        }]
+        task, task_summary = run_task(task_name, configs)
+        self.assertTrue(task_summary.success)
+        loop_result = task_summary.step_results[0]
+        self.assertEqual(2, len(loop_result.stats))
+        param_stat, script_stat = loop_result.stats
+        self.assertEqual((25, 25, 0), (param_stat.count, param_stat.success_count, param_stat.fail_count))
+        self.assertEqual((25, 22, 3), (script_stat.count, script_stat.success_count, script_stat.fail_count))
+        self.assertEqual(2, len(script_stat.errors))
+        self.assertIn('failed at 10', script_stat.errors[1])
+        # results of the first 2 loops, and the first 2 failed results
+        self.assertEqual(5, len(loop_result.children))
+        self.assertIn('[~] [SCRIPT_LOAD][fail every 10 loops], count=25, success=22, failed=3', str(task_summary))
+
+    def test_loop_concurrency(self):
+        task_name = sys._getframe().f_code.co_name
+
+        def loop_configs(loop_from, concurrency, ordered=True):
+            return [{
+                'name': 'load script',
+                'type': 'SCRIPT_LOAD',
+                'config': {
+                    'script': 'import time\n'
+                              'def slow(i):\n'
+                              '    time.sleep(0.02 * (i % 3))\n'
+                              '    assert i != 7, "failed at 7"\n'
+                              '    return i'
+                }
+            }, {
+                'name': 'loop',
+                'type': 'LOOP',
+                'config': {
+                    'loop_from': loop_from,
+                    'concurrency': concurrency,
+                    'ordered': ordered,
+                    'children': [{
+                        'name': 'set param',
+                        'type': 'PARAM_SET',
+                        'config': {
+                            'mine': '${slow($loop_index)}',
+                        }
+                    }, {
+                        'name': 'check param',
+                        'type': 'SCRIPT_LOAD',
+                        'config': {
+                            # loop_index is not overwritten by other loops
+                            'script': 'assert $mine == $loop_index',
+                        }
+                    }]
+                }
+            }]
+
+        task, task_summary = run_task(task_name, loop_configs({'range': [7]}, 4))
+        self.assertTrue(task_summary.success)
+        loop_results = task_summary.step_results[1].children
+        self.assertEqual(14, len(loop_results))
+        self.assertTrue(all(step_result.success for step_result in loop_results))
+        # variables of the last loop are kept
+        self.assertEqual(6, task.ctx.get_variable('loop_index'))
+        self.assertEqual(6, task.ctx.get_variable('mine'))
+
+        task, task_summary = run_task(task_name, loop_configs({'range': [7]}, 4, ordered=False))
+        self.assertTrue(task_summary.success)
+        self.assertEqual(14, len(task_summary.step_results[1].children))
+
+        # fail fast
+        task, task_summary = run_task(task_name, loop_configs({'range': [1000]}, 4))
+        self.assertFalse(task_summary.success)
+        loop_results = task_summary.step_results[1].children
+        self.assertLess(len(loop_results), 100)
+        self.assertTrue(any('failed at 7' in step_result.config_error for step_result in loop_results))
+
+        # nested loops run in the current thread when the budget is used up
+        set_max_loop_workers(1)
+        try:
+            configs = loop_configs({'range': [2]}, 2)
+            configs[1]['config']['children'] = [{
+                'name': 'inner loop',
+                'type': 'LOOP',
+                'config': loop_configs({'range': [3]}, 2)[1]['config'],
+            }]
+            task, task_summary = run_task(task_name, configs)
+        finally:
+            set_max_loop_workers(MAX_LOOP_WORKERS)
+        self.assertTrue(task_summary.success)
+        self.assertEqual(2, len(task_summary.step_results[1].children))
+        self.assertEqual(6, len(task_summary.step_results[1].children[0].children))
+
+    def test_loop_processes(self):
+        task_name = sys._getframe().f_code.co_name
+
+        def loop_configs(config):
+            return [{
+                'name': 'load script',
+                'type': 'SCRIPT_LOAD',
+                'config': {
+                    'script': 'import os\n'
+                              'def getpid():\n'
+                              '    return os.getpid()\n'
+                              'def gen(n):\n'
+                              '    yield from range(n)'
+                }
+            }, {
+                'name': 'set param',
+                'type': 'PARAM_SET',
+                'config': {
+                    'prefix': 'p',
+                }
+            }, {
+                'name': 'loop',
+                'type': 'LOOP',
+                'config': {
+                    'processes': 2,
+                    'children': [{
+                        'name': 'set param',
+                        'type': 'PARAM_SET',
+                        'config': {
+                            'pid': '${getpid()}',
+                            'p': '$prefix$loop_index',
+                        }
+                    }],
+                    **config
+                }
+            }]
+
+        task, task_summary = run_task(task_name, loop_configs({'loop_from': {'range': [5]}}))
+        self.assertTrue(task_summary.success)
+        self.assertEqual(5, len(task_summary.step_results[2].children))
+        # variables of the last loop are kept
+        self.assertEqual('p4', task.ctx.get_variable('p'))
+        self.assertNotEqual(os.getpid(), task.ctx.get_variable('pid'))
+        self.assertIn('[shard:1]', task.get_task_log())
+
+        task, task_summary = run_task(task_name, loop_configs({
+            'parameters': {'a': [1, 2], 'b': [1, 2, 3]},
+            'summary_mode': 'aggregate',
+            'summary_samples': 1,
+        }))
+        self.assertTrue(task_summary.success)
+        self.assertEqual(6, task_summary.step_results[2].stats[0].count)
+        self.assertEqual('p5', task.ctx.get_variable('p'))
+
+        # generators can not be split, run in current process
+        task, task_summary = run_task(task_name, loop_configs({'loop_from': '${gen(3)}'}))
+        self.assertTrue(task_summary.success)
+        self.assertEqual(os.getpid(), task.ctx.get_variable('pid'))
+
+    def test_execute_async(self):
+        task_name = sys._getframe().f_code.co_name
+        configs = [{
+            'name': 'load script',
+            'type': 'SCRIPT_LOAD',
+            'config': {
+                'script': 'def double(i):\n    return i * 2'
+            }
+        }, {
+            'name': 'loop',
+            'type': 'LOOP',
+            'config': {
+                'loop_from': {'range': [6]},
+                'concurrency': 3,
+                'children': [{
+                    'name': 'set param',
+                    'type': 'PARAM_SET',
+                    'config': {
+                        'outer': '$loop_index',
+                        'doubled': '${double($loop_index)}',
+                    }
+                }, {
+                    'name': 'inner loop',
+                    'type': 'LOOP',
+                    'config': {
+                        'loop_from': [1, 2],
+                        'children': [{
+                            'name': 'check param',
+                            'type': 'SCRIPT_LOAD',
+                            'config': {
+                                'script': 'assert $doubled == $outer * 2',
+                            }
+                        }]
+                    }
+                }]
+            }
+        }]
+        task = create_task(task_name, configs)
+        task_summary = asyncio.run(task.execute_async())
+        self.assertTrue(task_summary.success, task_summary)
+        loop_results = task_summary.step_results[1].children
+        self.assertEqual(12, len(loop_results))
+        self.assertEqual(2, len(loop_results[1].children))
+        self.assertEqual(10, task.ctx.get_variable('doubled'))
+        self.assertIn('task_summary', task_summary.log)
+
+    def test_schedule_dag(self):
+        task_name = sys._getframe().f_code.co_name
+        configs = [{
+            'name': 'load script',
+            'type': 'SCRIPT_LOAD',
+            'config': {
+                'script': 'import time\n'
+                          'def slow(value):\n'
+                          '    time.sleep(0.2)\n'
+                          '    return value\n'
+                          'def sum_values(*values):\n'
+                          '    return sum(values)'
+            }
+        }, {
+            'name': 'set a',
+            'type': 'PARAM_SET',
+            'config': {'a': '${slow(1)}'}
+        }, {
+            'name': 'set b',
+            'type': 'PARAM_SET',
+            'config': {'b': '${slow(2)}'}
+        }, {
+            'name': 'set c',
+            'type': 'PARAM_SET',
+            'config': {'c': '${slow(3)}'}
+        }, {
+            'name': 'set sum',
+            'type': 'PARAM_SET',
+            'config': {'sum': '${sum_values($a, $b, $c)}'}
+        }]
+        self.assertEqual([set(), {0}, {0}, {0}, {0, 1, 2, 3}], get_steps_dependencies(configs))
+
+        task = Task(name=task_name, configs=configs, log_file=get_task_log_file(get_uuid()), schedule=Schedule.DAG)
+        start_at = time.time()
+        task_summary = task.execute()
+        self.assertLess(time.time() - start_at, 0.5)
+        self.assertTrue(task_summary.success, task_summary)
+        self.assertEqual([config['name'] for config in configs],
+                         [step_result.name for step_result in task_summary.step_results])
+        self.assertEqual(6, task.ctx.get_variable('sum'))
+
+        # failed step stops the waiting ones
+        configs[2]['config']['b'] = '${slow($not_exists)}'
+        task = Task(name=task_name, configs=configs, log_file=get_task_log_file(get_uuid()), schedule=Schedule.DAG)
+        task_summary = task.execute()
+        self.assertFalse(task_summary.success)
+        self.assertEqual(4, len(task_summary.step_results))
+
+    def test_parallel(self):
+        task_name = sys._getframe().f_code.co_name
+
+        def parallel_configs(config):
+            return [{
+                'name': 'load script',
+                'type': 'SCRIPT_LOAD',
+                'config': {
+                    'script': 'import time\n'
+                              'def slow(seconds, value):\n'
+                              '    time.sleep(seconds)\n'
+                              '    assert value != "fail", "failed"\n'
+                              '    return value'
+                }
+            }, {
+                'name': 'parallel',
+                'type': 'PARALLEL',
+                'config': {
+                    'children': [{
+                        'name': f'set p{i}',
+                        'type': 'PARAM_SET',
+                        'config': {f'p{i}': f'${{slow({seconds}, {value})}}'}
+                    } for i, (seconds, value) in enumerate([(0.1, 'a'), (0.2, 'fail'), (0.3, 'c'), (0.4, 'd')])],
+                    **config
+                }
+            }]
+
+        start_at = time.time()
+        task, task_summary = run_task(task_name, parallel_configs({}))
+        self.assertLess(time.time() - start_at, 0.5)
+        self.assertFalse(task_summary.success)
+        parallel_result = task_summary.step_results[1]
+        self.assertEqual('parallel', parallel_result.type)
+        self.assertEqual(['set p0', 'set p1', 'set p2', 'set p3'],
+                         [step_result.name for step_result in parallel_result.children])
+
+        task, task_summary = run_task(task_name, parallel_configs({'join': 'first_success', 'max_concurrency': 1}))
+        self.assertTrue(task_summary.success)
+        # the others are cancelled
+        self.assertEqual(1, len(task_summary.step_results[1].children))
+        self.assertEqual('a', task.ctx.get_variable('p0'))
+
+        task, task_summary = run_task(task_name, parallel_configs({'join': 'quorum', 'quorum': 2}))
+        self.assertTrue(task_summary.success)
+        self.assertEqual('c', task.ctx.get_variable('p2'))
+
+        task, task_summary = run_task(task_name, parallel_configs({'join': 'quorum', 'quorum': 4}))
+        self.assertFalse(task_summary.success)
+        self.assertFalse(task_summary.step_results[1].config_error)
+
+        task, task_summary = run_task(task_name, parallel_configs({'join': 'quorum', 'quorum': 5}))
+        self.assertFalse(task_summary.success)
+        self.assertIn('quorum should <= count of children', task_summary.step_results[1].config_error)
+
+    def test_parallel_loops(self):
+        task_name = sys._getframe().f_code.co_name
+
+        def loop_config(name: Text, count: int):
+            return {
+                'name': f'loop {name}',
+                'type': 'LOOP',
+                'config': {
+                    'loop_from': [f'{name}{i}' for i in range(count)],
+                    'children': [{
+                        'name': 'check param',
+                        'type': 'PARAM_SET',
+                        'config': {'checked': f'${{check({name}, $loop_param)}}'}
+                    }]
+                }
+            }
+
+        configs = [{
+            'name': 'load script',
+            'type': 'SCRIPT_LOAD',
+            'config': {
+                'script': 'import time\n'
+                          'def check(prefix, param):\n'
+                          '    time.sleep(0.001)\n'
+                          '    assert param.startswith(prefix), param\n'
+                          '    return param'
+            }
+        }, {
+            'name': 'parallel',
+            'type': 'PARALLEL',
+            'config': {
+                'children': [loop_config('a', 40), loop_config('b', 40), {
+                    'name': 'set p',
+                    'type': 'PARAM_SET',
+                    'config': {'p': 1}
+                }, {
+                    'name': 'load script',
+                    'type': 'SCRIPT_LOAD',
+                    'config': {'script': 'def two():\n    return 2'}
+                }]
+            }
+        }, {
+            'name': 'use exported',
+            'type': 'PARAM_SET',
+            'config': {'q': '${two()}$p'}
+        }]
+        task, task_summary = run_task(task_name, configs)
+        self.assertTrue(task_summary.success, task_summary)
+        self.assertEqual([40, 40], [len(result.children) for result in task_summary.step_results[1].children[:2]])
+        # exported by PARAM_SET and SCRIPT_LOAD children, variables of loops are kept in their own contexts
+        self.assertEqual('21', task.ctx.get_variable('q'))
+        variables = task.ctx.get_variables()
+        self.assertNotIn('checked', variables)
+        # loop_param of the task itself
+        self.assertEqual(1, variables['loop_param'])
+
+    def test_step_plan(self):
+        task_name = sys._getframe().f_code.co_name
+        configs = [{
+            'name': 'loop',
+            'type': 'LOOP',
+            'config': {
+                'loop_from': {'range': [5]},
+                'children': [{
+                    'name': 'load script',
+                    'type': 'SCRIPT_LOAD',
+                    'config': {
+                        'script': 'def echo(value):\n    return value'
+                    }
+                }, {
+                    'name': 'set param',
+                    'type': 'PARAM_SET',
+                    'config': {
+                        'p1': '${echo($loop_index)}',
+                    }
+                }]
+            }
+        }]
+        with mock.patch('d7.steps.step_script_load.ScriptLoadConfig', wraps=ScriptLoadConfig) as config_class:
+            task, task_summary = run_task(task_name, configs)
+        self.assertTrue(task_summary.success)
+        self.assertEqual(10, len(task_summary.step_results[0].children))
+        self.assertEqual(4, task.ctx.get_variable('p1'))
+        # constant config is validated once
+        self.assertEqual(1, config_class.call_count)
+        loop_plan = task.step_plans[0]
+        self.assertIsNotNone(loop_plan.prototype)
+        script_plan, param_plan = loop_plan.prototype.step_plans
+        self.assertIsNotNone(script_plan.prototype)
+        self.assertIsNone(param_plan.prototype)
+        self.assertIsNotNone(param_plan.step_config)
+
+    def test_loop_parameters(self):
+        task_name = sys._getframe().f_code.co_name
+        configs = [{
+            'name': 'loop',
+            'type': 'LOOP',
+            'config': {
+                'parameters': {
+                    'user_agent': ['iOS/10.1', 'iOS/10.2'],
+                    'username-password': [['user1', '111111'], ['user2', '222222'], ['user3', '333333']],
+                },
+                'children': [{
+                    'name': 'set param',
+                    'type': 'PARAM_SET',
+                    'config': {
+                        'p1': '$loop_index:$user_agent:$username:$password',
+                    }
+                }]
+            }
+        }]
+        task, task_summary = run_task(task_name, configs)
+        self.assertTrue(task_summary.success)
+        self.assertEqual(6, len(task_summary.step_results[0].children))
+        self.assertEqual('5:iOS/10.2:user3:333333', task.ctx.get_variable('p1'))
+
+        configs[0]['config']['parameters'] = {'loop_index-user_agent': [[1, 'iOS/10.1']]}
+        task, task_summary = run_task(task_name, configs)
+        self.assertFalse(task_summary.success)
+        self.assertIn('loop_index is reserved', task_summary.step_results[0].config_error)
+
+    def test_loop_from_sources(self):
+        task_name = sys._getframe().f_code.co_name
+
+        def loop_configs(loop_from):
+            return [{
+                'name': 'load script',
+                'type': 'SCRIPT_LOAD',
+                'config': {
+                    'script': 'def gen_squares(n):\n    for i in range(n):\n        yield i * i'
+                }
+            }, {
+                'name': 'loop',
+                'type': 'LOOP',
+                'config': {
+                    'loop_from': loop_from,
+                    'children': [{
+                        'name': 'set param',
+                        'type': 'PARAM_SET',
+                        'config': {
+                            'p1': '$loop_index:$loop_param',
+                        }
+                    }]
+                }
+            }]
+
+        # range spec
+        task, task_summary = run_task(task_name, loop_configs({'range': [10, 100, 10]}))
+        self.assertTrue(task_summary.success)
+        self.assertEqual(9, len(task_summary.step_results[1].children))
+        self.assertEqual('8:90', task.ctx.get_variable('p1'))
+
+        # generator returned by function
+        task, task_summary = run_task(task_name, loop_configs('${gen_squares(5)}'))
+        self.assertTrue(task_summary.success)
+        self.assertEqual(5, len(task_summary.step_results[1].children))
+        self.assertEqual('4:16', task.ctx.get_variable('p1'))
+
+        # mapping is sorted by key
+        task, task_summary = run_task(task_name, loop_configs({'b': 2, 'c': 3, 'a': 1}))
+        self.assertTrue(task_summary.success)
+        self.assertEqual('c:3', task.ctx.get_variable('p1'))
+
+        # empty or invalid loop_from
+        for loop_from in ([], {}, '', {'range': 'abc'}, {'range': [0, 'a']}, {'range': [5, 0]}, {'range': [0, 5, 0]}):
+            task, task_summary = run_task(task_name, loop_configs(loop_from))
+            self.assertFalse(task_summary.success, loop_from)
+            self.assertTrue(task_summary.step_results[1].config_error, loop_from)
+
     def test_task_init_failed_invalid_type(self):
         task_name = sys._getframe().f_code.co_name
         configs = [{
@@ -1,9 +1,17 @@
 # -*- coding: utf-8 -*-
 
+import itertools
+import json
+import threading
+import time
 import unittest
+from types import SimpleNamespace
 
 
-from d7.steps.util import normalize_where, parse_curl_to_step_config
+from d7.core.utils import CartesianProduct, gen_cartesian_product, lazy_cartesian_product
+from d7.steps.util import normalize_where, parse_curl_to_step_config, render_sql, set_fetch_meta_func, \
+    get_metaconfig_db, get_metaconfig_redis, invalidate_meta_cache, set_meta_cache_ttl, META_CACHE_TTL, \
+    META_CACHE_ERROR_TTL, MetaCache
 
 
 class UtilTestCase(unittest.TestCase):
@@ -16,6 +24,134 @@ class UtilTestCase(unittest.TestCase):
         for where in where_list:
             self.assertEqual(where[1], normalize_where(where[0]))
 
+    def test_cartesian_product(self):
+        args = [
+            [{'a': 1}, {'a': 2}],
+            [{'x': 111, 'y': 112}, {'x': 121, 'y': 122}, {'x': 131, 'y': 132}],
+            [{'b': 1}, {'b': 2}, {'b': 3}, {'b': 4}],
+        ]
+        expected = [{**i, **j, **k} for (i, j, k) in itertools.product(*args)]
+        self.assertEqual(expected, gen_cartesian_product(*args))
+        self.assertEqual([], gen_cartesian_product())
+        self.assertEqual(args[0], gen_cartesian_product(args[0]))
+
+        product = lazy_cartesian_product(*args)
+        self.assertIsInstance(product, CartesianProduct)
+        self.assertEqual(0, len(lazy_cartesian_product()))
+        self.assertEqual(args[0], list(lazy_cartesian_product(args[0])))
+        self.assertEqual(24, len(product))
+        self.assertEqual(expected, list(product))
+        self.assertEqual(expected, [product[i] for i in range(len(product))])
+        self.assertEqual(expected[-1], product[-1])
+        self.assertEqual(expected[5:17], list(product[5:17]))
+        self.assertEqual(expected[3::5], list(product[3::5]))
+        self.assertEqual(expected[10:2:-3], list(product[10:2:-3]))
+        self.assertEqual(expected[7:9], list(product[5:17][2:4]))
+        self.assertEqual([], list(product[30:]))
+        self.assertIn({'a': 2, 'x': 121, 'y': 122, 'b': 3}, product)
+        with self.assertRaises(IndexError):
+            product[24]
+
+        # items are generated on demand
+        product = CartesianProduct(*[[{f'p{i}': j} for j in range(1000)] for i in range(4)])
+        self.assertEqual(1000 ** 4, len(product))
+        self.assertEqual({'p0': 123, 'p1': 456, 'p2': 789, 'p3': 12}, product[123456789012])
+
+    def test_render_sql(self):
+        sql = 'SELECT * FROM user_tab WHERE id = %(id)s AND name = %(name)s AND status IN %(status)s AND extra = %(extra)s'
+        args = {'id': 1, 'name': "a'b\\c", 'status': [1, 'x'], 'extra': None}
+        self.assertEqual("SELECT * FROM user_tab WHERE id = 1 AND name = 'a\\'b\\\\c' AND status IN (1,'x') AND extra = NULL",
+                         render_sql(sql, args))
+        self.assertEqual("INSERT INTO t VALUES (X'0102', 1.5e0)", render_sql('INSERT INTO t VALUES (%s, %s)', (b'\x01\x02', 1.5)))
+        self.assertEqual('SELECT 1', render_sql('SELECT 1', None))
+        with self.assertRaises(KeyError):
+            render_sql('SELECT * FROM user_tab WHERE id = %(id)s', {})
+
+    def test_meta_cache(self):
+        calls = []
+        errors = set()
+
+        def fetch_meta(meta_id):
+            calls.append(meta_id)
+            time.sleep(0.05)
+            if meta_id in errors:
+                return None, 'meta not found'
+            config = {'username': 'u', 'password': 'p', 'host': f'db{meta_id}', 'database': 'd', 'db': 0}
+            return SimpleNamespace(config=json.dumps(config)), None
+
+        set_fetch_meta_func(fetch_meta)
+        self.addCleanup(set_fetch_meta_func, None)
+        self.addCleanup(set_meta_cache_ttl, META_CACHE_TTL, META_CACHE_ERROR_TTL)
+
+        # single flight
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(get_metaconfig_db(1))) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([1], calls)
+        self.assertEqual(8, len(results))
+        self.assertTrue(all(r is results[0] for r in results))
+        self.assertEqual('db1', results[0].host)
+
+        # db and redis configs are cached separately
+        self.assertIs(results[0], get_metaconfig_db(1))
+        self.assertEqual('db1', get_metaconfig_redis(1).host)
+        self.assertEqual([1, 1], calls)
+
+        invalidate_meta_cache(1)
+        self.assertIsNot(results[0], get_metaconfig_db(1))
+        self.assertEqual([1, 1, 1], calls)
+
+        # errors are cached for error ttl
+        errors.add(2)
+        set_meta_cache_ttl(60, 0.1)
+        self.assertEqual('127.0.0.1', get_metaconfig_db(2).host)
+        self.assertEqual('127.0.0.1', get_metaconfig_db(2).host)
+        self.assertEqual([2], calls[3:])
+        errors.clear()
+        time.sleep(0.1)
+        self.assertEqual('db2', get_metaconfig_db(2).host)
+        self.assertEqual([2, 2], calls[3:])
+
+    def test_meta_cache_invalidate_during_load(self):
+        cache = MetaCache()
+        first_started = threading.Event()
+        release_first = threading.Event()
+        calls = []
+
+        def load_first():
+            calls.append(1)
+            first_started.set()
+            release_first.wait()
+            return 'old', 60
+
+        def load_second():
+            calls.append(2)
+            time.sleep(0.1)
+            return 'new', 60
+
+        first = threading.Thread(target=cache.get, args=('key', load_first))
+        first.start()
+        first_started.wait()
+        cache.invalidate('key')
+        results = []
+        second = threading.Thread(target=lambda: results.append(cache.get('key', load_second)))
+        second.start()
+        time.sleep(0.02)
+        # the first load finishes while the second one is running, the future of the second one is kept
+        release_first.set()
+        first.join()
+        third = threading.Thread(target=lambda: results.append(cache.get('key', load_second)))
+        third.start()
+        second.join()
+        third.join()
+        self.assertEqual([1, 2], calls)
+        self.assertEqual(['new', 'new'], results)
+        self.assertEqual('new', cache.get('key', load_second))
+        self.assertEqual([1, 2], calls)
+
     def test_parse_curl_get(self):
         curl_command = '''
 curl -X GET 'https://dp-admin.shopee.io/api/tw/order/list?categories=30102&fulfillment_status=F5&refund_status=MR0&order_status=OR5&page_size=10' 